@@ -0,0 +1,249 @@
+"""Benchmark the sendNotificationToTopic trigger against in-process fakes.
+
+Every combination of the sweep parameters seeds a fake Firestore with
+subscriptions for one property, then replays property updates through the
+real trigger function. It reports latency percentiles, RPC counts and peak
+memory per combination.
+
+Run from the ``functions`` directory:
+    python -m benchmarks.bench_fanout --subscribers 100,1000,10000 \\
+        --preference-sets 20 --changed-fields 1,5,20 --firestore-latency-ms 5
+"""
+import argparse
+import io
+import json
+import random
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from unittest import mock
+from dataclasses import dataclass, asdict
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from benchmarks.fakes import (
+    FakeDocumentReference,
+    FakeDocumentSnapshot,
+    FakeFirestore,
+    FakeMessaging,
+    FakeTaskQueues,
+    patched_clients,
+)
+from fanOutNotificationShard.function import fanOutNotificationShard
+from sendNotificationToTopic.function import sendNotificationToTopic
+from sendNotificationToTopic.helpers import (
+    coalesceNotifications,
+    sendPushNotification,
+    subscriptionCache,
+)
+from sendNotificationToTopic.helpers.buildNotification import WATCHED_FIELDS
+
+PROPERTY_ID = "property1"
+FIELDS = sorted(WATCHED_FIELDS)
+
+
+@dataclass
+class Scenario:
+    subscribers: int
+    preference_sets: int
+    changed_fields: int
+
+
+@dataclass
+class ScenarioResult:
+    subscribers: int
+    preference_sets: int
+    changed_fields: int
+    p50_ms: float
+    p99_ms: float
+    firestore_rpcs: float
+    fcm_rpcs: float
+    fcm_messages: float
+    document_reads: float
+    document_writes: float
+    peak_mib: float
+
+
+def _percentile(samples: List[float], percentile: float) -> float:
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(percentile / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def _preference_sets(count: int, rng: random.Random) -> List[List[str]]:
+    sets = {frozenset(FIELDS)}
+    attempts = 0
+    while len(sets) < count and attempts < count * 100:
+        attempts += 1
+        sets.add(frozenset(rng.sample(FIELDS, rng.randint(1, max(1, len(FIELDS) // 2)))))
+    return [sorted(preferences) for preferences in sets]
+
+
+def seed_subscriptions(db: FakeFirestore, scenario: Scenario, rng: random.Random) -> None:
+    preference_sets = _preference_sets(scenario.preference_sets, rng)
+    db.seed("subscriptions", {
+        f"sub{i}": {
+            "propertyId": PROPERTY_ID,
+            "userId": f"user{i}",
+            "isSubscribed": True,
+            "alertPreferences": preference_sets[i % len(preference_sets)],
+        }
+        for i in range(scenario.subscribers)
+    })
+
+
+def property_version(version: int, changed_fields: int) -> Dict[str, Any]:
+    """Property document where the first ``changed_fields`` fields carry ``version``."""
+    document = {"documentId": PROPERTY_ID, "insertTimestamp": version, "attempts": version}
+    for index, field in enumerate(FIELDS):
+        document[field] = f"{field}-{version if index < changed_fields else 0}"
+    return document
+
+
+def make_event(db: FakeFirestore, before: Dict[str, Any], after: Dict[str, Any], event_id: str):
+    """Minimal stand-in for the firestore_fn.Event the trigger receives."""
+    reference = FakeDocumentReference(db, f"properties/{PROPERTY_ID}")
+    return SimpleNamespace(
+        id=event_id,
+        params={"propertyId": PROPERTY_ID},
+        data=SimpleNamespace(
+            before=FakeDocumentSnapshot(reference, before),
+            after=FakeDocumentSnapshot(reference, after),
+        ),
+    )
+
+
+def run_scenario(scenario: Scenario, args: argparse.Namespace) -> ScenarioResult:
+    rng = random.Random(args.seed)
+    db = FakeFirestore(args.firestore_latency_ms / 1000, args.firestore_error_rate, args.seed)
+    fcm = FakeMessaging(args.fcm_latency_ms / 1000, args.fcm_error_rate, args.seed)
+    tasks = FakeTaskQueues()
+    task_handlers = {"fanOutNotificationShard": fanOutNotificationShard.__wrapped__}
+    seed_subscriptions(db, scenario, rng)
+    trigger = sendNotificationToTopic.__wrapped__
+
+    latencies: List[float] = []
+    totals = {"firestore": 0, "fcm": 0, "messages": 0, "reads": 0, "writes": 0}
+    peak = 0
+    delivery_mode = sendPushNotification.DeliveryMode(args.delivery_mode)
+    # Every scenario starts cold, the first replayed update fills the cache.
+    subscriptionCache.invalidate()
+    # Coalescing is disabled so every replayed update measures a full fan-out.
+    with patched_clients(db, fcm, tasks), redirect_stdout(io.StringIO()), mock.patch.object(
+        sendPushNotification, "DEFAULT_DELIVERY_MODE", delivery_mode
+    ), mock.patch.object(coalesceNotifications, "COALESCE_WINDOW_SECONDS", 0), mock.patch.object(
+        subscriptionCache, "SUBSCRIPTION_CACHE_ENABLED", not args.no_subscription_cache
+    ):
+        for iteration in range(args.iterations + 1):
+            before = property_version(iteration, scenario.changed_fields)
+            after = property_version(iteration + 1, scenario.changed_fields)
+            # Unique per scenario, the trigger skips event IDs it has already processed.
+            event_id = (
+                f"event-{scenario.subscribers}-{scenario.preference_sets}-"
+                f"{scenario.changed_fields}-{iteration}"
+            )
+            event = make_event(db, before, after, event_id)
+            db.clear("property_notifications")
+            db.clear("fan_out_jobs")
+            db.reset_stats()
+            fcm.reset_stats()
+
+            # The last iteration runs under tracemalloc only to measure peak memory.
+            measure_memory = iteration == args.iterations
+            if measure_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            trigger(event)
+            # Shard tasks of a sharded fan-out run in process as part of the update.
+            tasks.drain(task_handlers, max_workers=args.shard_workers)
+            elapsed = time.perf_counter() - start
+            if measure_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                continue
+
+            latencies.append(elapsed * 1000)
+            totals["firestore"] += sum(
+                count for kind, count in db.rpcs.items()
+                if kind not in ("document_reads", "document_writes")
+            )
+            totals["fcm"] += sum(
+                count for kind, count in fcm.rpcs.items() if kind != "fcm_messages"
+            )
+            totals["messages"] += fcm.rpcs["fcm_messages"]
+            totals["reads"] += db.rpcs["document_reads"]
+            totals["writes"] += db.rpcs["document_writes"]
+
+    runs = max(1, args.iterations)
+    return ScenarioResult(
+        subscribers=scenario.subscribers,
+        preference_sets=scenario.preference_sets,
+        changed_fields=scenario.changed_fields,
+        p50_ms=_percentile(latencies, 50),
+        p99_ms=_percentile(latencies, 99),
+        firestore_rpcs=totals["firestore"] / runs,
+        fcm_rpcs=totals["fcm"] / runs,
+        fcm_messages=totals["messages"] / runs,
+        document_reads=totals["reads"] / runs,
+        document_writes=totals["writes"] / runs,
+        peak_mib=peak / (1024 * 1024),
+    )
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=_int_list, default=[100, 1000, 5000])
+    parser.add_argument("--preference-sets", type=_int_list, default=[20])
+    parser.add_argument("--changed-fields", type=_int_list, default=[1, 5, 20])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--firestore-latency-ms", type=float, default=0.0)
+    parser.add_argument("--fcm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--firestore-error-rate", type=float, default=0.0)
+    parser.add_argument("--fcm-error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--delivery-mode",
+        choices=[mode.value for mode in sendPushNotification.DeliveryMode],
+        default=sendPushNotification.DEFAULT_DELIVERY_MODE.value,
+    )
+    parser.add_argument(
+        "--no-subscription-cache", action="store_true",
+        help="Query subscriptions on every update instead of serving them from the warm cache",
+    )
+    parser.add_argument(
+        "--shard-workers", type=int, default=8,
+        help="Shard tasks run concurrently when a fan-out is sharded",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per scenario")
+    args = parser.parse_args()
+
+    header = (
+        f"{'subs':>7} {'prefs':>6} {'fields':>6} {'p50 ms':>9} {'p99 ms':>9} "
+        f"{'fs rpc':>7} {'fcm rpc':>8} {'fcm msg':>8} {'reads':>8} {'writes':>8} {'peak MiB':>9}"
+    )
+    if not args.json:
+        print(header)
+    for subscribers in args.subscribers:
+        for preference_sets in args.preference_sets:
+            for changed_fields in args.changed_fields:
+                result = run_scenario(
+                    Scenario(subscribers, preference_sets, changed_fields), args
+                )
+                if args.json:
+                    print(json.dumps(asdict(result)))
+                    continue
+                print(
+                    f"{result.subscribers:>7} {result.preference_sets:>6} "
+                    f"{result.changed_fields:>6} {result.p50_ms:>9.2f} {result.p99_ms:>9.2f} "
+                    f"{result.firestore_rpcs:>7.1f} {result.fcm_rpcs:>8.1f} {result.fcm_messages:>8.1f} "
+                    f"{result.document_reads:>8.0f} {result.document_writes:>8.0f} "
+                    f"{result.peak_mib:>9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Micro-benchmarks for PropertyNotification / Change encoding and decoding.
+
+Compares the current slotted models with the previous ``asdict`` based
+implementation, which is kept below as a baseline.
+
+Run from the ``functions`` directory:
+    python -m benchmarks.bench_models --notifications 5000
+"""
+import argparse
+import timeit
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, List, Optional
+
+from models.property_notification import Change, ChangeType, PropertyNotification
+
+
+@dataclass
+class LegacyChange:
+    type: ChangeType
+    old_value: Optional[Any] = None
+    new_value: Optional[Any] = None
+
+    def to_firestore(self) -> Dict[str, Any]:
+        result = {'type': self.type.value}
+        if self.old_value is not None:
+            result['old_value'] = self.old_value
+        if self.new_value is not None:
+            result['new_value'] = self.new_value
+        return result
+
+
+@dataclass
+class LegacyPropertyNotification:
+    propertyId: str
+    createdAt: int
+    changes: Dict[str, LegacyChange]
+    userId: Optional[str] = None
+    isRead: bool = False
+    readAt: Optional[int] = None
+
+    def __post_init__(self):
+        invalid_keys = [
+            key for key in self.changes.keys() if key not in PropertyNotification._valid_fields
+        ]
+        if invalid_keys:
+            raise ValueError(f"Invalid field(s) in changes: {', '.join(invalid_keys)}")
+        self.changes = dict(self.changes)
+
+    def to_firestore(self) -> Dict[str, Any]:
+        base_dict = asdict(self, dict_factory=lambda x: {k: v for k, v in x if v is not None})
+        base_dict['changes'] = {key: value.to_firestore() for key, value in self.changes.items()}
+        return base_dict
+
+    @classmethod
+    def from_firestore(cls, data: Dict[str, Any]) -> 'LegacyPropertyNotification':
+        return cls(
+            propertyId=data['propertyId'],
+            createdAt=PropertyNotification._parse_timestamp(data['createdAt']),
+            changes={
+                key: LegacyChange(ChangeType(value['type']), value.get('old_value'), value.get('new_value'))
+                for key, value in data['changes'].items()
+            },
+            userId=data.get('userId'),
+            isRead=data.get('isRead', False),
+            readAt=PropertyNotification._parse_timestamp(data['readAt']) if data.get('readAt') is not None else None,
+        )
+
+
+FIELDS = ["book", "page", "remark1", "remark2", "parcelId", "instrumentId"]
+
+
+def _encode_legacy(count: int) -> List[Dict[str, Any]]:
+    changes = {field: LegacyChange(ChangeType.UPDATED, "old", "new") for field in FIELDS}
+    return [
+        LegacyPropertyNotification("property1", 0, changes, userId=f"user{i}").to_firestore()
+        for i in range(count)
+    ]
+
+
+def _encode_current(count: int) -> List[Dict[str, Any]]:
+    changes = {field: Change(ChangeType.UPDATED, "old", "new") for field in FIELDS}
+    return [
+        PropertyNotification("property1", 0, changes, userId=f"user{i}").to_firestore()
+        for i in range(count)
+    ]
+
+
+def _encode_current_shared(count: int) -> List[Dict[str, Any]]:
+    """What fan-out does: encode once, then only swap userId."""
+    changes = {field: Change(ChangeType.UPDATED, "old", "new") for field in FIELDS}
+    encoded = PropertyNotification("property1", 0, changes).to_firestore()
+    return [dict(encoded, userId=f"user{i}") for i in range(count)]
+
+
+def _documents(count: int) -> List[Dict[str, Any]]:
+    return _encode_current_shared(count)
+
+
+def _measure(label: str, func: Callable[[], Any], repeat: int) -> None:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<32} {best * 1000:>10.2f} ms {peak / 1024:>12.1f} KiB peak")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notifications", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    count = args.notifications
+
+    print(f"{count} notifications, {len(FIELDS)} changed fields each")
+    print("encode")
+    _measure("  legacy asdict", lambda: _encode_legacy(count), args.repeat)
+    _measure("  slotted to_firestore", lambda: _encode_current(count), args.repeat)
+    _measure("  slotted, encoded once", lambda: _encode_current_shared(count), args.repeat)
+
+    documents = _documents(count)
+    print("decode")
+    _measure(
+        "  legacy from_firestore",
+        lambda: [LegacyPropertyNotification.from_firestore(d) for d in documents],
+        args.repeat,
+    )
+    _measure(
+        "  slotted from_firestore",
+        lambda: [PropertyNotification.from_firestore(d) for d in documents],
+        args.repeat,
+    )
+    _measure(
+        "  slotted from_firestore_many",
+        lambda: PropertyNotification.from_firestore_many(documents),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
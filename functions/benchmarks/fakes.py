@@ -0,0 +1,762 @@
+"""In-process stand-ins for the Firestore client, the FCM messaging module and task queues.
+
+They implement the subset of the google-cloud-firestore and firebase_admin
+messaging APIs the functions use, record an RPC counter for every call that
+would hit the network, and can inject latency and transient errors. Nothing
+here talks to a real backend, so benchmarks run offline.
+"""
+import copy
+import itertools
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from unittest import mock
+
+from firebase_admin import exceptions, firestore, functions, messaging
+from google.api_core import exceptions as api_exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+
+class _Backend:
+    """Latency, error injection and RPC accounting shared by a fake client."""
+
+    def __init__(self, latency: float, error_rate: float, seed: Optional[int]):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.rpcs: Counter = Counter()
+
+    def rpc(self, kind: str, error_factory=None) -> None:
+        with self._lock:
+            self.rpcs[kind] += 1
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise (error_factory or _unavailable)(f"Injected {kind} failure")
+
+    def count(self, kind: str, amount: int = 1) -> None:
+        with self._lock:
+            self.rpcs[kind] += amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self.rpcs.clear()
+
+
+def _unavailable(message: str) -> Exception:
+    return api_exceptions.ServiceUnavailable(message)
+
+
+# ---------------------------------------------------------------------------
+# Firestore
+# ---------------------------------------------------------------------------
+
+
+class FakeFirestore:
+    """A thread-safe in-memory Firestore client.
+
+    Args:
+        latency: Seconds slept on every RPC.
+        error_rate: Probability in [0, 1] that an RPC raises ServiceUnavailable.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self._backend = _Backend(latency, error_rate, seed)
+        self._lock = threading.RLock()
+        self._documents: Dict[str, Dict[str, Any]] = {}
+        # Opaque per-document update times, compared by last_update_time preconditions.
+        self._update_times: Dict[str, int] = {}
+        self._clock = itertools.count(1)
+
+    @property
+    def rpcs(self) -> Counter:
+        return self._backend.rpcs
+
+    def reset_stats(self) -> None:
+        self._backend.reset()
+
+    def collection(self, *path: str) -> "FakeCollection":
+        return FakeCollection(self, "/".join(path))
+
+    def document(self, *path: str) -> "FakeDocumentReference":
+        return FakeDocumentReference(self, "/".join(path))
+
+    def batch(self) -> "FakeWriteBatch":
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs) -> "FakeTransaction":
+        return FakeTransaction(self)
+
+    @staticmethod
+    def write_option(**kwargs) -> "FakeWriteOption":
+        if len(kwargs) != 1 or next(iter(kwargs)) not in ("last_update_time", "exists"):
+            raise TypeError("Pass exactly one of last_update_time or exists")
+        return FakeWriteOption(**kwargs)
+
+    def get_all(self, references: Iterable["FakeDocumentReference"], field_paths=None, transaction=None):
+        references = list(references)
+        self._backend.rpc("get_all")
+        self._backend.count("document_reads", len(references))
+        return [self._snapshot(ref.path) for ref in references]
+
+    def seed(self, collection: str, documents: Dict[str, Dict[str, Any]]) -> None:
+        """Load documents without counting RPCs."""
+        with self._lock:
+            for doc_id, data in documents.items():
+                self._documents[f"{collection}/{doc_id}"] = copy.deepcopy(data)
+                self._update_times[f"{collection}/{doc_id}"] = next(self._clock)
+
+    def dump(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        """Return a copy of every document in a collection, without counting RPCs."""
+        prefix = f"{collection}/"
+        with self._lock:
+            return {
+                path[len(prefix):]: copy.deepcopy(data)
+                for path, data in self._documents.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            }
+
+    def clear(self, collection: str) -> None:
+        prefix = f"{collection}/"
+        with self._lock:
+            for path in [path for path in self._documents if path.startswith(prefix)]:
+                del self._documents[path]
+                self._update_times.pop(path, None)
+
+    # Internal helpers used by references, queries and batches.
+
+    def _snapshot(self, path: str) -> "FakeDocumentSnapshot":
+        with self._lock:
+            data = self._documents.get(path)
+            return FakeDocumentSnapshot(
+                FakeDocumentReference(self, path),
+                copy.deepcopy(data) if data is not None else None,
+                self._update_times.get(path),
+            )
+
+    def _apply(self, writes: List[Tuple[str, str, Any, Dict[str, Any]]]) -> None:
+        with self._lock:
+            # Check every precondition first, a commit applies all of its writes or none.
+            exists = {}
+            for op, path, data, options in writes:
+                present = exists.get(path, path in self._documents)
+                if op == "create" and present:
+                    raise api_exceptions.AlreadyExists(f"Document {path} already exists")
+                if op == "update" and not present:
+                    raise api_exceptions.NotFound(f"No document to update: {path}")
+                option = options.get("option")
+                if option is not None and not option.holds(present, self._update_times.get(path)):
+                    raise api_exceptions.FailedPrecondition(f"Precondition failed for {path}")
+                exists[path] = op != "delete"
+            update_time = next(self._clock)
+            for op, path, data, options in writes:
+                existing = self._documents.get(path)
+                if op == "delete":
+                    self._documents.pop(path, None)
+                    self._update_times.pop(path, None)
+                    continue
+                self._update_times[path] = update_time
+                if op in ("create", "set") and not options.get("merge"):
+                    existing = {}
+                self._documents[path] = _apply_fields(
+                    copy.deepcopy(existing or {}), data, dotted=(op == "update")
+                )
+
+
+def _apply_fields(document: Dict[str, Any], data: Dict[str, Any], dotted: bool) -> Dict[str, Any]:
+    for key, value in data.items():
+        parts = key.split(".") if dotted else [key]
+        target = document
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        field = parts[-1]
+        if isinstance(value, dict) and not dotted and isinstance(target.get(field), dict):
+            target[field] = _apply_fields(target[field], value, dotted=False)
+            continue
+        target[field] = _resolve_transform(target.get(field), value)
+        if target[field] is _DELETE:
+            del target[field]
+    return document
+
+
+_DELETE = object()
+
+
+def _resolve_transform(current: Any, value: Any) -> Any:
+    if value is transforms.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if value is transforms.DELETE_FIELD:
+        return _DELETE
+    if isinstance(value, transforms.Increment):
+        return (current or 0) + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current or [])
+        result.extend(item for item in value.values if item not in result)
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        return [item for item in (current or []) if item not in value.values]
+    if isinstance(value, dict):
+        return {key: _resolve_transform(None, item) for key, item in value.items()}
+    return copy.deepcopy(value)
+
+
+class FakeWriteOption:
+    """Precondition returned by ``FakeFirestore.write_option``."""
+
+    def __init__(self, last_update_time: Any = None, exists: Optional[bool] = None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+    def holds(self, present: bool, update_time: Any) -> bool:
+        if self.exists is not None:
+            return present == self.exists
+        return present and update_time == self.last_update_time
+
+
+class FakeDocumentSnapshot:
+    def __init__(
+        self,
+        reference: "FakeDocumentReference",
+        data: Optional[Dict[str, Any]],
+        update_time: Any = None,
+    ):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        value: Any = self._data
+        for part in field_path.split("."):
+            if not isinstance(value, dict) or part not in value:
+                raise KeyError(field_path)
+            value = value[part]
+        return value
+
+
+class FakeDocumentReference:
+    def __init__(self, client: FakeFirestore, path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    @property
+    def parent(self) -> "FakeCollection":
+        return FakeCollection(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None) -> FakeDocumentSnapshot:
+        self._client._backend.rpc("get")
+        self._client._backend.count("document_reads")
+        return self._client._snapshot(self.path)
+
+    def create(self, document_data: Dict[str, Any]) -> None:
+        self._write("create", document_data)
+
+    def set(self, document_data: Dict[str, Any], merge: bool = False) -> None:
+        self._write("set", document_data, merge=merge)
+
+    def update(self, field_updates: Dict[str, Any], option: Optional[FakeWriteOption] = None) -> None:
+        self._write("update", field_updates, option=option)
+
+    def delete(self, option: Optional[FakeWriteOption] = None) -> None:
+        self._write("delete", {}, option=option)
+
+    def _write(self, op: str, data: Dict[str, Any], **options) -> None:
+        self._client._backend.rpc("commit")
+        self._client._backend.count("document_writes")
+        self._client._apply([(op, self.path, data, options)])
+
+
+_OPERATORS = {
+    "==": lambda value, target: value == target,
+    "!=": lambda value, target: value != target,
+    "<": lambda value, target: value is not None and value < target,
+    "<=": lambda value, target: value is not None and value <= target,
+    ">": lambda value, target: value is not None and value > target,
+    ">=": lambda value, target: value is not None and value >= target,
+    "in": lambda value, target: value in target,
+    "not-in": lambda value, target: value not in target,
+    "array_contains": lambda value, target: isinstance(value, list) and target in value,
+    "array_contains_any": lambda value, target: isinstance(value, list)
+    and any(item in value for item in target),
+}
+
+
+def _field_value(data: Dict[str, Any], doc_id: str, field_path: str) -> Any:
+    if field_path == "__name__":
+        return doc_id
+    value: Any = data
+    for part in field_path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+class FakeQuery:
+    def __init__(self, client: FakeFirestore, collection_path: str, filters=(), projection=None,
+                 orders=(), limit_count=None, cursor=None, end_cursor=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = tuple(filters)
+        self._projection = projection
+        self._orders = tuple(orders)
+        self._limit = limit_count
+        self._cursor = cursor
+        self._end_cursor = end_cursor
+
+    def _copy(self, **changes) -> "FakeQuery":
+        state = dict(
+            filters=self._filters, projection=self._projection, orders=self._orders,
+            limit_count=self._limit, cursor=self._cursor, end_cursor=self._end_cursor,
+        )
+        state.update(changes)
+        return FakeQuery(self._client, self._collection_path, **state)
+
+    def where(self, field_path: Optional[str] = None, op_string: Optional[str] = None,
+              value: Any = None, *, filter: Optional[FieldFilter] = None) -> "FakeQuery":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f"Unsupported operator {op_string}")
+        if op_string in ("in", "not-in", "array_contains_any") and len(value) > 30:
+            raise ValueError(f"'{op_string}' supports at most 30 values")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def select(self, field_paths: Iterable[str]) -> "FakeQuery":
+        return self._copy(projection=list(field_paths))
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(orders=self._orders + ((str(field_path), direction),))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit_count=count)
+
+    def start_after(self, document_fields) -> "FakeQuery":
+        return self._copy(cursor=document_fields)
+
+    def end_at(self, document_fields) -> "FakeQuery":
+        return self._copy(end_cursor=document_fields)
+
+    def count(self, alias: Optional[str] = None) -> "FakeAggregation":
+        return FakeAggregation(self, "count", None, alias or "count")
+
+    def sum(self, field_ref: str, alias: Optional[str] = None) -> "FakeAggregation":
+        return FakeAggregation(self, "sum", field_ref, alias or "sum")
+
+    def _matching(self) -> List[Tuple[str, Dict[str, Any]]]:
+        prefix = f"{self._collection_path}/"
+        # Filter before copying, a query usually matches a small part of the collection.
+        with self._client._lock:
+            rows = [
+                (path[len(prefix):], data)
+                for path, data in self._client._documents.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+                and all(_OPERATORS[op](_field_value(data, path[len(prefix):], field), value)
+                        for field, op, value in self._filters)
+            ]
+        orders = self._orders or (("__name__", "ASCENDING"),)
+        for field, direction in reversed(orders):
+            rows.sort(key=lambda row: _sort_key(_field_value(row[1], row[0], field)),
+                      reverse=direction == "DESCENDING")
+        if self._cursor is not None:
+            cursor = self._cursor_values(self._cursor, orders)
+            rows = [row for row in rows if _compare(row, cursor, orders) > 0]
+        if self._end_cursor is not None:
+            cursor = self._cursor_values(self._end_cursor, orders)
+            rows = [row for row in rows if _compare(row, cursor, orders) <= 0]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return [(doc_id, copy.deepcopy(data)) for doc_id, data in rows]
+
+    @staticmethod
+    def _cursor_values(cursor, orders) -> List[Any]:
+        if isinstance(cursor, FakeDocumentSnapshot):
+            return [_field_value(cursor._data or {}, cursor.id, field) for field, _ in orders]
+        values = []
+        for field, _ in orders:
+            value = cursor.get(field)
+            values.append(value.id if isinstance(value, FakeDocumentReference) else value)
+        return values
+
+    def stream(self, transaction=None):
+        rows = self._matching()
+        self._client._backend.rpc("query")
+        self._client._backend.count("document_reads", max(1, len(rows)))
+        for doc_id, data in rows:
+            if self._projection is not None:
+                data = {field: data[field] for field in self._projection if field in data}
+            yield FakeDocumentSnapshot(
+                FakeDocumentReference(self._client, f"{self._collection_path}/{doc_id}"), data
+            )
+
+    def get(self, transaction=None) -> List[FakeDocumentSnapshot]:
+        return list(self.stream(transaction=transaction))
+
+
+def _compare(row: Tuple[str, Dict[str, Any]], cursor: List[Any], orders) -> int:
+    doc_id, data = row
+    for (field, direction), cursor_value in zip(orders, cursor):
+        left = _sort_key(_field_value(data, doc_id, field))
+        right = _sort_key(cursor_value)
+        if left != right:
+            result = -1 if left < right else 1
+            return -result if direction == "DESCENDING" else result
+    return 0
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    return (3, str(value))
+
+
+class FakeAggregation:
+    def __init__(self, query: FakeQuery, kind: str, field: Optional[str], alias: str):
+        self._query = query
+        self._kind = kind
+        self._field = field
+        self._alias = alias
+
+    def get(self, transaction=None):
+        rows = self._query._matching()
+        self._query._client._backend.rpc("aggregation")
+        self._query._client._backend.count("document_reads", max(1, len(rows) // 1000))
+        if self._kind == "count":
+            value = len(rows)
+        else:
+            value = sum(_field_value(data, doc_id, self._field) or 0 for doc_id, data in rows)
+        return [[_AggregationResult(self._alias, value)]]
+
+
+class _AggregationResult:
+    def __init__(self, alias: str, value: Any):
+        self.alias = alias
+        self.value = value
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client: FakeFirestore, path: str):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        document_id = document_id or uuid.uuid4().hex[:20]
+        return FakeDocumentReference(self._client, f"{self._collection_path}/{document_id}")
+
+    def add(self, document_data: Dict[str, Any], document_id: Optional[str] = None):
+        reference = self.document(document_id)
+        reference.create(document_data)
+        return None, reference
+
+    def list_documents(self) -> List[FakeDocumentReference]:
+        self._client._backend.rpc("list_documents")
+        return [FakeDocumentReference(self._client, f"{self._collection_path}/{doc_id}")
+                for doc_id in self._client.dump(self._collection_path)]
+
+
+class FakeWriteBatch:
+    # Matches the server side limit on writes per commit.
+    MAX_WRITES = 500
+
+    def __init__(self, client: FakeFirestore):
+        self._client = client
+        self._writes: List[Tuple[str, str, Any, Dict[str, Any]]] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def create(self, reference: FakeDocumentReference, document_data: Dict[str, Any]):
+        self._writes.append(("create", reference.path, document_data, {}))
+        return self
+
+    def set(self, reference: FakeDocumentReference, document_data: Dict[str, Any], merge: bool = False):
+        self._writes.append(("set", reference.path, document_data, {"merge": merge}))
+        return self
+
+    def update(self, reference: FakeDocumentReference, field_updates: Dict[str, Any],
+               option: Optional[FakeWriteOption] = None):
+        self._writes.append(("update", reference.path, field_updates, {"option": option}))
+        return self
+
+    def delete(self, reference: FakeDocumentReference, option: Optional[FakeWriteOption] = None):
+        self._writes.append(("delete", reference.path, {}, {"option": option}))
+        return self
+
+    def commit(self):
+        if len(self._writes) > self.MAX_WRITES:
+            raise api_exceptions.InvalidArgument(
+                f"A write batch can contain at most {self.MAX_WRITES} writes"
+            )
+        self._client._backend.rpc("commit")
+        self._client._backend.count("document_writes", len(self._writes))
+        self._client._apply(self._writes)
+        return []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Buffers writes until commit, compatible with ``firestore.transactional``.
+
+    Reads go straight to the store, there is no contention or retry.
+    """
+
+    def __init__(self, client: FakeFirestore):
+        super().__init__(client)
+        self._max_attempts = 1
+        self._read_only = False
+        self._id = None
+
+    def get(self, reference: FakeDocumentReference) -> FakeDocumentSnapshot:
+        return reference.get(transaction=self)
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None) -> None:
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self) -> None:
+        self._clean_up()
+
+    def _commit(self):
+        if self._writes:
+            self.commit()
+        self._clean_up()
+        return []
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+
+# ---------------------------------------------------------------------------
+# FCM
+# ---------------------------------------------------------------------------
+
+
+class FakeMessaging:
+    """Stand-in for the ``firebase_admin.messaging`` send and topic functions.
+
+    ``error_rate`` applies per message for sends and per token for topic
+    management, mirroring how FCM reports partial failures.
+    """
+
+    # FCM limits for one send_each call and one topic management call.
+    MAX_MESSAGES = 500
+    MAX_TOKENS = 1000
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self._backend = _Backend(latency, 0.0, seed)
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.sent: List[messaging.Message] = []
+        self.topics: Dict[str, set] = {}
+        # Tokens FCM reports as unregistered, like an uninstalled app.
+        self.dead_tokens: set = set()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def rpcs(self) -> Counter:
+        return self._backend.rpcs
+
+    def reset_stats(self) -> None:
+        self._backend.reset()
+        with self._lock:
+            self.sent = []
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._error_rate > 0 and self._random.random() < self._error_rate
+
+    def send(self, message: messaging.Message, dry_run: bool = False, app=None) -> str:
+        self._backend.rpc("fcm_send")
+        if self._fails():
+            raise exceptions.UnavailableError("Injected FCM send failure")
+        with self._lock:
+            self.sent.append(message)
+            return f"projects/fake/messages/{next(self._message_ids)}"
+
+    def send_each(self, messages: List[messaging.Message], dry_run: bool = False, app=None):
+        if len(messages) > self.MAX_MESSAGES:
+            raise ValueError("messages must not contain more than 500 elements.")
+        self._backend.rpc("fcm_send_each")
+        self._backend.count("fcm_messages", len(messages))
+        responses = []
+        for message in messages:
+            if message.token is not None and message.token in self.dead_tokens:
+                responses.append(messaging.SendResponse(
+                    None, messaging.UnregisteredError("Requested entity was not found.")
+                ))
+                continue
+            if self._fails():
+                responses.append(messaging.SendResponse(
+                    None, exceptions.UnavailableError("Injected FCM send failure")
+                ))
+                continue
+            with self._lock:
+                # A dry run validates the message without delivering it.
+                if not dry_run:
+                    self.sent.append(message)
+                message_id = f"projects/fake/messages/{next(self._message_ids)}"
+            responses.append(messaging.SendResponse({"name": message_id}, None))
+        return messaging.BatchResponse(responses)
+
+    def subscribe_to_topic(self, tokens, topic: str, app=None):
+        return self._manage_topic(tokens, topic, subscribe=True)
+
+    def unsubscribe_from_topic(self, tokens, topic: str, app=None):
+        return self._manage_topic(tokens, topic, subscribe=False)
+
+    def _manage_topic(self, tokens, topic: str, subscribe: bool):
+        tokens = [tokens] if isinstance(tokens, str) else list(tokens)
+        if not tokens or len(tokens) > self.MAX_TOKENS:
+            raise ValueError("Tokens must be a non-empty list of at most 1000 tokens.")
+        self._backend.rpc("fcm_topic_management")
+        results = []
+        with self._lock:
+            members = self.topics.setdefault(topic, set())
+        for token in tokens:
+            if token in self.dead_tokens:
+                results.append({"error": "NOT_FOUND"})
+                continue
+            if self._fails():
+                results.append({"error": "INTERNAL"})
+                continue
+            with self._lock:
+                (members.add if subscribe else members.discard)(token)
+            results.append({})
+        return messaging.TopicManagementResponse({"results": results})
+
+
+# ---------------------------------------------------------------------------
+# Task queues
+# ---------------------------------------------------------------------------
+
+
+class FakeTaskQueues:
+    """In-process stand-in for ``firebase_admin.functions.task_queue``.
+
+    Enqueued tasks are kept in memory until ``drain()`` hands them to the
+    registered handlers, the raw task functions (``fn.__wrapped__``). Explicit
+    task IDs are de-duplicated like Cloud Tasks does, and a task whose handler
+    raises is retried up to ``max_attempts`` times.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self._backend = _Backend(latency, error_rate, seed)
+        self._lock = threading.Lock()
+        self._task_ids = itertools.count(1)
+        self._seen_ids: set = set()
+        self.pending: List[Tuple[str, str, Any]] = []
+        self.failed: List[Tuple[str, Any, Exception]] = []
+
+    @property
+    def rpcs(self) -> Counter:
+        return self._backend.rpcs
+
+    def reset_stats(self) -> None:
+        self._backend.reset()
+
+    def task_queue(
+        self, function_name: str, extension_id: Optional[str] = None, app=None
+    ) -> "FakeTaskQueue":
+        return FakeTaskQueue(self, function_name)
+
+    def _enqueue(self, function_name: str, task_data: Any, opts) -> str:
+        self._backend.rpc("task_enqueue")
+        task_id = getattr(opts, "task_id", None)
+        with self._lock:
+            if task_id is not None:
+                if task_id in self._seen_ids:
+                    raise exceptions.AlreadyExistsError(f"Task {task_id} already exists", None)
+                self._seen_ids.add(task_id)
+            else:
+                task_id = f"task-{next(self._task_ids)}"
+            self.pending.append((function_name, task_id, copy.deepcopy(task_data)))
+        return task_id
+
+    def drain(self, handlers: Dict[str, Any], max_workers: int = 1, max_attempts: int = 3) -> int:
+        """Run pending tasks, including ones enqueued meanwhile, until none are left.
+
+        Returns the number of tasks that succeeded.
+        """
+        succeeded = 0
+        attempts: Counter = Counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                with self._lock:
+                    batch, self.pending = self.pending, []
+                if not batch:
+                    return succeeded
+                futures = [
+                    (task, executor.submit(handlers[task[0]], SimpleNamespace(data=task[2])))
+                    for task in batch
+                ]
+                for task, future in futures:
+                    try:
+                        future.result()
+                        succeeded += 1
+                    except Exception as e:
+                        attempts[task[1]] += 1
+                        with self._lock:
+                            if attempts[task[1]] < max_attempts:
+                                self.pending.append(task)
+                            else:
+                                self.failed.append((task[0], task[2], e))
+
+
+class FakeTaskQueue:
+    def __init__(self, queues: FakeTaskQueues, function_name: str):
+        self._queues = queues
+        self._function_name = function_name
+
+    def enqueue(self, task_data: Any, opts=None) -> str:
+        return self._queues._enqueue(self._function_name, task_data, opts)
+
+
+@contextmanager
+def patched_clients(db: FakeFirestore, fcm: FakeMessaging, tasks: Optional[FakeTaskQueues] = None):
+    """Route ``firestore.client()``, the messaging calls and task queues to the fakes."""
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(firestore, "client", lambda *args, **kwargs: db))
+        for name in ("send", "send_each", "subscribe_to_topic", "unsubscribe_from_topic"):
+            stack.enter_context(mock.patch.object(messaging, name, getattr(fcm, name)))
+        if tasks is not None:
+            stack.enter_context(mock.patch.object(functions, "task_queue", tasks.task_queue))
+        yield
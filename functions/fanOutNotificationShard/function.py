@@ -0,0 +1,59 @@
+from firebase_admin import firestore
+from firebase_functions import tasks_fn
+from firebase_functions.options import RetryConfig, RateLimits
+from instrumentation import InvocationMetrics
+from sendNotificationToTopic.helpers import shardedFanOut
+from sendNotificationToTopic.helpers.createInAppNotification import createInAppNotificationsForShard
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=10),
+    rate_limits=RateLimits(max_concurrent_dispatches=100),
+)
+def fanOutNotificationShard(req: tasks_fn.CallableRequest) -> None:
+    """
+    Purpose:
+    Creates the in-app notifications for one shard of a large fan-out.
+
+    Triggered by:
+    1. A task enqueued by sendNotificationToTopic or flushNotificationBuffer
+    when a property has more than SHARDED_FAN_OUT_THRESHOLD matching subscribers.
+    """
+    data = req.data or {}
+    job_id = data.get("jobId")
+    shard_index = data.get("shardIndex")
+    if not isinstance(job_id, str) or not job_id:
+        raise ValueError("jobId must be a non-empty string")
+    if not isinstance(shard_index, int) or isinstance(shard_index, bool):
+        raise ValueError("shardIndex must be an integer")
+    runFanOutShard(job_id, shard_index)
+
+
+def runFanOutShard(job_id: str, shard_index: int) -> int:
+    """Write one shard and report it on the job document.
+
+    Returns the number of notifications written. A failure raises so the
+    task queue retries the shard, its document IDs are deterministic.
+    """
+    metrics = InvocationMetrics("fanOutNotificationShard", jobId=job_id, shardIndex=shard_index)
+    db = firestore.client()
+    with metrics.stage("readJob"):
+        job = shardedFanOut.readJob(db, job_id)
+    metrics.count("firestoreRpcs")
+    if job is None or shardedFanOut.isShardComplete(job, shard_index):
+        metrics.label(skipped="missingJob" if job is None else "shardComplete")
+        metrics.emit()
+        return 0
+    metrics.label(propertyId=job.get("propertyId"))
+
+    try:
+        written = createInAppNotificationsForShard(db, job, shard_index, metrics)
+        with metrics.stage("reportCompletion"):
+            job_complete = shardedFanOut.recordShardComplete(db, job_id, shard_index, written)
+    except Exception as e:
+        metrics.label(error=str(e))
+        metrics.emit(severity="ERROR")
+        raise
+    metrics.label(jobComplete=job_complete)
+    metrics.emit()
+    return written
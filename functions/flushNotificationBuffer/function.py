@@ -0,0 +1,149 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn, tasks_fn
+from firebase_functions.options import RetryConfig, RateLimits
+from instrumentation import InvocationMetrics
+from sendNotificationToTopic.helpers import coalesceNotifications, idempotency
+from sendNotificationToTopic.helpers.dispatchNotifications import (
+    DISPATCH_STAGES,
+    deliveredPushTargets,
+    dispatchNotifications,
+)
+
+# A buffer older than its window plus this grace period lost its flush task.
+STALE_BUFFER_GRACE_SECONDS = 60
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=10),
+    rate_limits=RateLimits(max_concurrent_dispatches=50),
+)
+def flushNotificationBuffer(req: tasks_fn.CallableRequest) -> None:
+    """
+    Purpose:
+    Sends the coalesced notification for one property once its window closes.
+
+    A failed stage raises, so the task queue retries the flush. The window
+    stays buffered until every stage succeeded, and stages or push targets
+    that already finished are skipped on the retry.
+
+    Triggered by:
+    1. A task enqueued by sendNotificationToTopic when a new window opens.
+    """
+    property_id = (req.data or {}).get("propertyId")
+    if not isinstance(property_id, str) or not property_id:
+        raise ValueError("propertyId must be a non-empty string")
+    flushBuffer(property_id)
+
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes")
+def flushStaleNotificationBuffers(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Purpose:
+    Safety net that flushes buffers whose flush task was never enqueued, ran
+    or used up its retries. Buffers leased by a running flush are skipped.
+    """
+    db = firestore.client()
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    cutoff = now - (
+        coalesceNotifications.COALESCE_WINDOW_SECONDS + STALE_BUFFER_GRACE_SECONDS
+    ) * 1000
+    stale_buffers = (
+        db.collection(coalesceNotifications.BUFFER_COLLECTION)
+        .where("windowStart", "<=", cutoff)
+        .select(["propertyId", "flushing", "flushLeaseExpiresAt"])
+        .stream()
+    )
+    for buffer in stale_buffers:
+        if coalesceNotifications.isFlushLeaseActive(buffer.to_dict(), now):
+            # A flush task is running or retrying this window.
+            continue
+        try:
+            flushBuffer(buffer.id)
+        except Exception as e:
+            # The buffer stays, the next run tries again.
+            logging.error("Failed to flush stale buffer of %s: %s", buffer.id, e)
+
+
+def flushBuffer(property_id: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Claim a property's buffer and fan out its merged changes.
+
+    The window is the idempotency key: finished stages and delivered push
+    targets are recorded under it like for a trigger event, and the buffer
+    is only dropped after every stage succeeded. The claim leases the
+    window, a flush finding it leased by another one skips it. A failed
+    flush releases its lease for the retry.
+
+    Returns the per-stage results, or None if there was nothing to send.
+
+    Raises:
+        Exception: If a stage failed. The buffer is kept for the retry.
+    """
+    metrics = InvocationMetrics("flushNotificationBuffer", propertyId=property_id)
+    db = firestore.client()
+    try:
+        with metrics.stage("claimBuffer"):
+            claimed = coalesceNotifications.claimBuffer(db, property_id)
+    except coalesceNotifications.FlushLeaseHeld:
+        metrics.label(skipped="flushInProgress")
+        metrics.emit()
+        return None
+    if claimed is None:
+        metrics.label(skipped="emptyBuffer")
+        metrics.emit()
+        return None
+
+    payload, buffer = claimed
+    window_start = buffer.get("windowStart")
+    if not payload:
+        # The burst ended where it started, nothing to send.
+        with metrics.stage("finishFlush"):
+            coalesceNotifications.finishFlush(db, property_id, window_start)
+        metrics.label(skipped="emptyBuffer")
+        metrics.emit()
+        return None
+
+    metrics.count("changedFields", len(payload))
+    metrics.count("coalescedEvents", buffer.get("eventCount", 1))
+    # Same window, same IDs: a flush that runs twice skips the documents it already created.
+    notification_key = f"{property_id}_{window_start}"
+    try:
+        with metrics.stage("idempotencyCheck"):
+            progress = idempotency.eventProgress(db, notification_key)
+        results = dispatchNotifications(
+            payload,
+            property_id,
+            metrics,
+            stages=DISPATCH_STAGES - progress.stages,
+            notification_key=notification_key,
+            skip_push_targets=progress.sent_push_targets,
+        )
+        idempotency.markStagesComplete(
+            db,
+            notification_key,
+            {stage for stage, result in results.items() if result["success"]},
+            deliveredPushTargets(results),
+        )
+        failed = {
+            stage: result["error"] for stage, result in results.items() if not result["success"]
+        }
+        metrics.label(failedStages=failed, resumedStages=sorted(progress.stages))
+        if failed:
+            raise Exception(f"Notification stages failed for property {property_id}: {failed}")
+    except Exception:
+        metrics.emit(severity="ERROR")
+        # Let the task queue retry, the buffer still holds this window.
+        try:
+            coalesceNotifications.releaseFlush(db, property_id, buffer["flushLeaseId"])
+        except Exception as e:
+            # The lease expires on its own, the retry only has to wait for it.
+            logging.error("Failed to release flush lease of %s: %s", property_id, e)
+        raise
+
+    with metrics.stage("finishFlush"):
+        opened_window = coalesceNotifications.finishFlush(db, property_id, window_start)
+    metrics.label(openedWindow=opened_window)
+    metrics.emit()
+    return results
@@ -0,0 +1,271 @@
+from firebase_admin import auth, firestore
+import logging
+from datetime import datetime, timezone
+from firebase_functions import https_fn
+from flask import jsonify, Response
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from instrumentation import InvocationMetrics
+from subscription_web import CORS_RESPONSE_HEADERS, corsPreflightResponse
+from sendNotificationToTopic.helpers import unreadCounter
+from sendNotificationToTopic.helpers.batchWrite import FIRESTORE_BATCH_LIMIT, commitInBatches
+
+NOTIFICATIONS_COLLECTION = "property_notifications"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Fields returned by getInbox, userId is implied by the caller.
+INBOX_FIELDS = ["propertyId", "createdAt", "changes", "isRead", "readAt"]
+MAX_MARK_READ_IDS = 500
+
+
+class AuthenticationError(Exception):
+    """Missing or invalid Firebase ID token, answered with 401."""
+
+
+@https_fn.on_request()
+def getInbox(req: https_fn.Request) -> Response:
+    """Page through the caller's notifications, newest first.
+
+    Query: ?limit=20&unreadOnly=true&cursor=<nextCursor of the previous page>
+    Response: {"notifications": [{"id": ..., "propertyId": ..., ...}], "nextCursor": "..." | null}
+    """
+    return handleInboxRequest(req, "getInbox", readInboxPage, methods="GET, OPTIONS")
+
+
+@https_fn.on_request()
+def getUnreadCount(req: https_fn.Request) -> Response:
+    """Unread badge count from the sharded counter, ?recount=true rebuilds it first.
+
+    Response: {"unreadCount": 3}
+    """
+    return handleInboxRequest(req, "getUnreadCount", readUnreadCount, methods="GET, OPTIONS")
+
+
+@https_fn.on_request()
+def markNotificationsRead(req: https_fn.Request) -> Response:
+    """Mark notifications read with batched updates.
+
+    Body: {"notificationIds": ["id1", "id2"]} or {"all": true}
+    Response: {"success": true, "updated": 2}
+    """
+    return handleInboxRequest(req, "markNotificationsRead", markRead, methods="POST, OPTIONS")
+
+
+def handleInboxRequest(
+    req: https_fn.Request,
+    function_name: str,
+    handler: Callable[[Any, https_fn.Request, str, InvocationMetrics], Dict[str, Any]],
+    methods: str,
+) -> Response:
+    # Handle CORS preflight request
+    if req.method == "OPTIONS":
+        return corsPreflightResponse(methods, "Content-Type, Authorization")
+
+    response_headers = dict(CORS_RESPONSE_HEADERS)
+    metrics = InvocationMetrics(function_name)
+
+    try:
+        logging.debug("Request headers: %s", req.headers)
+        with metrics.stage("verifyIdToken"):
+            user_id = authenticatedUserId(req)
+        metrics.label(userId=user_id)
+        body = handler(firestore.client(), req, user_id, metrics)
+        return jsonify(body), 200, response_headers
+
+    except AuthenticationError as ae:
+        logging.warning("Unauthenticated request: %s", ae)
+        metrics.label(error=str(ae))
+        return jsonify({"error": "Unauthenticated"}), 401, response_headers
+    except ValueError as ve:
+        logging.error("Invalid request: %s", ve)
+        metrics.label(error=str(ve))
+        return jsonify({"error": str(ve)}), 400, response_headers
+    except Exception as e:
+        logging.error("Error in %s: %s", function_name, e)
+        metrics.label(error=str(e))
+        return jsonify({"error": "Failed to process inbox request"}), 500, response_headers
+    finally:
+        metrics.emit()
+
+
+def authenticatedUserId(req: https_fn.Request) -> str:
+    """Verify the `Authorization: Bearer <Firebase ID token>` header and return the uid."""
+    return authenticatedClaims(req)["uid"]
+
+
+def authenticatedClaims(req: https_fn.Request) -> Dict[str, Any]:
+    """Verify the `Authorization: Bearer <Firebase ID token>` header and return its claims."""
+    header = req.headers.get("Authorization", "")
+    scheme, _, token = header.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        raise AuthenticationError("Authorization header must be 'Bearer <ID token>'")
+    try:
+        return auth.verify_id_token(token.strip())
+    except (auth.InvalidIdTokenError, auth.UserDisabledError, ValueError) as e:
+        raise AuthenticationError(str(e)) from e
+
+
+def readInboxPage(
+    db, req: https_fn.Request, user_id: str, metrics: InvocationMetrics
+) -> Dict[str, Any]:
+    limit = parsePageSize(req.args.get("limit"))
+    unread_only = req.args.get("unreadOnly", "").lower() == "true"
+    cursor = parseCursor(req.args.get("cursor"))
+
+    query = db.collection(NOTIFICATIONS_COLLECTION).where("userId", "==", user_id)
+    if unread_only:
+        query = query.where("isRead", "==", False)
+    # __name__ breaks createdAt ties, so a page boundary never skips or repeats a document.
+    query = (
+        query.order_by("createdAt", direction=firestore.Query.DESCENDING)
+        .order_by("__name__", direction=firestore.Query.DESCENDING)
+        .select(INBOX_FIELDS)
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.start_after({"createdAt": cursor[0], "__name__": cursor[1]})
+
+    with metrics.stage("inboxQuery"):
+        metrics.count("firestoreRpcs")
+        snapshots = list(query.stream())
+    page = snapshots[:limit]
+    metrics.count("notificationsRead", len(page))
+    next_cursor = None
+    if len(snapshots) > limit:
+        last = page[-1]
+        next_cursor = f"{last.get('createdAt')}:{last.id}"
+    return {
+        "notifications": [{"id": snapshot.id, **snapshot.to_dict()} for snapshot in page],
+        "nextCursor": next_cursor,
+    }
+
+
+def readUnreadCount(
+    db, req: https_fn.Request, user_id: str, metrics: InvocationMetrics
+) -> Dict[str, Any]:
+    with metrics.stage("unreadCount"):
+        if req.args.get("recount", "").lower() == "true":
+            count = unreadCounter.recountUnread(db, user_id, metrics)
+        else:
+            count = unreadCounter.readUnreadCount(db, user_id, metrics)
+    return {"unreadCount": count}
+
+
+def markRead(
+    db, req: https_fn.Request, user_id: str, metrics: InvocationMetrics
+) -> Dict[str, Any]:
+    data = req.get_json(silent=True) or {}
+    if not data:
+        raise ValueError("Request body must be JSON")
+    read_at = int(datetime.now(timezone.utc).timestamp() * 1000)
+
+    if data.get("all") is True:
+        with metrics.stage("findUnread"):
+            refs = unreadNotificationRefs(db, user_id, metrics)
+        with metrics.stage("firestoreWrites"):
+            updated = commitInBatches(
+                db, [(ref, {"isRead": True, "readAt": read_at}) for ref in refs], metrics, merge=True
+            )
+        metrics.count("notificationsMarkedRead", updated)
+        with metrics.stage("unreadCounters"):
+            unreadCounter.recountUnread(db, user_id, metrics)
+        return {"success": True, "updated": updated}
+
+    notification_ids = parseNotificationIds(data.get("notificationIds"))
+    with metrics.stage("firestoreWrites"):
+        updated = markOwnedUnreadRead(db, user_id, notification_ids, read_at, metrics)
+    metrics.count("notificationsMarkedRead", updated)
+    if updated:
+        with metrics.stage("unreadCounters"):
+            commitInBatches(
+                db, unreadCounter.unreadCounterWrites(db, [user_id], -updated), metrics, merge=True
+            )
+    return {"success": True, "updated": updated}
+
+
+def markOwnedUnreadRead(
+    db, user_id: str, notification_ids: List[str], read_at: int, metrics: InvocationMetrics
+) -> int:
+    """Mark the caller's unread notifications among the given IDs as read, in one transaction.
+
+    The read and the updates share a transaction, so when two requests mark
+    the same notifications only one of them finds them unread and
+    decrements the counter.
+
+    Returns:
+        int: Number of notifications marked read.
+    """
+    collection = db.collection(NOTIFICATIONS_COLLECTION)
+    refs = [collection.document(notification_id) for notification_id in notification_ids]
+    metrics.count("firestoreRpcs", 2)
+    return _markOwnedUnreadRead(db.transaction(), db, refs, user_id, read_at)
+
+
+@firestore.transactional
+def _markOwnedUnreadRead(transaction, db, refs: List[Any], user_id: str, read_at: int) -> int:
+    owned_unread = []
+    for snapshot in db.get_all(refs, field_paths=["userId", "isRead"], transaction=transaction):
+        data = snapshot.to_dict() if snapshot.exists else None
+        if data and data.get("userId") == user_id and data.get("isRead") is not True:
+            owned_unread.append(snapshot.reference)
+    for ref in owned_unread:
+        transaction.update(ref, {"isRead": True, "readAt": read_at})
+    return len(owned_unread)
+
+
+def unreadNotificationRefs(db, user_id: str, metrics: InvocationMetrics) -> List[Any]:
+    """All of the caller's unread notifications, fetched by name only in pages."""
+    refs: List[Any] = []
+    cursor: Optional[str] = None
+    while True:
+        query = (
+            db.collection(NOTIFICATIONS_COLLECTION)
+            .where("userId", "==", user_id)
+            .where("isRead", "==", False)
+            .order_by("__name__")
+            .select(["__name__"])
+            .limit(FIRESTORE_BATCH_LIMIT)
+        )
+        if cursor is not None:
+            query = query.start_after({"__name__": cursor})
+        metrics.count("firestoreRpcs")
+        page = [snapshot.reference for snapshot in query.stream()]
+        refs.extend(page)
+        if len(page) < FIRESTORE_BATCH_LIMIT:
+            return refs
+        cursor = page[-1].id
+
+
+def parsePageSize(value: Optional[str]) -> int:
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+def parseCursor(value: Optional[str]) -> Optional[Tuple[int, str]]:
+    """Parse a "<createdAt>:<documentId>" cursor returned as nextCursor."""
+    if not value:
+        return None
+    created_at, _, document_id = value.partition(":")
+    if not created_at.lstrip("-").isdigit() or not document_id:
+        raise ValueError("cursor is invalid")
+    return int(created_at), document_id
+
+
+def parseNotificationIds(notification_ids: Any) -> List[str]:
+    if not isinstance(notification_ids, list) or not notification_ids or not all(
+        isinstance(notification_id, str) and notification_id and "/" not in notification_id
+        for notification_id in notification_ids
+    ):
+        raise ValueError(
+            "notificationIds must be a non-empty list of document IDs, or pass all: true"
+        )
+    if len(notification_ids) > MAX_MARK_READ_IDS:
+        raise ValueError(f"At most {MAX_MARK_READ_IDS} notificationIds per request")
+    # dict keeps first-seen order and drops duplicate IDs.
+    return list(dict.fromkeys(notification_ids))
@@ -0,0 +1,135 @@
+import logging
+import re
+import uuid
+from firebase_admin import firestore
+from firebase_functions import https_fn, options
+from flask import jsonify, Response
+from typing import Any, Dict, List, Optional
+from instrumentation import InvocationMetrics
+from inbox_web import AuthenticationError, authenticatedClaims
+from subscription_web import CORS_RESPONSE_HEADERS, corsPreflightResponse
+from sendNotificationToTopic.helpers import bulkIngest
+
+MAX_INGEST_RECORDS = 2000
+# Custom claim the upstream job's account must carry.
+BULK_INGEST_CLAIM = "bulkIngest"
+# Used in document IDs and as notification key prefix.
+INGEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,100}$")
+# Record fields are written with update(), where a dot would name a nested field.
+FIELD_NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+@https_fn.on_request(timeout_sec=540, memory=options.MemoryOption.GB_1)
+def bulkIngestProperties(req: https_fn.Request) -> Response:
+    """Update many properties in one request and fan out their changes together.
+
+    Body: {"ingestId": "optional-retry-key", "properties": [{"documentId": "property1", "book": "46"}]}
+
+    Each record replaces the top-level fields it names. Writes carry the
+    bulkIngestId marker, so sendNotificationToTopic skips them. Subscription
+    lookups, in-app writes and FCM sends are grouped across properties.
+
+    The changes to notify are committed with the property writes, and stay
+    pending until they went out. Retrying with the same ingestId resumes
+    them: properties an earlier attempt already applied come back as
+    resumed, and only what did not go out is sent. Pending fan-outs of an
+    ingest that is not retried are resumed by resumeBulkIngestFanOuts.
+    """
+    # Handle CORS preflight request
+    if req.method == "OPTIONS":
+        return corsPreflightResponse("POST, OPTIONS", "Content-Type, Authorization")
+
+    response_headers = dict(CORS_RESPONSE_HEADERS)
+    metrics = InvocationMetrics("bulkIngestProperties")
+
+    try:
+        logging.debug("Request headers: %s", req.headers)
+        with metrics.stage("verifyIdToken"):
+            claims = authenticatedClaims(req)
+        if claims.get(BULK_INGEST_CLAIM) is not True:
+            return jsonify({"error": "Forbidden"}), 403, response_headers
+
+        data = req.get_json(silent=True) or {}
+        if not data:
+            raise ValueError("Request body must be JSON")
+        ingest_id = parseIngestId(data.get("ingestId"))
+        records = parseIngestRecords(data.get("properties"))
+        metrics.label(ingestId=ingest_id)
+        metrics.count("records", len(records))
+
+        db = firestore.client()
+        # A generated ingestId is new, there is nothing to resume.
+        applied = bulkIngest.applyIngestRecords(
+            db, records, ingest_id, metrics, resume=data.get("ingestId") is not None
+        )
+        fan_outs = applied["fanOuts"]
+        metrics.count("changedProperties", len(fan_outs))
+        notifications = {}
+        if fan_outs:
+            notifications = bulkIngest.dispatchGroupedNotifications(db, fan_outs, metrics)
+
+        return jsonify({
+            "success": not applied["rejected"]
+            and not applied["failed"]
+            and not notifications.get("pending"),
+            "ingestId": ingest_id,
+            "received": len(records),
+            "written": applied["written"],
+            "created": applied["created"],
+            "unchanged": applied["unchanged"],
+            "resumed": applied["resumed"],
+            "rejected": applied["rejected"],
+            "failed": applied["failed"],
+            "changedProperties": sorted(fan_outs),
+            "notifications": notifications,
+        }), 200, response_headers
+
+    except AuthenticationError as ae:
+        logging.warning("Unauthenticated request: %s", ae)
+        metrics.label(error=str(ae))
+        return jsonify({"error": "Unauthenticated"}), 401, response_headers
+    except ValueError as ve:
+        logging.error("Invalid request: %s", ve)
+        metrics.label(error=str(ve))
+        return jsonify({"error": str(ve)}), 400, response_headers
+    except Exception as e:
+        logging.error("Error during bulk ingest: %s", e)
+        metrics.label(error=str(e))
+        return jsonify({"error": "Failed to ingest properties"}), 500, response_headers
+    finally:
+        metrics.emit()
+
+
+def parseIngestId(ingest_id: Any) -> str:
+    if ingest_id is None:
+        return uuid.uuid4().hex
+    if not isinstance(ingest_id, str) or not INGEST_ID_PATTERN.match(ingest_id):
+        raise ValueError("ingestId must be 1-100 letters, digits, '-' or '_'")
+    return ingest_id
+
+
+def parseIngestRecords(records: Any) -> List[Dict[str, Any]]:
+    """Validate property records, each needs a documentId, may appear once and names plain fields."""
+    if not isinstance(records, list) or not records:
+        raise ValueError("properties must be a non-empty list")
+    if len(records) > MAX_INGEST_RECORDS:
+        raise ValueError(f"At most {MAX_INGEST_RECORDS} properties per request")
+    seen: Dict[str, None] = {}
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError("each property must be an object")
+        property_id: Optional[str] = record.get("documentId")
+        if not isinstance(property_id, str) or not property_id or "/" in property_id:
+            raise ValueError("each property needs a documentId without '/'")
+        if property_id in seen:
+            raise ValueError(f"documentId {property_id} appears more than once")
+        if bulkIngest.BULK_INGEST_MARKER_FIELD in record:
+            raise ValueError(f"{bulkIngest.BULK_INGEST_MARKER_FIELD} is set by the ingest")
+        invalid = [
+            field for field in record
+            if not isinstance(field, str) or not FIELD_NAME_PATTERN.match(field)
+        ]
+        if invalid:
+            raise ValueError(f"Invalid field name(s) in {property_id}: {', '.join(map(str, invalid))}")
+        seen[property_id] = None
+    return records
@@ -0,0 +1,110 @@
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+# Fraction of invocations that also log per-item details (failed topics, ...).
+DEFAULT_DETAIL_SAMPLE_RATE = 0.01
+# Upper bound on per-item details kept for one invocation.
+MAX_DETAILS = 50
+
+
+class InvocationMetrics:
+    """Collect stage timings and counters for one function invocation.
+
+    Everything is aggregated in memory and written as a single JSON line by
+    ``emit()``, which Cloud Logging parses as a structured entry. Per-item
+    details are only kept for a sampled fraction of invocations. Safe to use
+    from several threads.
+
+    Example:
+        metrics = InvocationMetrics("sendNotificationToTopic", propertyId="p1")
+        with metrics.stage("diff"):
+            ...
+        metrics.count("fcmRpcs")
+        metrics.emit()
+    """
+
+    def __init__(
+        self, function_name: str, detail_sample_rate: float = DEFAULT_DETAIL_SAMPLE_RATE, **labels: Any
+    ):
+        self.function_name = function_name
+        self.labels: Dict[str, Any] = dict(labels)
+        self.sampled = random.random() < detail_sample_rate
+        self._stages_ms: Dict[str, float] = {}
+        self._counters: Dict[str, int] = {}
+        self._details: List[Dict[str, Any]] = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a block. Repeated or concurrent stages with the same name add up."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self._stages_ms[name] = self._stages_ms.get(name, 0.0) + elapsed_ms
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def label(self, **labels: Any) -> None:
+        with self._lock:
+            self.labels.update(labels)
+
+    def detail(self, kind: str, **fields: Any) -> None:
+        """Record a per-item detail, only for sampled invocations."""
+        if not self.sampled:
+            return
+        with self._lock:
+            if len(self._details) < MAX_DETAILS:
+                self._details.append({"kind": kind, **fields})
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            entry: Dict[str, Any] = {
+                "message": f"{self.function_name} invocation metrics",
+                "function": self.function_name,
+                "totalMs": round((time.perf_counter() - self._started) * 1000, 3),
+                "stagesMs": {name: round(ms, 3) for name, ms in self._stages_ms.items()},
+                "counters": dict(self._counters),
+                **self.labels,
+            }
+            if self._details:
+                entry["details"] = list(self._details)
+        return entry
+
+    def emit(self, severity: str = "INFO") -> None:
+        """Write the collected metrics as one structured log line."""
+        entry = self.to_dict()
+        entry["severity"] = severity
+        print(json.dumps(entry, default=str))
+
+
+class _NoopMetrics(InvocationMetrics):
+    """Used when a helper is called without metrics, records nothing."""
+
+    def __init__(self):
+        super().__init__("noop", detail_sample_rate=0.0)
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def count(self, name: str, amount: int = 1) -> None:
+        pass
+
+    def label(self, **labels: Any) -> None:
+        pass
+
+    def emit(self, severity: str = "INFO") -> None:
+        pass
+
+
+NOOP_METRICS: InvocationMetrics = _NoopMetrics()
@@ -0,0 +1,32 @@
+from firebase_admin import firestore
+from firebase_functions.firestore_fn import (
+    on_document_written,
+    Event,
+    Change,
+    DocumentSnapshot,
+)
+from typing import Optional
+from instrumentation import InvocationMetrics
+from sendNotificationToTopic.helpers.subscriptionCache import bumpSubscriptionVersions
+
+
+@on_document_written(document="subscriptions/{subscriptionId}")
+def invalidateSubscriptionCache(event: Event[Change[Optional[DocumentSnapshot]]]) -> None:
+    """
+    Purpose:
+    Bumps the subscription version of the affected properties, so warm
+    sendNotificationToTopic instances drop their cached subscribers.
+
+    Triggered by:
+    1. Creates, updates and deletes in "subscriptions" collection.
+    """
+    metrics = InvocationMetrics(
+        "invalidateSubscriptionCache", subscriptionId=event.params.get("subscriptionId")
+    )
+    before = event.data.before.to_dict() if event.data.before is not None else None
+    after = event.data.after.to_dict() if event.data.after is not None else None
+    with metrics.stage("bumpVersions"):
+        property_ids = bumpSubscriptionVersions(firestore.client(), before, after)
+    metrics.count("firestoreRpcs", len(property_ids))
+    metrics.label(propertyIds=property_ids)
+    metrics.emit()
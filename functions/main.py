@@ -4,7 +4,19 @@
 from firebase_admin import initialize_app
 
 from sendNotificationToTopic.function import sendNotificationToTopic
-from subscription_web import subscribeToTopic, unsubscribeFromTopic  
+from flushNotificationBuffer.function import flushNotificationBuffer, flushStaleNotificationBuffers
+from invalidateSubscriptionCache.function import invalidateSubscriptionCache
+from fanOutNotificationShard.function import fanOutNotificationShard
+from pruneDeadTokens.function import pruneDeadTokens
+from resumeBulkIngestFanOuts.function import resumeBulkIngestFanOuts
+from subscription_web import (
+    subscribeToTopic,
+    unsubscribeFromTopic,
+    bulkSubscribeToTopics,
+    bulkUnsubscribeFromTopics,
+)
+from inbox_web import getInbox, getUnreadCount, markNotificationsRead
+from ingest_web import bulkIngestProperties
 initialize_app()
 
 
@@ -1,7 +1,8 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field
 from datetime import datetime
 from google.cloud import firestore
-from typing import Optional, Dict, Any, Union
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Union, Iterable, List, Mapping, Tuple
 from enum import Enum
 
 class ChangeType(Enum):
@@ -9,7 +10,10 @@ class ChangeType(Enum):
     ADDED = "added"
     REMOVED = "removed"
 
-@dataclass
+# Plain dict lookup, much cheaper than ChangeType(value) in bulk decoding.
+_CHANGE_TYPES_BY_VALUE = {change_type.value: change_type for change_type in ChangeType}
+
+@dataclass(frozen=True, slots=True)
 class Change:
     type: ChangeType
     old_value: Optional[Any] = None
@@ -26,15 +30,19 @@ class Change:
     @classmethod
     def from_firestore(cls, data: Dict[str, Any]) -> 'Change':
         return cls(
-            type=ChangeType(data['type']),
+            type=_CHANGE_TYPES_BY_VALUE[data['type']],
             old_value=data.get('old_value'),
             new_value=data.get('new_value'),
         )
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class PropertyNotification:
     """A notification representing changes to a property.
 
+    Instances are immutable, use ``dataclasses.replace`` to derive a new one.
+    The encoded ``changes`` map is computed once and reused by every
+    ``to_firestore`` call, so treat the returned dictionaries as read-only.
+
     Example:
         notification = PropertyNotification(
             propertyId="12345",
@@ -48,10 +56,13 @@ class PropertyNotification:
     """
     propertyId: str
     createdAt: int
-    changes: Dict[str, Change]
+    changes: Mapping[str, Change]
     userId: Optional[str] = None
     isRead: bool = False
     readAt: Optional[int] = None
+    _encoded_changes: Optional[Dict[str, Dict[str, Any]]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     _valid_fields = {
         "recordingDate", "lastNameOrCorpName", "firstName", "middleName", "generation",
@@ -62,35 +73,116 @@ class PropertyNotification:
     }
 
     def __post_init__(self):
-        self.changes = self._validate_changes(self.changes)
+        object.__setattr__(
+            self, "changes", MappingProxyType(self._validate_changes(self.changes))
+        )
 
     @classmethod
-    def _validate_changes(cls, changes: Dict[str, Change]) -> Dict[str, Change]:
+    def _validate_changes(cls, changes: Mapping[str, Change]) -> Dict[str, Change]:
         """Validate changes against valid Property fields."""
         invalid_keys = [key for key in changes.keys() if key not in cls._valid_fields]
         if invalid_keys:
             raise ValueError(f"Invalid field(s) in changes: {', '.join(invalid_keys)}")
         return dict(changes)  # Return a copy to ensure immutability
 
+    def encoded_changes(self) -> Dict[str, Dict[str, Any]]:
+        """Return the Firestore encoding of ``changes``, computed on first use."""
+        if self._encoded_changes is None:
+            object.__setattr__(
+                self,
+                "_encoded_changes",
+                {key: value.to_firestore() for key, value in self.changes.items()},
+            )
+        return self._encoded_changes
+
     def to_firestore(self) -> Dict[str, Any]:
-        """Convert to Firestore-compatible dictionary using dataclass fields."""
-        base_dict = asdict(self, dict_factory=lambda x: {k: v for k, v in x if v is not None})
-        base_dict['changes'] = {key: value.to_firestore() for key, value in self.changes.items()}
-        return base_dict
+        """Convert to Firestore-compatible dictionary, omitting None values."""
+        result: Dict[str, Any] = {
+            'propertyId': self.propertyId,
+            'createdAt': self.createdAt,
+            'changes': self.encoded_changes(),
+        }
+        if self.userId is not None:
+            result['userId'] = self.userId
+        result['isRead'] = self.isRead
+        if self.readAt is not None:
+            result['readAt'] = self.readAt
+        return result
 
     @classmethod
     def from_firestore(cls, data: Dict[str, Any], doc_id: Optional[str] = None) -> 'PropertyNotification':
         """Create from Firestore data with type conversion."""
         changes_raw = data.get('changes', {}) or {}
-        changes = {key: Change.from_firestore(value) for key, value in changes_raw.items()}
-        return cls(
-            propertyId=data['propertyId'],
-            createdAt=cls._parse_timestamp(data['createdAt']),
-            changes=changes,
-            userId=data.get('userId'),
-            isRead=data.get('isRead', False),
-            readAt=cls._parse_timestamp(data['readAt']) if data.get('readAt') is not None else None,
+        return cls._from_decoded(data, cls._decode_changes(changes_raw))
+
+    @classmethod
+    def from_firestore_many(cls, documents: Iterable[Dict[str, Any]]) -> List['PropertyNotification']:
+        """Decode many notification documents at once.
+
+        Fan-out writes the same ``changes`` map to every subscriber, so an inbox
+        page usually repeats a handful of maps. Each distinct map is decoded and
+        validated once and shared by every notification that carries it.
+        """
+        decoded_changes: Dict[Tuple, Mapping[str, Change]] = {}
+        notifications: List[PropertyNotification] = []
+        for data in documents:
+            changes_raw = data.get('changes', {}) or {}
+            cache_key = cls._changes_cache_key(changes_raw)
+            changes = decoded_changes.get(cache_key) if cache_key is not None else None
+            if changes is None:
+                changes = cls._decode_changes(changes_raw)
+                if cache_key is not None:
+                    decoded_changes[cache_key] = changes
+            notifications.append(cls._from_decoded(data, changes))
+        return notifications
+
+    @classmethod
+    def _decode_changes(cls, changes_raw: Dict[str, Any]) -> Mapping[str, Change]:
+        return MappingProxyType(cls._validate_changes(
+            {key: Change.from_firestore(value) for key, value in changes_raw.items()}
+        ))
+
+    @classmethod
+    def _from_decoded(cls, data: Dict[str, Any], changes: Mapping[str, Change]) -> 'PropertyNotification':
+        """Build an instance from already validated changes, bypassing __init__."""
+        notification = object.__new__(cls)
+        set_field = object.__setattr__
+        set_field(notification, 'propertyId', data['propertyId'])
+        set_field(notification, 'createdAt', cls._parse_timestamp(data['createdAt']))
+        set_field(notification, 'changes', changes)
+        set_field(notification, 'userId', data.get('userId'))
+        set_field(notification, 'isRead', data.get('isRead', False))
+        set_field(
+            notification,
+            'readAt',
+            cls._parse_timestamp(data['readAt']) if data.get('readAt') is not None else None,
         )
+        set_field(notification, '_encoded_changes', None)
+        return notification
+
+    @staticmethod
+    def _changes_cache_key(changes_raw: Dict[str, Any]) -> Optional[Tuple]:
+        """Hashable key for an encoded changes map, or None if a value is unhashable.
+
+        Values carry their type, 1, 1.0 and True compare equal but must not
+        share a decoded map.
+        """
+        try:
+            key = tuple(
+                (
+                    name,
+                    value.get('type'),
+                    type(value.get('old_value')),
+                    value.get('old_value'),
+                    type(value.get('new_value')),
+                    value.get('new_value'),
+                )
+                for name, value in changes_raw.items()
+            )
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     @staticmethod
     def _parse_timestamp(value: Any) -> int:
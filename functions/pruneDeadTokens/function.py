@@ -0,0 +1,112 @@
+from typing import Dict, List, Optional
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn
+from instrumentation import InvocationMetrics
+from subscription_web import manageTopicsInBulk
+from sendNotificationToTopic.helpers import tokenRegistry
+from sendNotificationToTopic.helpers.batchWrite import FIRESTORE_BATCH_LIMIT
+
+# Upper bound on registry pages handled by one run, the next run continues.
+MAX_PRUNE_PAGES = 20
+# {"cursor": <last registry document ID checked>}, absent once a pass completed.
+PRUNE_STATE_COLLECTION = "fcm_token_prune"
+PRUNE_STATE_DOCUMENT = "state"
+
+
+@scheduler_fn.on_schedule(schedule="every 24 hours")
+def pruneDeadTokens(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Purpose:
+    Checks registered tokens with FCM dry-run sends, unsubscribes the ones
+    FCM reports as unregistered or invalid from all of their topics and
+    deletes their registry documents, so topic sizes follow live devices.
+
+    Triggered by:
+    1. Schedule, once a day.
+    """
+    pruneDeadTokenRegistry()
+
+
+def pruneDeadTokenRegistry(max_pages: int = MAX_PRUNE_PAGES) -> Dict[str, int]:
+    """Walk the token registry page by page and prune the dead tokens.
+
+    Every page of fcm_tokens is checked with dry-run sends, see
+    findDeadTokens, except tokens topic management already flagged dead.
+    Dead tokens are unsubscribed through manageTopicsInBulk, in chunks of
+    1,000 tokens per topic, and their documents deleted. A token whose
+    unsubscribe failed for a transient reason is flagged dead and kept for
+    the next run. FCM answering NOT_FOUND for a dead token counts as done.
+
+    A run stops after max_pages and stores its cursor, the next run
+    continues from there and starts over once the registry is walked.
+    Only tokens that went through subscribeToTopic or the bulk endpoints
+    after the registry was introduced have a document. FCM cannot list a
+    topic's tokens, so older tokens are pruned once their client re-subscribes.
+
+    Returns:
+        Dict[str, int]: {"checked": ..., "pruned": ..., "retained": ...}
+    """
+    metrics = InvocationMetrics("pruneDeadTokens")
+    db = firestore.client()
+    state_ref = db.collection(PRUNE_STATE_COLLECTION).document(PRUNE_STATE_DOCUMENT)
+    with metrics.stage("registryQuery"):
+        state = state_ref.get()
+    metrics.count("firestoreRpcs")
+    cursor: Optional[str] = (state.to_dict() or {}).get("cursor") if state.exists else None
+    checked = 0
+    pruned = 0
+    retained = 0
+    for _ in range(max_pages):
+        with metrics.stage("registryQuery"):
+            page = tokenRegistry.tokenPage(db, cursor, metrics)
+        cursor = page[-1].id if len(page) == FIRESTORE_BATCH_LIMIT else None
+
+        entries = [(snapshot.reference, snapshot.to_dict()) for snapshot in page]
+        unflagged = [data["token"] for _, data in entries if not data.get("dead")]
+        with metrics.stage("fcmDryRun"):
+            reasons = tokenRegistry.findDeadTokens(unflagged, metrics)
+        checked += len(unflagged)
+        dead = [
+            (reference, data) for reference, data in entries
+            if data.get("dead") or data["token"] in reasons
+        ]
+
+        tokens_by_topic: Dict[str, List[str]] = {}
+        for _, data in dead:
+            for topic in data.get("topics") or []:
+                tokens_by_topic.setdefault(topic, []).append(data["token"])
+        with metrics.stage("fcmTopicManagement"):
+            results = manageTopicsInBulk(tokens_by_topic, False, metrics)
+
+        failed_tokens = {
+            error["token"]
+            for result in results.values()
+            for error in result["errors"]
+            if not tokenRegistry.isDeadTokenReason(error["reason"])
+        }
+        done = [reference for reference, data in dead if data["token"] not in failed_tokens]
+        # Newly found tokens that are kept skip the dry run next time.
+        kept = {
+            data["token"]: reference for reference, data in dead
+            if data["token"] in failed_tokens and data["token"] in reasons
+        }
+        with metrics.stage("firestoreWrites"):
+            if kept:
+                tokenRegistry.flagDeadTokens(
+                    db, kept, {token: reasons[token] for token in kept}, metrics
+                )
+            pruned += tokenRegistry.deleteRegistryDocuments(db, done, metrics)
+        retained += len(dead) - len(done)
+        if cursor is None:
+            break
+
+    with metrics.stage("firestoreWrites"):
+        if cursor is None:
+            state_ref.delete()
+        else:
+            state_ref.set({"cursor": cursor})
+    metrics.count("firestoreRpcs")
+    metrics.count("tokensPruned", pruned)
+    metrics.count("tokensRetained", retained)
+    metrics.emit(severity="WARNING" if retained else "INFO")
+    return {"checked": checked, "pruned": pruned, "retained": retained}
@@ -0,0 +1,58 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn
+from instrumentation import InvocationMetrics
+from sendNotificationToTopic.helpers import bulkIngest
+
+# A fan-out younger than this may still be dispatched by its ingest request.
+STALE_FAN_OUT_GRACE_SECONDS = 10 * 60
+
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes")
+def resumeBulkIngestFanOuts(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Purpose:
+    Safety net that sends the notifications of bulk ingest fan-outs whose
+    request crashed, failed or was never retried.
+
+    Triggered by:
+    1. Schedule, every 10 minutes.
+    """
+    resumeStaleFanOuts()
+
+
+def resumeStaleFanOuts() -> Dict[str, int]:
+    """Dispatch pending fan-outs older than the grace period, grouped per ingest.
+
+    Stages and push targets a fan-out records as done are skipped. Fan-outs
+    that are still pending afterwards are picked up by the next run.
+
+    Returns:
+        Dict[str, int]: {"resumed": ..., "pending": ...}
+    """
+    metrics = InvocationMetrics("resumeBulkIngestFanOuts")
+    db = firestore.client()
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    with metrics.stage("fanOutQuery"):
+        by_ingest = bulkIngest.staleFanOuts(
+            db, now - STALE_FAN_OUT_GRACE_SECONDS * 1000, metrics=metrics
+        )
+    resumed = 0
+    pending = 0
+    for ingest_id, fan_outs in by_ingest.items():
+        try:
+            notifications = bulkIngest.dispatchGroupedNotifications(db, fan_outs, metrics)
+        except Exception as e:
+            # The fan-outs stay, the next run tries again.
+            logging.error("Failed to resume fan-outs of ingest %s: %s", ingest_id, e)
+            pending += len(fan_outs)
+            continue
+        resumed += len(fan_outs) - len(notifications["pending"])
+        pending += len(notifications["pending"])
+
+    metrics.count("fanOutsResumed", resumed)
+    metrics.count("fanOutsPending", pending)
+    metrics.emit(severity="WARNING" if pending else "INFO")
+    return {"resumed": resumed, "pending": pending}
@@ -1,4 +1,3 @@
-import copy
 from firebase_admin import messaging, exceptions
 from firebase_functions.firestore_fn import (
     on_document_updated,
@@ -9,9 +8,15 @@ from firebase_admin import firestore
 from datetime import datetime, timezone
 from typing import Dict, List, Any
 from models.property_notification import Change, ChangeType, PropertyNotification
+from instrumentation import InvocationMetrics
 from sendNotificationToTopic.helpers.buildNotification import buildNotificationChangePayload
-from sendNotificationToTopic.helpers.createInAppNotification import createInAppNotifications
-from sendNotificationToTopic.helpers.sendPushNotification import sendPushNotifications
+from sendNotificationToTopic.helpers.bulkIngest import isBulkIngestWrite
+from sendNotificationToTopic.helpers import coalesceNotifications, idempotency
+from sendNotificationToTopic.helpers.dispatchNotifications import (
+    DISPATCH_STAGES,
+    deliveredPushTargets,
+    dispatchNotifications,
+)
 
 
 
@@ -24,6 +29,15 @@ def sendNotificationToTopic(event: Event[DocumentSnapshot]) -> None:
     and notification preference (propertyField).
     2. Creates an in-app notification entry in "property_notification" collection.
 
+    When COALESCE_WINDOW_SECONDS is set, changes are only buffered here and
+    sent once per window by flushNotificationBuffer.
+
+    Deliveries are at least once. Finished stages are recorded per event ID,
+    so a retried event only runs the stages that failed. A failed push stage
+    also records the topics it did deliver, they are not sent again. A
+    failing stage raises, so the event is redelivered when retries are
+    enabled on the deployed function.
+
     Triggered by:
     1. Changes in "properties" collection.
 
@@ -36,22 +50,70 @@ def sendNotificationToTopic(event: Event[DocumentSnapshot]) -> None:
     """
     property_id = event.params["propertyId"]
     data = event.data
+    metrics = InvocationMetrics("sendNotificationToTopic", propertyId=property_id)
 
     new_property_data = data.after.to_dict()
     old_property_data = data.before.to_dict()
-    if new_property_data == old_property_data:
-        print(f"Property {property_id} is unchanged. No notification is sent.")
+    if isBulkIngestWrite(old_property_data, new_property_data):
+        # bulkIngestProperties already fanned out this write.
+        metrics.label(skipped="bulkIngest")
+        metrics.emit()
+        return
+
+    with metrics.stage("diff"):
+        payload = buildNotificationChangePayload(
+            new_object=new_property_data,
+            old_object=old_property_data,
+            property_id=property_id,
+        )
+    metrics.count("changedFields", len(payload))
+    if not payload:
+        # Only unwatched bookkeeping fields changed: skip every Firestore/FCM call.
+        metrics.label(skipped="noWatchedChanges")
+        metrics.emit()
         return
-    payload = buildNotificationChangePayload(
-        new_object=new_property_data,
-        old_object=old_property_data,
-        property_id=property_id,
-    )
 
-    try:
-        payload_copy = copy.deepcopy(payload)
-        sendPushNotifications(payload, property_id)
-        createInAppNotifications(payload_copy, property_id)
+    db = firestore.client()
+    with metrics.stage("idempotencyCheck"):
+        progress = idempotency.eventProgress(db, event.id)
+    completed_stages = progress.stages
 
-    except Exception as e:
-        print(f"Error: {e}")
\ No newline at end of file
+    if coalesceNotifications.COALESCE_WINDOW_SECONDS > 0:
+        if "buffer" in completed_stages:
+            metrics.label(skipped="duplicateEvent")
+            metrics.emit()
+            return
+        # Bursts of writes to one property are merged and sent by flushNotificationBuffer.
+        with metrics.stage("buffer"):
+            opened_window = coalesceNotifications.bufferChanges(db, property_id, payload)
+        idempotency.markStagesComplete(db, event.id, {"buffer"})
+        metrics.label(buffered=True, openedWindow=opened_window)
+        metrics.emit()
+        return
+
+    pending_stages = DISPATCH_STAGES - completed_stages
+    if not pending_stages:
+        metrics.label(skipped="duplicateEvent")
+        metrics.emit()
+        return
+
+    results = dispatchNotifications(
+        payload,
+        property_id,
+        metrics,
+        stages=pending_stages,
+        notification_key=event.id,
+        skip_push_targets=progress.sent_push_targets,
+    )
+    idempotency.markStagesComplete(
+        db,
+        event.id,
+        {stage for stage, result in results.items() if result["success"]},
+        deliveredPushTargets(results),
+    )
+    failed = {stage: result["error"] for stage, result in results.items() if not result["success"]}
+    metrics.label(failedStages=failed, resumedStages=sorted(completed_stages))
+    metrics.emit(severity="ERROR" if failed else "INFO")
+    if failed:
+        # Let the platform retry the event, finished stages are skipped next time.
+        raise Exception(f"Notification stages failed for property {property_id}: {failed}")
\ No newline at end of file
@@ -0,0 +1,166 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Any, Optional, Tuple
+from google.api_core import exceptions as api_exceptions
+from google.cloud.firestore_v1 import DocumentReference
+from instrumentation import InvocationMetrics, NOOP_METRICS
+
+# Firestore rejects a single commit with more than 500 writes.
+FIRESTORE_BATCH_LIMIT = 500
+MAX_PARALLEL_COMMITS = 8
+MAX_COMMIT_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.5
+
+
+class BatchWriteError(Exception):
+    """Some batches failed for good. ``written`` holds the writes of the batches that landed."""
+
+    def __init__(self, message: str, written: List[Tuple[DocumentReference, Dict[str, Any]]]):
+        super().__init__(message)
+        self.written = written
+
+
+def commitInBatches(
+    db,
+    writes: List[Tuple[DocumentReference, Dict[str, Any]]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+    merge: bool = False,
+) -> int:
+    """Write documents with WriteBatch commits of up to FIRESTORE_BATCH_LIMIT.
+
+    Batches are committed in parallel. A batch that fails is retried on its
+    own, so writes that already landed are never sent again. Every write is a
+    ``set`` on a known document reference, which makes a retry idempotent.
+    With ``merge`` the writes only touch the given fields. Field transforms
+    such as ``Increment`` are not idempotent: a commit that timed out after
+    it landed applies them twice when retried.
+
+    Returns:
+        int: Number of documents written.
+
+    Raises:
+        BatchWriteError: If some batches still fail after MAX_COMMIT_ATTEMPTS.
+    """
+    return len(_runInBatches(
+        writes, lambda chunk: _commitWithRetry(db, chunk, metrics, merge)
+    ))
+
+
+def createInBatches(
+    db,
+    writes: List[Tuple[DocumentReference, Dict[str, Any]]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> List[Tuple[DocumentReference, Dict[str, Any]]]:
+    """Create documents with WriteBatch commits of up to FIRESTORE_BATCH_LIMIT.
+
+    Like commitInBatches, but every write is a ``create``: a document that
+    already exists is left untouched instead of overwritten. A batch is
+    atomic, so one existing document fails it with AlreadyExists. The batch
+    is then read back with one ``get_all`` and committed again without the
+    existing documents. A redelivered fan-out with deterministic IDs therefore
+    keeps what the first delivery wrote, including isRead and readAt.
+
+    Returns:
+        The writes that created a document. A batch that timed out after it
+        landed is retried and reports its documents as existing, not created.
+
+    Raises:
+        BatchWriteError: If some batches still fail after MAX_COMMIT_ATTEMPTS.
+    """
+    return _runInBatches(writes, lambda chunk: _createWithRetry(db, chunk, metrics))
+
+
+def _runInBatches(
+    writes: List[Tuple[DocumentReference, Dict[str, Any]]],
+    commit_chunk: Callable[
+        [List[Tuple[DocumentReference, Dict[str, Any]]]],
+        Tuple[List[Tuple[DocumentReference, Dict[str, Any]]], Optional[Exception]],
+    ],
+) -> List[Tuple[DocumentReference, Dict[str, Any]]]:
+    """Commit chunks in parallel. ``commit_chunk`` returns the writes that landed and the last error."""
+    chunks = [
+        writes[start:start + FIRESTORE_BATCH_LIMIT]
+        for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT)
+    ]
+    if not chunks:
+        return []
+    workers = min(MAX_PARALLEL_COMMITS, len(chunks))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(commit_chunk, chunks))
+
+    written = [write for landed, error in outcomes if error is None for write in landed]
+    failed = [
+        (len(chunk), error) for chunk, (_, error) in zip(chunks, outcomes) if error is not None
+    ]
+    if failed:
+        failed_writes = sum(count for count, _ in failed)
+        raise BatchWriteError(
+            f"{failed_writes}/{len(writes)} writes failed after "
+            f"{MAX_COMMIT_ATTEMPTS} attempts: {failed[0][1]}",
+            written,
+        )
+    return written
+
+
+def _commitWithRetry(
+    db,
+    chunk: List[Tuple[DocumentReference, Dict[str, Any]]],
+    metrics: InvocationMetrics,
+    merge: bool = False,
+) -> Tuple[List[Tuple[DocumentReference, Dict[str, Any]]], Optional[Exception]]:
+    """Commit one chunk, retrying with exponential backoff. Returns the chunk and the last error."""
+    last_error = None
+    for attempt in range(MAX_COMMIT_ATTEMPTS):
+        if attempt > 0:
+            metrics.count("commitRetries")
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)))
+        batch = db.batch()
+        for ref, data in chunk:
+            batch.set(ref, data, merge=merge)
+        metrics.count("firestoreRpcs")
+        try:
+            batch.commit()
+            return chunk, None
+        except Exception as e:
+            last_error = e
+    return [], last_error
+
+
+def _createWithRetry(
+    db,
+    chunk: List[Tuple[DocumentReference, Dict[str, Any]]],
+    metrics: InvocationMetrics,
+) -> Tuple[List[Tuple[DocumentReference, Dict[str, Any]]], Optional[Exception]]:
+    """Create one chunk, dropping existing documents on AlreadyExists. Returns the created writes."""
+    pending = chunk
+    last_error: Optional[Exception] = None
+    for attempt in range(MAX_COMMIT_ATTEMPTS):
+        if attempt > 0 and not isinstance(last_error, api_exceptions.AlreadyExists):
+            metrics.count("commitRetries")
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)))
+        if not pending:
+            return [], None
+        batch = db.batch()
+        for ref, data in pending:
+            batch.create(ref, data)
+        metrics.count("firestoreRpcs")
+        try:
+            batch.commit()
+            return pending, None
+        except api_exceptions.AlreadyExists as e:
+            last_error = e
+            metrics.count("firestoreRpcs")
+            try:
+                existing = {
+                    snapshot.reference.path
+                    for snapshot in db.get_all([ref for ref, _ in pending])
+                    if snapshot.exists
+                }
+            except Exception as read_error:
+                last_error = read_error
+                continue
+            metrics.count("existingDocuments", len(existing))
+            pending = [(ref, data) for ref, data in pending if ref.path not in existing]
+        except Exception as e:
+            last_error = e
+    return [], last_error
@@ -1,16 +1,40 @@
 
-from typing import Dict, List, Any
-from models.property_notification import Change, ChangeType
+from itertools import chain
+from typing import Dict, List, Any, Collection, FrozenSet, Optional
+from models.property_notification import Change, ChangeType, PropertyNotification
+
+# Bookkeeping fields rewritten by almost every ingest. Changes to them never
+# reach subscribers, so they are not worth a notification. bulkIngestId is the
+# marker written by bulkIngestProperties.
+IGNORED_FIELDS: FrozenSet[str] = frozenset(
+    {"insertTimestamp", "attempts", "numberOfAttempts", "bulkIngestId"}
+)
+WATCHED_FIELDS: FrozenSet[str] = frozenset(
+    PropertyNotification._valid_fields - IGNORED_FIELDS
+)
+
+_MISSING = object()
 
 
 def buildNotificationChangePayload(
-    new_object: Dict[str, Any], old_object: Dict[str, Any], property_id: str
+    new_object: Dict[str, Any],
+    old_object: Dict[str, Any],
+    property_id: str,
+    watch: Optional[Collection[str]] = WATCHED_FIELDS,
+    ignore: Collection[str] = IGNORED_FIELDS,
 ) -> Dict[str, Change]:
     """Take two property objects and return their differences.
 
     Args:
         new_object (Dict[str, Any]): Updated property object.
         old_object (Dict[str, Any]): Original property object.
+        watch (Collection[str]): Fields to compare, None compares every field.
+        ignore (Collection[str]): Fields to skip even when watched.
+
+    Changes end up in PropertyNotification and in topic names, so only
+    top-level fields can be watched: every watched field must be one of
+    PropertyNotification._valid_fields and ignored fields must not be paths.
+    Nested paths are checked here, before any diffing, and raise ValueError.
 
     Returns:
         Dict[str, Change]
@@ -23,41 +47,111 @@ def buildNotificationChangePayload(
         "documentId"
     ) != old_object.get("documentId"):
         raise Exception("Property IDs don't match")
+    checkNotifiableFields(watch, ignore)
+
+    return diffDocuments(new_object, old_object, watch=watch, ignore=ignore)
+
+
+def checkNotifiableFields(
+    watch: Optional[Collection[str]], ignore: Collection[str]
+) -> None:
+    """Raise ValueError for watch or ignore entries a notification cannot carry."""
+    if watch is not WATCHED_FIELDS and watch is not None:
+        invalid = sorted(set(watch) - PropertyNotification._valid_fields)
+        if invalid:
+            raise ValueError(f"Cannot watch field(s) {', '.join(invalid)}: not notification fields")
+    nested = sorted(path for path in ignore if "." in path)
+    if nested:
+        raise ValueError(f"Cannot ignore nested path(s) {', '.join(nested)}: only top-level fields")
+
+
+def diffDocuments(
+    new_object: Dict[str, Any],
+    old_object: Dict[str, Any],
+    watch: Optional[Collection[str]] = None,
+    ignore: Collection[str] = (),
+) -> Dict[str, Change]:
+    """Diff two documents in a single pass, keyed by dotted field path.
+
+    Added, updated and removed fields are all reported in the same pass. Only
+    watched paths are compared. A watched field is compared as a whole, unless
+    the watch or ignore list names a path inside it (``"owner.name"``). In that
+    case the engine descends into that map, or that array by index
+    (``"owners.0"``), and reports changes under the nested path.
+
+    Example:
+    diffDocuments({"book": "46", "owner": {"name": "B"}}, {"book": "45", "owner": {"name": "A"}},
+                  watch={"book", "owner.name"})
+    -> {"book": Change(UPDATED, "45", "46"), "owner.name": Change(UPDATED, "A", "B")}
+    """
+    watch_set = frozenset(watch) if watch is not None else None
+    ignore_set = frozenset(ignore)
+    descend: set = set()
+    for path in chain(watch_set or (), ignore_set):
+        parts = path.split(".")
+        descend.update(".".join(parts[:i]) for i in range(1, len(parts)))
 
     changes_payload: Dict[str, Change] = {}
+    _diffContainer(
+        changes_payload, "", new_object, old_object,
+        watch_set, ignore_set, frozenset(descend), watch_set is None,
+    )
+    return changes_payload
+
+
+def _diffContainer(
+    changes_payload: Dict[str, Change],
+    prefix: str,
+    new_container: Any,
+    old_container: Any,
+    watch: Optional[FrozenSet[str]],
+    ignore: FrozenSet[str],
+    descend: FrozenSet[str],
+    watched: bool,
+) -> None:
+    if isinstance(new_container, dict):
+        keys = chain(new_container, (k for k in old_container if k not in new_container))
+        get_new = lambda key: new_container.get(key, _MISSING)
+        get_old = lambda key: old_container.get(key, _MISSING)
+    else:
+        keys = range(max(len(new_container), len(old_container)))
+        get_new = lambda index: new_container[index] if index < len(new_container) else _MISSING
+        get_old = lambda index: old_container[index] if index < len(old_container) else _MISSING
+
+    for key in keys:
+        path = f"{prefix}{key}"
+        if path in ignore:
+            continue
+        is_watched = watched or path in watch
+        if not is_watched and path not in descend:
+            continue
+
+        new_value = get_new(key)
+        old_value = get_old(key)
+        if new_value is old_value or new_value == old_value:
+            continue
+        if path in descend and _isSameContainerType(new_value, old_value):
+            _diffContainer(
+                changes_payload, f"{path}.", new_value, old_value,
+                watch, ignore, descend, is_watched,
+            )
+            continue
+
+        if new_value is _MISSING:
+            changes_payload[path] = Change(
+                type=ChangeType.REMOVED, old_value=old_value, new_value=None
+            )
+        elif (old_value is _MISSING or old_value is None) and new_value is not None:
+            changes_payload[path] = Change(
+                type=ChangeType.ADDED, old_value=None, new_value=new_value
+            )
+        elif not (old_value is _MISSING and new_value is None):
+            changes_payload[path] = Change(
+                type=ChangeType.UPDATED, old_value=old_value, new_value=new_value
+            )
+
 
-    if new_object != old_object:
-        # Check for new or updated attributes
-        for new_key, new_value in new_object.items():
-            is_new_field = (old_object.get(new_key) is None) and (new_value is not None)
-            if is_new_field:
-                change = Change(
-                    type=ChangeType.ADDED, old_value=None, new_value=new_value
-                )
-                data_to_add = {new_key: change}
-                changes_payload.update(data_to_add)
-                continue
-            is_updating_field = new_value != old_object.get(new_key)
-            if is_updating_field:
-                old_value = old_object.get(new_key)
-                change = Change(
-                    type=ChangeType.UPDATED, old_value=old_value, new_value=new_value
-                )
-                data_to_add = {new_key: change}
-                changes_payload.update(data_to_add)
-               
-
-        # Check for removed attributes
-        is_removing_field = changes_payload == {}
-        if is_removing_field:
-            removed_keys = old_object.keys() - new_object.keys()
-            for key in removed_keys:
-                change = Change(
-                    type=ChangeType.REMOVED,
-                    old_value=old_object.get(key),
-                    new_value=None,
-                )
-                data_to_add = {key: change}
-                changes_payload.update(data_to_add)
-               
-    return changes_payload
\ No newline at end of file
+def _isSameContainerType(new_value: Any, old_value: Any) -> bool:
+    return (isinstance(new_value, dict) and isinstance(old_value, dict)) or (
+        isinstance(new_value, list) and isinstance(old_value, list)
+    )
@@ -0,0 +1,430 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+from firebase_admin import firestore
+from models.property_notification import Change
+from instrumentation import InvocationMetrics, NOOP_METRICS
+from sendNotificationToTopic.helpers.batchWrite import (
+    FIRESTORE_BATCH_LIMIT,
+    MAX_COMMIT_ATTEMPTS,
+    MAX_PARALLEL_COMMITS,
+    RETRY_BACKOFF_SECONDS,
+    commitInBatches,
+)
+from sendNotificationToTopic.helpers.buildNotification import buildNotificationChangePayload
+from sendNotificationToTopic.helpers.coalesceNotifications import mergeChangePayloads
+from sendNotificationToTopic.helpers.createInAppNotification import (
+    createInAppNotificationsForProperties,
+)
+from sendNotificationToTopic.helpers.dispatchNotifications import DISPATCH_STAGES
+from sendNotificationToTopic.helpers.sendPushNotification import (
+    sendPushNotificationsForProperties,
+)
+
+# Written with every bulk ingest write. sendNotificationToTopic skips a write
+# that changes it, the ingest fans out on its own.
+BULK_INGEST_MARKER_FIELD = "bulkIngestId"
+PROPERTIES_COLLECTION = "properties"
+# bulk_ingest_fan_outs/{ingestId}_{propertyId}: the changes of one ingested
+# property until all of its notifications went out. Committed together with
+# the property write, so a fan-out that crashed or failed can be resumed.
+FAN_OUTS_COLLECTION = "bulk_ingest_fan_outs"
+# Fan-out documents carry expireAt, a Firestore TTL policy deletes them after this long.
+FAN_OUT_TTL = timedelta(days=2)
+# A changed property takes two writes in a commit: the property and its fan-out document.
+INGEST_CHUNK_SIZE = FIRESTORE_BATCH_LIMIT // 2
+
+
+def isBulkIngestWrite(
+    old_object: Optional[Dict[str, Any]], new_object: Optional[Dict[str, Any]]
+) -> bool:
+    """True if the write set a new bulk ingest marker.
+
+    A later regular write keeps the marker unchanged, or drops it by
+    overwriting the document, so it is still notified by the trigger.
+    """
+    marker = (new_object or {}).get(BULK_INGEST_MARKER_FIELD)
+    return marker is not None and marker != (old_object or {}).get(BULK_INGEST_MARKER_FIELD)
+
+
+def fanOutDocumentId(ingest_id: str, property_id: str) -> str:
+    return f"{ingest_id}_{property_id}"
+
+
+def applyIngestRecords(
+    db,
+    records: List[Dict[str, Any]],
+    ingest_id: str,
+    metrics: InvocationMetrics = NOOP_METRICS,
+    resume: bool = True,
+) -> Dict[str, Any]:
+    """Apply records to their property documents and persist the fan-outs they need.
+
+    Records are handled INGEST_CHUNK_SIZE at a time, chunks in parallel. A
+    chunk reads the current versions with one ``get_all``, diffs them, and
+    commits in one batch:
+
+    - an ``update`` of the fields each record names plus the marker, with the
+      snapshot's update time as precondition, so a concurrent write is never
+      overwritten. The chunk is read and diffed again instead;
+    - a fan-out document per property with notifiable changes.
+
+    Records that change nothing are not written. A new property is created
+    without notifications, like the update-only trigger. A record whose diff
+    fails is rejected and not written.
+
+    With ``resume`` the fan-out documents of an earlier attempt with the
+    same ingest ID are read too. Their properties come back as unchanged,
+    but their fan-outs are returned for dispatch again. A record that
+    changes a property again is merged into its pending fan-out.
+
+    Returns:
+        Dict[str, Any]
+
+    Example:
+    {"fanOuts": {"property1": {"changes": {...}, "notificationKey": "ingest1_property1", ...}},
+    "written": 2, "created": ["property2"], "unchanged": ["property3"], "resumed": [],
+    "rejected": {"property4": "..."}, "failed": {}}
+    """
+    chunks = [
+        records[start:start + INGEST_CHUNK_SIZE]
+        for start in range(0, len(records), INGEST_CHUNK_SIZE)
+    ]
+    applied = _emptyOutcome()
+    if not chunks:
+        return applied
+    with metrics.stage("applyRecords"):
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_COMMITS, len(chunks))) as executor:
+            outcomes = list(executor.map(
+                lambda chunk: _applyChunkWithRetry(db, chunk, ingest_id, resume, metrics), chunks
+            ))
+    for outcome in outcomes:
+        applied["fanOuts"].update(outcome["fanOuts"])
+        applied["written"] += outcome["written"]
+        for key in ("created", "unchanged", "resumed"):
+            applied[key].extend(outcome[key])
+        applied["rejected"].update(outcome["rejected"])
+        applied["failed"].update(outcome["failed"])
+    metrics.count("changedFields", sum(
+        len(fan_out["changes"]) for fan_out in applied["fanOuts"].values()
+    ))
+    return applied
+
+
+def _applyChunkWithRetry(
+    db,
+    records: List[Dict[str, Any]],
+    ingest_id: str,
+    resume: bool,
+    metrics: InvocationMetrics,
+) -> Dict[str, Any]:
+    """Read, diff and commit one chunk, again from the read when the commit fails."""
+    last_error: Optional[Exception] = None
+    for attempt in range(MAX_COMMIT_ATTEMPTS):
+        if attempt > 0:
+            metrics.count("commitRetries")
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)))
+        try:
+            return _applyChunk(db, records, ingest_id, resume, metrics)
+        except Exception as e:
+            # Usually FailedPrecondition: a property changed since it was read.
+            last_error = e
+    outcome = _emptyOutcome()
+    outcome["failed"] = {record["documentId"]: str(last_error) for record in records}
+    return outcome
+
+
+def _emptyOutcome() -> Dict[str, Any]:
+    return {
+        "fanOuts": {}, "written": 0, "created": [], "unchanged": [], "resumed": [],
+        "rejected": {}, "failed": {},
+    }
+
+
+def _applyChunk(
+    db,
+    records: List[Dict[str, Any]],
+    ingest_id: str,
+    resume: bool,
+    metrics: InvocationMetrics,
+) -> Dict[str, Any]:
+    properties = db.collection(PROPERTIES_COLLECTION)
+    fan_outs = db.collection(FAN_OUTS_COLLECTION)
+    property_refs = [properties.document(record["documentId"]) for record in records]
+    fan_out_refs = [
+        fan_outs.document(fanOutDocumentId(ingest_id, record["documentId"])) for record in records
+    ]
+    metrics.count("firestoreRpcs")
+    snapshots = {
+        snapshot.reference.path: snapshot
+        for snapshot in db.get_all(property_refs + (fan_out_refs if resume else []))
+    }
+
+    now = datetime.now(timezone.utc)
+    outcome = _emptyOutcome()
+    batch = db.batch()
+    batch_writes = 0
+    for record, property_ref, fan_out_ref in zip(records, property_refs, fan_out_refs):
+        property_id = record["documentId"]
+        snapshot = snapshots.get(property_ref.path)
+        pending_snapshot = snapshots.get(fan_out_ref.path)
+        pending = pending_snapshot.to_dict() if pending_snapshot and pending_snapshot.exists else None
+        if snapshot is None or not snapshot.exists:
+            batch.create(property_ref, {**record, BULK_INGEST_MARKER_FIELD: ingest_id})
+            batch_writes += 1
+            outcome["written"] += 1
+            outcome["created"].append(property_id)
+            continue
+
+        old_object = snapshot.to_dict()
+        new_object = {**old_object, **record}
+        if new_object == old_object:
+            if pending is not None:
+                outcome["fanOuts"][property_id] = pending
+                outcome["resumed"].append(property_id)
+            else:
+                outcome["unchanged"].append(property_id)
+            continue
+        try:
+            payload = buildNotificationChangePayload(
+                new_object=new_object, old_object=old_object, property_id=property_id
+            )
+        except Exception as e:
+            outcome["rejected"][property_id] = str(e)
+            continue
+
+        batch.update(
+            property_ref,
+            {**record, BULK_INGEST_MARKER_FIELD: ingest_id},
+            option=db.write_option(last_update_time=snapshot.update_time),
+        )
+        batch_writes += 1
+        outcome["written"] += 1
+        if pending is not None:
+            payload = mergeChangePayloads(decodeFanOutChanges(pending), payload)
+        if payload:
+            fan_out = newFanOut(ingest_id, property_id, payload, pending, now)
+            batch.set(fan_out_ref, fan_out)
+            batch_writes += 1
+            outcome["fanOuts"][property_id] = fan_out
+        elif pending is not None:
+            # The record undid the pending changes, nothing is left to notify.
+            batch.delete(fan_out_ref)
+            batch_writes += 1
+
+    if batch_writes:
+        metrics.count("firestoreRpcs")
+        batch.commit()
+    return outcome
+
+
+def newFanOut(
+    ingest_id: str,
+    property_id: str,
+    payload: Dict[str, Change],
+    pending: Optional[Dict[str, Any]],
+    now: datetime,
+) -> Dict[str, Any]:
+    """Fan-out document for a property's changes.
+
+    Merged into a pending fan-out the changes are a new notification, with
+    a new revision in its key, since part of the old one may have gone out.
+    """
+    revision = pending.get("revision", 0) + 1 if pending is not None else 0
+    notification_key = fanOutDocumentId(ingest_id, property_id)
+    if revision:
+        notification_key = f"{notification_key}_{revision}"
+    return {
+        "ingestId": ingest_id,
+        "propertyId": property_id,
+        "revision": revision,
+        "notificationKey": notification_key,
+        "createdAt": int(now.timestamp() * 1000),
+        "changes": {key: change.to_firestore() for key, change in payload.items()},
+        "stages": {},
+        "pushTargets": [],
+        "expireAt": now + FAN_OUT_TTL,
+    }
+
+
+def decodeFanOutChanges(fan_out: Dict[str, Any]) -> Dict[str, Change]:
+    return {
+        key: Change.from_firestore(value) for key, value in (fan_out.get("changes") or {}).items()
+    }
+
+
+def dispatchGroupedNotifications(
+    db,
+    fan_outs: Dict[str, Dict[str, Any]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> Dict[str, Any]:
+    """Fan out many properties of one ingest at once: grouped push sends and grouped in-app writes.
+
+    Both stages run concurrently, like dispatchNotifications, and skip what
+    the fan-out documents record as done. A group whose in-app writes
+    failed is retried once in place with the same notification keys, the
+    documents it already created are kept. Progress is then written back:
+    finished fan-outs are deleted, the others record their finished stages
+    and delivered push targets for the next attempt.
+
+    Returns:
+        Dict[str, Any]
+
+    Example:
+    {"pushMessages": 12, "pushFailures": {"'property_7_all' in topics": "Quota exceeded"},
+    "inAppNotifications": 4100, "pending": ["property7"]}
+    """
+    payloads = {property_id: decodeFanOutChanges(fan_out) for property_id, fan_out in fan_outs.items()}
+    push_payloads = {
+        property_id: payloads[property_id]
+        for property_id, fan_out in fan_outs.items()
+        if not (fan_out.get("stages") or {}).get("push")
+    }
+    in_app_property_ids = [
+        property_id
+        for property_id, fan_out in fan_outs.items()
+        if not (fan_out.get("stages") or {}).get("inApp")
+    ]
+    delivered_targets = {
+        target for fan_out in fan_outs.values() for target in fan_out.get("pushTargets") or ()
+    }
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        push_future = executor.submit(
+            sendPushNotificationsForProperties,
+            push_payloads,
+            metrics,
+            skip_targets=delivered_targets,
+        )
+        in_app_future = executor.submit(
+            _createInAppWithRetry, db, fan_outs, payloads, in_app_property_ids, metrics
+        )
+
+    completed: Dict[str, Set[str]] = {property_id: set() for property_id in fan_outs}
+    delivered: Dict[str, List[str]] = {property_id: [] for property_id in fan_outs}
+    push_messages = 0
+    push_failures: Dict[str, str] = {}
+    try:
+        for property_id, results in push_future.result().items():
+            push_messages += len(results)
+            failures = {
+                target: result["error"] for target, result in results.items() if not result["success"]
+            }
+            push_failures.update(failures)
+            delivered[property_id] = [target for target in results if target not in failures]
+            if not failures:
+                completed[property_id].add("push")
+    except Exception as e:
+        push_failures = {property_id: str(e) for property_id in push_payloads}
+    try:
+        in_app_written, in_app_failed = in_app_future.result()
+    except Exception as e:
+        in_app_written, in_app_failed = 0, {property_id: str(e) for property_id in in_app_property_ids}
+    for property_id in in_app_property_ids:
+        if property_id not in in_app_failed:
+            completed[property_id].add("inApp")
+
+    with metrics.stage("recordProgress"):
+        pending = recordFanOutProgress(db, fan_outs, completed, delivered, metrics)
+    return {
+        "pushMessages": push_messages,
+        "pushFailures": push_failures,
+        "inAppNotifications": in_app_written,
+        "inAppFailures": in_app_failed,
+        "pending": pending,
+    }
+
+
+def _createInAppWithRetry(
+    db,
+    fan_outs: Dict[str, Dict[str, Any]],
+    payloads: Dict[str, Dict[str, Change]],
+    property_ids: List[str],
+    metrics: InvocationMetrics,
+) -> Tuple[int, Dict[str, str]]:
+    def create(group: List[str]) -> Tuple[int, Dict[str, str]]:
+        return createInAppNotificationsForProperties(
+            db,
+            {property_id: payloads[property_id] for property_id in group},
+            {property_id: fan_outs[property_id]["notificationKey"] for property_id in group},
+            metrics,
+            created_at={property_id: fan_outs[property_id]["createdAt"] for property_id in group},
+        )
+
+    if not property_ids:
+        return 0, {}
+    written, failed = create(property_ids)
+    if failed:
+        metrics.count("inAppGroupRetries")
+        retry_written, failed = create(list(failed))
+        written += retry_written
+    return written, failed
+
+
+def recordFanOutProgress(
+    db,
+    fan_outs: Dict[str, Dict[str, Any]],
+    completed: Dict[str, Set[str]],
+    delivered: Dict[str, List[str]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> List[str]:
+    """Delete finished fan-out documents and record the progress of the others.
+
+    A failure is logged: the fan-outs stay pending and a resumed attempt
+    repeats what was not recorded, in-app documents are not duplicated.
+
+    Returns:
+        List[str]: The property IDs whose fan-out is still pending.
+    """
+    collection = db.collection(FAN_OUTS_COLLECTION)
+    finished = []
+    progress = []
+    pending = []
+    for property_id, fan_out in fan_outs.items():
+        reference = collection.document(fanOutDocumentId(fan_out["ingestId"], property_id))
+        stages = {
+            stage for stage, done in (fan_out.get("stages") or {}).items() if done
+        } | completed[property_id]
+        if DISPATCH_STAGES <= stages:
+            finished.append(reference)
+            continue
+        pending.append(property_id)
+        update: Dict[str, Any] = {"stages": {stage: True for stage in stages}}
+        if delivered[property_id]:
+            update["pushTargets"] = firestore.ArrayUnion(delivered[property_id])
+        progress.append((reference, update))
+    try:
+        commitInBatches(db, progress, metrics, merge=True)
+        for start in range(0, len(finished), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for reference in finished[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.delete(reference)
+            metrics.count("firestoreRpcs")
+            batch.commit()
+    except Exception as e:
+        logging.error("Failed to record bulk ingest fan-out progress: %s", e)
+        metrics.label(fanOutProgressError=str(e))
+    metrics.count("pendingFanOuts", len(pending))
+    return sorted(pending)
+
+
+def staleFanOuts(
+    db, cutoff: int, limit: int = FIRESTORE_BATCH_LIMIT, metrics: InvocationMetrics = NOOP_METRICS
+) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Fan-outs created before ``cutoff`` (milliseconds) that are still pending, per ingest ID.
+
+    Example:
+    {"ingest1": {"property1": {"changes": {...}, ...}}}
+    """
+    query = (
+        db.collection(FAN_OUTS_COLLECTION)
+        .where("createdAt", "<=", cutoff)
+        .limit(limit)
+    )
+    metrics.count("firestoreRpcs")
+    by_ingest: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for snapshot in query.stream():
+        fan_out = snapshot.to_dict()
+        by_ingest.setdefault(fan_out["ingestId"], {})[fan_out["propertyId"]] = fan_out
+    return by_ingest
@@ -0,0 +1,244 @@
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Any, Mapping, Optional, Tuple
+from firebase_admin import firestore, functions
+from models.property_notification import Change, ChangeType
+
+# Changes to one property within this many seconds become one notification.
+# 0 disables coalescing and fans out from the trigger directly.
+COALESCE_WINDOW_SECONDS = 10
+BUFFER_COLLECTION = "notification_buffers"
+FLUSH_TASK_FUNCTION = "flushNotificationBuffer"
+# A claimed window is leased to one flush for this long. It must outlast a
+# flush, the function timeout, so a running flush is never claimed twice.
+FLUSH_LEASE_SECONDS = 300
+
+
+class FlushLeaseHeld(Exception):
+    """Another flush holds an active lease on the window."""
+
+
+def bufferChanges(db, property_id: str, change_payload: Mapping[str, Change]) -> bool:
+    """Merge changes into the property's buffer document.
+
+    The first change of a window creates the buffer and schedules its flush
+    task, later changes in the window only merge into it. Changes arriving
+    while the window is being flushed are held in ``pendingChanges`` and
+    become the next window once the flush finished.
+
+    Returns:
+        bool: True if this call opened a new window.
+    """
+    buffer_ref = db.collection(BUFFER_COLLECTION).document(property_id)
+    opened_window = _mergeIntoBuffer(
+        db.transaction(), buffer_ref, property_id, dict(change_payload), _nowMilliseconds()
+    )
+    if opened_window:
+        scheduleFlush(property_id)
+    return opened_window
+
+
+@firestore.transactional
+def _mergeIntoBuffer(
+    transaction, buffer_ref, property_id: str, change_payload: Dict[str, Change], now: int
+) -> bool:
+    snapshot = buffer_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        transaction.set(buffer_ref, {
+            "propertyId": property_id,
+            "windowStart": now,
+            "updatedAt": now,
+            "eventCount": 1,
+            "changes": {key: change.to_firestore() for key, change in change_payload.items()},
+        })
+        return True
+
+    buffer = snapshot.to_dict()
+    if buffer.get("flushing"):
+        pending = decodeBufferedChanges(buffer, "pendingChanges")
+        merged = mergeChangePayloads(pending, change_payload)
+        transaction.update(buffer_ref, {
+            "updatedAt": now,
+            "pendingEventCount": firestore.Increment(1),
+            "pendingChanges": {key: change.to_firestore() for key, change in merged.items()},
+        })
+        return False
+
+    merged = mergeChangePayloads(decodeBufferedChanges(buffer), change_payload)
+    transaction.update(buffer_ref, {
+        "updatedAt": now,
+        "eventCount": firestore.Increment(1),
+        "changes": {key: change.to_firestore() for key, change in merged.items()},
+    })
+    return False
+
+
+def scheduleFlush(property_id: str) -> None:
+    """Enqueue the flush task for the end of the window.
+
+    A failed enqueue is only logged. flushStaleNotificationBuffers picks the
+    buffer up later.
+    """
+    try:
+        functions.task_queue(FLUSH_TASK_FUNCTION).enqueue(
+            {"propertyId": property_id},
+            functions.TaskOptions(schedule_delay_seconds=COALESCE_WINDOW_SECONDS),
+        )
+    except Exception as e:
+        logging.error("Failed to schedule buffer flush for %s: %s", property_id, e)
+
+
+def claimBuffer(db, property_id: str) -> Optional[Tuple[Dict[str, Change], Dict[str, Any]]]:
+    """Atomically read a property's buffer and lease its window for FLUSH_LEASE_SECONDS.
+
+    The buffer is kept until finishFlush, so a failed flush can be retried
+    with the same window. Changes arriving after the claim are held for the
+    next window. A window that is already flushing is only claimed again
+    once its lease expired or was released by releaseFlush, so two flushes
+    never dispatch the same window at once.
+
+    Returns:
+        The buffered changes and the raw buffer document, whose flushLeaseId
+        identifies this claim. None if there is no buffer.
+
+    Raises:
+        FlushLeaseHeld: If another flush holds an active lease on the window.
+    """
+    buffer_ref = db.collection(BUFFER_COLLECTION).document(property_id)
+    return _claimBuffer(db.transaction(), buffer_ref, _nowMilliseconds(), uuid.uuid4().hex)
+
+
+@firestore.transactional
+def _claimBuffer(
+    transaction, buffer_ref, now: int, lease_id: str
+) -> Optional[Tuple[Dict[str, Change], Dict[str, Any]]]:
+    snapshot = buffer_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    buffer = snapshot.to_dict()
+    if isFlushLeaseActive(buffer, now):
+        raise FlushLeaseHeld(f"Window {buffer.get('windowStart')} is being flushed")
+    lease = {
+        "flushing": True,
+        "flushStartedAt": now,
+        "flushLeaseId": lease_id,
+        "flushLeaseExpiresAt": now + FLUSH_LEASE_SECONDS * 1000,
+    }
+    transaction.update(buffer_ref, lease)
+    return decodeBufferedChanges(buffer), {**buffer, **lease}
+
+
+def isFlushLeaseActive(buffer: Dict[str, Any], now: int) -> bool:
+    return bool(buffer.get("flushing")) and buffer.get("flushLeaseExpiresAt", 0) > now
+
+
+def releaseFlush(db, property_id: str, lease_id: str) -> None:
+    """End a failed flush's lease early, so its retry can claim the window right away.
+
+    The window stays flushing: changes arriving meanwhile are still held
+    for the next window.
+    """
+    buffer_ref = db.collection(BUFFER_COLLECTION).document(property_id)
+    _releaseFlush(db.transaction(), buffer_ref, lease_id, _nowMilliseconds())
+
+
+@firestore.transactional
+def _releaseFlush(transaction, buffer_ref, lease_id: str, now: int) -> None:
+    snapshot = buffer_ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.to_dict().get("flushLeaseId") == lease_id:
+        transaction.update(buffer_ref, {"flushLeaseExpiresAt": now})
+
+
+def finishFlush(db, property_id: str, window_start: int) -> bool:
+    """Drop a flushed window from the property's buffer.
+
+    Changes held while the window was flushing become a new window, whose
+    flush is scheduled like in bufferChanges.
+
+    Returns:
+        bool: True if a new window was opened.
+    """
+    buffer_ref = db.collection(BUFFER_COLLECTION).document(property_id)
+    opened_window = _finishFlush(
+        db.transaction(), buffer_ref, property_id, window_start, _nowMilliseconds()
+    )
+    if opened_window:
+        scheduleFlush(property_id)
+    return opened_window
+
+
+@firestore.transactional
+def _finishFlush(transaction, buffer_ref, property_id: str, window_start: int, now: int) -> bool:
+    snapshot = buffer_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    buffer = snapshot.to_dict()
+    if buffer.get("windowStart") != window_start:
+        return False
+    pending = buffer.get("pendingChanges")
+    if not pending:
+        transaction.delete(buffer_ref)
+        return False
+    transaction.set(buffer_ref, {
+        "propertyId": property_id,
+        "windowStart": now,
+        "updatedAt": now,
+        "eventCount": buffer.get("pendingEventCount", 1),
+        "changes": pending,
+    })
+    return True
+
+
+def decodeBufferedChanges(buffer: Dict[str, Any], field: str = "changes") -> Dict[str, Change]:
+    return {
+        key: Change.from_firestore(value)
+        for key, value in (buffer.get(field) or {}).items()
+    }
+
+
+def mergeChangePayloads(
+    older: Mapping[str, Change], newer: Mapping[str, Change]
+) -> Dict[str, Change]:
+    """Merge two change payloads so the oldest old_value and newest new_value win.
+
+    The change type is derived again from the merged values. A field that
+    ends up back at its original value is dropped.
+
+    Example:
+    older {"book": UPDATED 45 -> 46}, newer {"book": UPDATED 46 -> 47, "page": ADDED 12}
+    -> {"book": UPDATED 45 -> 47, "page": ADDED 12}
+    """
+    merged: Dict[str, Change] = dict(older)
+    for key, newer_change in newer.items():
+        older_change = merged.pop(key, None)
+        if older_change is None:
+            merged[key] = newer_change
+            continue
+        change = _mergeChange(older_change, newer_change)
+        if change is not None:
+            merged[key] = change
+    return merged
+
+
+def _mergeChange(older: Change, newer: Change) -> Optional[Change]:
+    old_present = older.type != ChangeType.ADDED
+    new_present = newer.type != ChangeType.REMOVED
+    old_value = older.old_value if old_present else None
+    new_value = newer.new_value if new_present else None
+
+    if not new_present:
+        if not old_present:
+            return None
+        return Change(type=ChangeType.REMOVED, old_value=old_value, new_value=None)
+    if old_value is None:
+        if new_value is None:
+            return None
+        return Change(type=ChangeType.ADDED, old_value=None, new_value=new_value)
+    if old_value == new_value:
+        return None
+    return Change(type=ChangeType.UPDATED, old_value=old_value, new_value=new_value)
+
+
+def _nowMilliseconds() -> int:
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
@@ -1,48 +1,450 @@
 from models.property_notification import PropertyNotification, ChangeType, Change
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Collection, FrozenSet, Iterable, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from firebase_admin import firestore
 from datetime import datetime, timezone
+from instrumentation import InvocationMetrics, NOOP_METRICS
+from sendNotificationToTopic.helpers.batchWrite import (
+    BatchWriteError,
+    commitInBatches,
+    createInBatches,
+)
+from sendNotificationToTopic.helpers.idempotency import notificationDocumentId
+from sendNotificationToTopic.helpers import shardedFanOut, subscriptionCache, unreadCounter
+
+# Firestore allows at most 30 values in one array_contains_any or in filter.
+ARRAY_CONTAINS_ANY_LIMIT = 30
+IN_FILTER_LIMIT = 30
+# Count aggregations findLargeProperties runs at a time.
+MAX_PARALLEL_COUNTS = 10
 
 def createInAppNotifications(
-    change_payload: Dict[str, Change], property_id: str
-) -> None:
+    change_payload: Dict[str, Change],
+    property_id: str,
+    metrics: InvocationMetrics = NOOP_METRICS,
+    notification_key: Optional[str] = None,
+) -> int:
     """
     Add new notification documents to property_notification collection in firestore.
     The number of user subscribes to this propperty = The number of notification created.
+
+    Subscribers come from the warm-instance subscription cache, which costs one
+    version read when it is current. With the cache disabled, or for a
+    property too large to cache, only subscribers whose alertPreferences
+    overlap the changed fields are read.
+    Documents are created with batched commits instead of one add() per subscriber.
+    With a notification_key (the triggering event ID) document IDs are
+    deterministic, so a retried event skips the documents it already created
+    and keeps their isRead state.
+
+    Above SHARDED_FAN_OUT_THRESHOLD matching subscribers nothing is written
+    here, the fan-out is split into fanOutNotificationShard tasks instead.
+    Returns the number of notifications created. When sharded, the number of
+    matching subscribers seen, which stops at SHARDED_FAN_OUT_THRESHOLD + 1
+    unless they came from the cache.
     """
     db = firestore.client()
-    subscriptions_of_this_property = (
-        db.collection("subscriptions")
-        .where("propertyId", "==", property_id)
-        .where("isSubscribed", "==", True)
-        .stream()
-    )
-
     dt = datetime.now(timezone.utc)
     current_time_in_milliseconds = int(dt.timestamp() * 1000)
-    for sub in subscriptions_of_this_property:
-        sub_data = sub.to_dict()
+    subscribers_by_preferences = None
+    with metrics.stage("subscriptionQuery"):
+        if subscriptionCache.SUBSCRIPTION_CACHE_ENABLED:
+            subscribers_by_preferences = subscriptionCache.cachedSubscribersByPreferences(
+                db, property_id, metrics
+            )
+        if subscribers_by_preferences is not None:
+            matching_count = countMatchingSubscribers(subscribers_by_preferences, change_payload)
+        else:
+            # One past the threshold is enough to know the fan-out gets sharded.
+            subscriptions = querySubscriptionsForChanges(
+                db,
+                property_id,
+                list(change_payload.keys()),
+                metrics,
+                limit=shardedFanOut.SHARDED_FAN_OUT_THRESHOLD + 1,
+            )
+            matching_count = len(subscriptions)
+            if matching_count <= shardedFanOut.SHARDED_FAN_OUT_THRESHOLD:
+                subscribers_by_preferences = groupSubscribersByPreferences(subscriptions)
+
+    if matching_count > shardedFanOut.SHARDED_FAN_OUT_THRESHOLD:
+        with metrics.stage("shardScheduling"):
+            shardedFanOut.scheduleShardedFanOut(
+                db,
+                change_payload,
+                property_id,
+                current_time_in_milliseconds,
+                notification_key,
+                metrics,
+            )
+        metrics.count("fanOutSize", matching_count)
+        return matching_count
+
+    notifications_collection = db.collection("property_notifications")
+    with metrics.stage("preferenceMatching"):
+        writes = buildNotificationWrites(
+            notifications_collection,
+            change_payload,
+            property_id,
+            current_time_in_milliseconds,
+            subscribers_by_preferences,
+            notification_key,
+        )
+    metrics.count("preferenceSets", len(subscribers_by_preferences))
+    metrics.count("fanOutSize", len(writes))
+    return commitNotificationWrites(db, writes, metrics)
+
+
+def createInAppNotificationsForShard(
+    db,
+    job: Dict[str, Any],
+    shard_index: int,
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> int:
+    """Write the in-app notifications of one shard of a sharded fan-out job.
+
+    Uses the changes and creation time stored on the job, so every shard and
+    every retry of a shard builds identical documents.
+    Returns the number of notifications written.
+    """
+    change_payload = {
+        key: Change.from_firestore(value) for key, value in (job.get("changes") or {}).items()
+    }
+    with metrics.stage("subscriptionQuery"):
+        metrics.count("firestoreRpcs")
+        subscriptions = [
+            sub.to_dict() for sub in shardedFanOut.shardQuery(db, job, shard_index).stream()
+        ]
+    metrics.count("subscriptionsRead", len(subscriptions))
+
+    with metrics.stage("preferenceMatching"):
+        # The shard reads every active subscription, not only matching ones.
+        subscribers_by_preferences = groupSubscribersByPreferences(
+            sub for sub in subscriptions if sub.get("alertPreferences")
+        )
+        writes = buildNotificationWrites(
+            db.collection("property_notifications"),
+            change_payload,
+            job["propertyId"],
+            job["createdAt"],
+            subscribers_by_preferences,
+            job.get("notificationKey"),
+        )
+    metrics.count("fanOutSize", len(writes))
+    return commitNotificationWrites(db, writes, metrics)
+
+
+def createInAppNotificationsForProperties(
+    db,
+    payloads: Dict[str, Dict[str, Change]],
+    notification_keys: Dict[str, str],
+    metrics: InvocationMetrics = NOOP_METRICS,
+    created_at: Optional[Dict[str, int]] = None,
+) -> Tuple[int, Dict[str, str]]:
+    """Fan out the in-app notifications of many properties with grouped reads and writes.
+
+    Properties are handled IN_FILTER_LIMIT at a time. Properties with more
+    than SHARDED_FAN_OUT_THRESHOLD active subscriptions are found first with
+    count aggregations. Their matching subscribers are read with
+    querySubscriptionsForChanges, up to one past the threshold, and above it
+    they are handed to the sharded fan-out. The other properties of the group
+    share one subscription query with an ``in`` filter, so a group never
+    reads more than IN_FILTER_LIMIT x SHARDED_FAN_OUT_THRESHOLD subscriptions
+    at once. The notifications of the whole group share batched commits.
+    Document IDs use each property's key from ``notification_keys``, and
+    ``created_at`` can fix each property's creation time, so a retried group
+    creates the same documents and schedules the same sharded jobs.
+
+    Returns:
+        The number of notifications created or scheduled, and the error per
+        property whose group failed. A failed group counts nothing.
+    """
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    created_at = created_at or {}
+    notifications_collection = db.collection("property_notifications")
+    property_ids = list(payloads)
+    written = 0
+    failed: Dict[str, str] = {}
+    for start in range(0, len(property_ids), IN_FILTER_LIMIT):
+        group = property_ids[start:start + IN_FILTER_LIMIT]
+        try:
+            with metrics.stage("subscriptionQuery"):
+                large = findLargeProperties(db, group, metrics)
+                subscribers_by_property = querySubscriptionsForProperties(
+                    db, [property_id for property_id in group if property_id not in large], metrics
+                )
+            writes = []
+            scheduled = 0
+            for property_id in group:
+                change_payload = payloads[property_id]
+                notification_key = notification_keys[property_id]
+                property_created_at = created_at.get(property_id, now)
+                if property_id in large:
+                    with metrics.stage("subscriptionQuery"):
+                        subscriptions = querySubscriptionsForChanges(
+                            db,
+                            property_id,
+                            list(change_payload.keys()),
+                            metrics,
+                            limit=shardedFanOut.SHARDED_FAN_OUT_THRESHOLD + 1,
+                        )
+                    if len(subscriptions) > shardedFanOut.SHARDED_FAN_OUT_THRESHOLD:
+                        with metrics.stage("shardScheduling"):
+                            shardedFanOut.scheduleShardedFanOut(
+                                db,
+                                change_payload,
+                                property_id,
+                                property_created_at,
+                                notification_key,
+                                metrics,
+                            )
+                        scheduled += len(subscriptions)
+                        continue
+                    subscribers_by_preferences = groupSubscribersByPreferences(subscriptions)
+                else:
+                    subscribers_by_preferences = subscribers_by_property.get(property_id, {})
+                with metrics.stage("preferenceMatching"):
+                    writes.extend(buildNotificationWrites(
+                        notifications_collection,
+                        change_payload,
+                        property_id,
+                        property_created_at,
+                        subscribers_by_preferences,
+                        notification_key,
+                    ))
+            metrics.count("fanOutSize", len(writes) + scheduled)
+            # Counted only once the whole group went through.
+            written += commitNotificationWrites(db, writes, metrics) + scheduled
+        except Exception as e:
+            failed.update({property_id: str(e) for property_id in group})
+    return written, failed
+
+
+def findLargeProperties(
+    db,
+    property_ids: List[str],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> Set[str]:
+    """Properties with more than SHARDED_FAN_OUT_THRESHOLD active subscriptions.
+
+    One count aggregation per property, limited to one past the threshold so
+    it never costs more than that many index entries. Runs up to
+    MAX_PARALLEL_COUNTS aggregations at a time.
+    """
+    limit = shardedFanOut.SHARDED_FAN_OUT_THRESHOLD + 1
+
+    def count(property_id: str) -> int:
+        metrics.count("firestoreRpcs")
+        query = shardedFanOut.activeSubscriptionsQuery(db, property_id).limit(limit)
+        return int(query.count().get()[0][0].value)
+
+    if not property_ids:
+        return set()
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_COUNTS, len(property_ids))) as executor:
+        counts = list(executor.map(count, property_ids))
+    return {
+        property_id
+        for property_id, active in zip(property_ids, counts)
+        if active > shardedFanOut.SHARDED_FAN_OUT_THRESHOLD
+    }
+
+
+def commitNotificationWrites(
+    db,
+    writes: List[Tuple[Any, Dict[str, Any]]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> int:
+    """Create notification documents, then bump the recipients' unread counters.
+
+    Documents that already exist are kept as they are, see createInBatches.
+    Only newly created documents count as unread, so a redelivered or
+    retried fan-out does not inflate the badge. When some batches fail, the
+    counters of the ones that landed are still bumped before raising.
+    Counter writes are best effort. A failure is recorded in the metrics and
+    does not fail the fan-out, recountUnread repairs the counter.
+    Returns the number of notifications created.
+    """
+    try:
+        with metrics.stage("firestoreWrites"):
+            created = createInBatches(db, writes, metrics)
+    except BatchWriteError as e:
+        incrementUnreadCounters(db, e.written, metrics)
+        raise
+    incrementUnreadCounters(db, created, metrics)
+    return len(created)
+
+
+def incrementUnreadCounters(
+    db,
+    created: List[Tuple[Any, Dict[str, Any]]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> None:
+    """Best effort +1 on the unread counter of every created notification's user."""
+    user_ids = [data["userId"] for _, data in created if data.get("userId") is not None]
+    if not user_ids:
+        return
+    try:
+        with metrics.stage("unreadCounters"):
+            commitInBatches(
+                db, unreadCounter.unreadCounterWrites(db, user_ids), metrics, merge=True
+            )
+    except Exception as e:
+        metrics.count("unreadCounterFailures")
+        metrics.label(unreadCounterError=str(e))
+
+
+def countMatchingSubscribers(
+    subscribers_by_preferences: Dict[FrozenSet[str], List[str]],
+    change_payload: Dict[str, Change],
+) -> int:
+    """Number of subscribers whose preferences overlap the changed fields."""
+    return sum(
+        len(user_ids)
+        for preferences, user_ids in subscribers_by_preferences.items()
+        if not preferences.isdisjoint(change_payload.keys())
+    )
+
+
+def buildNotificationWrites(
+    notifications_collection,
+    change_payload: Dict[str, Change],
+    property_id: str,
+    created_at: int,
+    subscribers_by_preferences: Dict[FrozenSet[str], List[str]],
+    notification_key: Optional[str] = None,
+) -> List[Tuple[Any, Dict[str, Any]]]:
+    """Build one (document reference, data) write per matching subscriber."""
+    writes = []
+    for preferences, user_ids in subscribers_by_preferences.items():
         matched_changes: Dict[str, Change] = ChangeAndPreferenceUnion(
-            change_payload, sub_data.get("alertPreferences")
+            change_payload, preferences
         )
         if(len(matched_changes) == 0):
             continue
+        # Encode once per distinct preference set, then only swap the userId.
         notification = PropertyNotification(
             propertyId=property_id,
-            createdAt=current_time_in_milliseconds,
+            createdAt=created_at,
             changes=matched_changes,
-            userId=sub_data.get("userId"),
+            userId=None,
             isRead=False,
             readAt=None,
         )
-        try:
-            db.collection("property_notifications").add(notification.to_firestore())
-        except Exception as e:
-            raise e
+        encoded_notification = notification.to_firestore()
+        for user_id in user_ids:
+            notification_data = dict(encoded_notification)
+            if user_id is not None:
+                notification_data["userId"] = user_id
+            if notification_key is not None and user_id is not None:
+                document_ref = notifications_collection.document(
+                    notificationDocumentId(notification_key, user_id)
+                )
+            else:
+                document_ref = notifications_collection.document()
+            writes.append((document_ref, notification_data))
+    return writes
+
+
+def querySubscriptionsForChanges(
+    db,
+    property_id: str,
+    changed_fields: List[str],
+    metrics: InvocationMetrics = NOOP_METRICS,
+    limit: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Fetch active subscriptions whose alertPreferences contain a changed field.
+
+    The filter runs server side with array_contains_any, split into chunks of
+    ARRAY_CONTAINS_ANY_LIMIT fields. A subscription matching several chunks is
+    returned once. Only userId and alertPreferences are fetched.
+    With a limit, no chunk reads more than that and at most limit distinct
+    subscriptions are returned.
+    """
+    subscriptions: Dict[str, Dict[str, Any]] = {}
+    for start in range(0, len(changed_fields), ARRAY_CONTAINS_ANY_LIMIT):
+        if limit is not None and len(subscriptions) >= limit:
+            break
+        fields_chunk = changed_fields[start:start + ARRAY_CONTAINS_ANY_LIMIT]
+        query = (
+            db.collection("subscriptions")
+            .where("propertyId", "==", property_id)
+            .where("isSubscribed", "==", True)
+            .where("alertPreferences", "array_contains_any", fields_chunk)
+            .select(["userId", "alertPreferences"])
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        metrics.count("firestoreRpcs")
+        for sub in query.stream():
+            if sub.id not in subscriptions:
+                subscriptions[sub.id] = sub.to_dict()
+                if limit is not None and len(subscriptions) >= limit:
+                    break
+    metrics.count("subscriptionsRead", len(subscriptions))
+    return list(subscriptions.values())
+
+
+def querySubscriptionsForProperties(
+    db,
+    property_ids: List[str],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> Dict[str, Dict[FrozenSet[str], List[str]]]:
+    """Active subscribers of up to IN_FILTER_LIMIT properties with one ``in`` query.
+
+    Subscriptions without alertPreferences cannot match a change and are left out.
+
+    Example:
+    {"property1": {frozenset({"book", "page"}): ["user1"]}, "property2": {...}}
+    """
+    if not property_ids:
+        return {}
+    query = (
+        db.collection("subscriptions")
+        .where("propertyId", "in", property_ids)
+        .where("isSubscribed", "==", True)
+        .select(["propertyId", "userId", "alertPreferences"])
+    )
+    metrics.count("firestoreRpcs")
+    subscribers_by_property: Dict[str, Dict[FrozenSet[str], List[str]]] = {}
+    # Interned so subscribers with the same preferences share one frozenset.
+    preference_sets: Dict[FrozenSet[str], FrozenSet[str]] = {}
+    read = 0
+    for sub in query.stream():
+        read += 1
+        sub_data = sub.to_dict()
+        preferences = sub_data.get("alertPreferences")
+        if not preferences:
+            continue
+        key = frozenset(preferences)
+        key = preference_sets.setdefault(key, key)
+        subscribers_by_property.setdefault(sub_data.get("propertyId"), {}).setdefault(
+            key, []
+        ).append(sub_data.get("userId"))
+    metrics.count("subscriptionsRead", read)
+    return subscribers_by_property
+
+
+def groupSubscribersByPreferences(
+    subscriptions: Iterable[Dict[str, Any]]
+) -> Dict[FrozenSet[str], List[str]]:
+    """Index subscriber user IDs by their set of alertPreferences.
+
+    Example:
+    {frozenset({"book", "page"}): ["user1", "user7"], frozenset({"remark1"}): ["user2"]}
+    """
+    subscribers_by_preferences: Dict[FrozenSet[str], List[str]] = {}
+    for sub_data in subscriptions:
+        preferences = sub_data.get("alertPreferences")
+        if preferences is None:
+            raise Exception("alertPreference is None while isSubscribed is True")
+        subscribers_by_preferences.setdefault(frozenset(preferences), []).append(
+            sub_data.get("userId")
+        )
+    return subscribers_by_preferences
 
 
 def ChangeAndPreferenceUnion(
-    changes_payload: Dict[str, Change], preferences: List[str]
+    changes_payload: Dict[str, Change], preferences: Collection[str]
 ) -> Dict[str, Change]:
     if changes_payload is None:
         raise Exception(
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Dict, Any, Collection, List, Mapping, Optional
+from models.property_notification import Change
+from instrumentation import InvocationMetrics, NOOP_METRICS
+from sendNotificationToTopic.helpers.createInAppNotification import createInAppNotifications
+from sendNotificationToTopic.helpers.sendPushNotification import (
+    PushDeliveryError,
+    sendPushNotifications,
+)
+
+DISPATCH_STAGES = frozenset({"push", "inApp"})
+
+
+def dispatchNotifications(
+    changes_payload: Mapping[str, Change],
+    property_id: str,
+    metrics: InvocationMetrics = NOOP_METRICS,
+    stages: Optional[Collection[str]] = None,
+    notification_key: Optional[str] = None,
+    skip_push_targets: Collection[str] = (),
+) -> Dict[str, Dict[str, Any]]:
+    """Run push delivery and in-app notification creation concurrently.
+
+    Both stages receive the same read-only view of the payload (``Change`` is
+    frozen), so neither can affect the other. A failure in one stage does not
+    stop the other.
+
+    ``stages`` limits the run to a subset of DISPATCH_STAGES, which lets a
+    retried event skip what already finished, ``skip_push_targets`` the push
+    targets an earlier attempt delivered. ``notification_key`` makes the
+    in-app document IDs deterministic. A failed push stage keeps the result
+    per target, so the caller can record the ones that were delivered.
+
+    Returns:
+        Dict[str, Dict[str, Any]]
+
+    Example:
+    {"push": {"success": False, "error": "1/2 push targets failed, ...",
+              "result": {"property_1_all": {"success": True, ...}, ...}},
+    "inApp": {"success": False, "error": "Deadline Exceeded"}}
+    """
+    payload = MappingProxyType(dict(changes_payload))
+    runners = {
+        "push": lambda: sendPushNotifications(
+            payload, property_id, metrics, skip_targets=skip_push_targets
+        ),
+        "inApp": lambda: createInAppNotifications(
+            payload, property_id, metrics, notification_key
+        ),
+    }
+    if stages is not None:
+        runners = {name: run for name, run in runners.items() if name in stages}
+    if not runners:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(runners)) as executor:
+        futures = {name: executor.submit(run) for name, run in runners.items()}
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name, future in futures.items():
+        try:
+            results[name] = {"success": True, "result": future.result()}
+        except PushDeliveryError as e:
+            results[name] = {"success": False, "error": str(e), "result": e.results}
+        except Exception as e:
+            results[name] = {"success": False, "error": str(e)}
+    return results
+
+
+def deliveredPushTargets(results: Dict[str, Dict[str, Any]]) -> List[str]:
+    """Push targets a failed push stage did deliver. Empty if the stage did not fail."""
+    push = results.get("push") or {}
+    if push.get("success", True):
+        return []
+    return [target for target, result in (push.get("result") or {}).items() if result["success"]]
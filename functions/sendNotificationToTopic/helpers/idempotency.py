@@ -0,0 +1,93 @@
+"""Per-event progress markers that let a retried delivery skip finished stages.
+
+The guard is not atomic: eventProgress reads the marker and
+markStagesComplete writes it after the stages ran, with nothing in
+between. Two deliveries of the same event running concurrently both read
+no progress and both run every stage. In-app documents have deterministic
+IDs and are only created once, but the push stage is sent twice. The
+guard covers sequential retries and redeliveries, not concurrent ones.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Collection, FrozenSet, NamedTuple, Set
+from firebase_admin import firestore
+
+# Marker documents carry expireAt, a Firestore TTL policy deletes them after
+# this long. Longer than any trigger redelivery.
+PROCESSED_EVENTS_COLLECTION = "processed_events"
+EVENT_MARKER_TTL = timedelta(days=2)
+# Events remembered by a warm instance without a Firestore read.
+LOCAL_CACHE_SIZE = 2048
+
+
+class EventProgress(NamedTuple):
+    stages: FrozenSet[str]
+    # Push topics or conditions already delivered while the push stage as a whole failed.
+    sent_push_targets: FrozenSet[str]
+
+
+NO_PROGRESS = EventProgress(frozenset(), frozenset())
+
+_recent_events: "OrderedDict[str, EventProgress]" = OrderedDict()
+_recent_events_lock = threading.Lock()
+
+
+def eventProgress(db, event_id: str) -> EventProgress:
+    """Return the finished stages and delivered push targets of an event.
+
+    A warm instance answers from its in-memory LRU. Otherwise one marker
+    document is read, which other instances share.
+    """
+    with _recent_events_lock:
+        progress = _recent_events.get(event_id)
+        if progress is not None:
+            _recent_events.move_to_end(event_id)
+            return progress
+
+    snapshot = db.collection(PROCESSED_EVENTS_COLLECTION).document(event_id).get()
+    progress = NO_PROGRESS
+    if snapshot.exists:
+        marker = snapshot.to_dict()
+        progress = EventProgress(
+            frozenset(stage for stage, done in (marker.get("stages") or {}).items() if done),
+            frozenset(marker.get("pushTargets") or ()),
+        )
+    _remember(event_id, progress)
+    return progress
+
+
+def markStagesComplete(
+    db, event_id: str, stages: Set[str], sent_push_targets: Collection[str] = ()
+) -> None:
+    """Record finished stages and delivered push targets locally and in the shared marker document."""
+    if not stages and not sent_push_targets:
+        return
+    now = datetime.now(timezone.utc)
+    marker = {
+        "stages": {stage: True for stage in stages},
+        "updatedAt": now,
+        "expireAt": now + EVENT_MARKER_TTL,
+    }
+    if sent_push_targets:
+        marker["pushTargets"] = firestore.ArrayUnion(list(sent_push_targets))
+    db.collection(PROCESSED_EVENTS_COLLECTION).document(event_id).set(marker, merge=True)
+    with _recent_events_lock:
+        previous = _recent_events.get(event_id, NO_PROGRESS)
+    _remember(event_id, EventProgress(
+        previous.stages | frozenset(stages),
+        previous.sent_push_targets | frozenset(sent_push_targets),
+    ))
+
+
+def notificationDocumentId(notification_key: str, user_id: str) -> str:
+    """Deterministic in-app notification ID, so a repeated create finds the document instead of duplicating it."""
+    return f"{notification_key}_{user_id}".replace("/", "_")
+
+
+def _remember(event_id: str, progress: EventProgress) -> None:
+    with _recent_events_lock:
+        _recent_events[event_id] = progress
+        _recent_events.move_to_end(event_id)
+        while len(_recent_events) > LOCAL_CACHE_SIZE:
+            _recent_events.popitem(last=False)
@@ -1,47 +1,196 @@
+from enum import Enum
 from firebase_admin import firestore
 from firebase_admin import messaging, exceptions
-from typing import Dict, List, Any
+from typing import Collection, Dict, List, Any, Optional, Tuple
 from models.property_notification import PropertyNotification, ChangeType, Change
+from instrumentation import InvocationMetrics, NOOP_METRICS
+
+# FCM rejects send_each calls with more than 500 messages.
+FCM_BATCH_LIMIT = 500
+# FCM allows at most 5 topics in one condition expression.
+FCM_CONDITION_TOPIC_LIMIT = 5
+
+
+class DeliveryMode(Enum):
+    # One message per topic. A device on several topics gets several copies.
+    TOPIC = "topic"
+    # Topics OR'd into condition expressions, one message per condition.
+    CONDITION = "condition"
+
+
+DEFAULT_DELIVERY_MODE = DeliveryMode.CONDITION
+
+
+class PushDeliveryError(Exception):
+    """Some push targets failed. ``results`` holds the result of every target that was sent."""
+
+    def __init__(self, results: Dict[str, Dict[str, Any]]):
+        failures = {
+            target: result["error"] for target, result in results.items() if not result["success"]
+        }
+        first_target = next(iter(failures))
+        super().__init__(
+            f"{len(failures)}/{len(results)} push targets failed, "
+            f"{first_target}: {failures[first_target]}"
+        )
+        self.results = results
+
 
 def sendPushNotifications(
-    changes_payload: Dict[str, Change], property_id: str
-) -> None:
-    """Send Push Notification using FCM"""
-    changes_payload = payloadToString(changes_payload)
-    sendToFieldSpecificTopics(changes_payload, property_id)
-    sendToAllFieldTopic(changes_payload, property_id)
-
-
-def sendToFieldSpecificTopics(changes_payload: Dict[str, str], property_id: str):
-    try:
-        changes_payload["propertyId"] = property_id
-        for key, value in changes_payload.items():
-            if(key == "propertyId"):
+    changes_payload: Dict[str, Change],
+    property_id: str,
+    metrics: InvocationMetrics = NOOP_METRICS,
+    mode: Optional[DeliveryMode] = None,
+    skip_targets: Collection[str] = (),
+) -> Dict[str, Dict[str, Any]]:
+    """Send Push Notification using FCM.
+
+    Every field-specific topic and the ``property_{propertyId}_all`` topic are
+    sent together through ``messaging.send_each``. In CONDITION mode the topics
+    are packed into condition expressions, so N topics need ceil(N / 5) sends.
+    ``mode`` defaults to DEFAULT_DELIVERY_MODE. Targets in ``skip_targets``,
+    the ones an earlier attempt already delivered, are not sent again.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Result per topic or condition, see ``sendMessagesInBatches``.
+
+    Raises:
+        PushDeliveryError: If any target failed, after every target was tried.
+    """
+    all_messages = buildMessages(changes_payload, property_id, mode)
+    messages = [(target, message) for target, message in all_messages if target not in skip_targets]
+    metrics.count("pushTargetsSkipped", len(all_messages) - len(messages))
+    with metrics.stage("fcmSend"):
+        results = sendMessagesInBatches(messages, metrics)
+    if any(not result["success"] for result in results.values()):
+        raise PushDeliveryError(results)
+    return results
+
+
+def sendPushNotificationsForProperties(
+    payloads: Dict[str, Dict[str, Change]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+    mode: Optional[DeliveryMode] = None,
+    skip_targets: Collection[str] = (),
+) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Send the messages of many properties through one ``sendMessagesInBatches`` run.
+
+    Messages of different properties share send_each chunks, so N properties
+    with a few topics each need about N * topics / 500 calls instead of N.
+    Targets in ``skip_targets`` were delivered before and are not sent again.
+    Unlike sendPushNotifications, failed targets are only reported.
+
+    Returns:
+        Dict[str, Dict[str, Dict[str, Any]]]: Per property, the result per topic or condition.
+    """
+    messages: List[Tuple[str, messaging.Message]] = []
+    property_by_target: Dict[str, str] = {}
+    for property_id, changes_payload in payloads.items():
+        for target, message in buildMessages(changes_payload, property_id, mode):
+            if target in skip_targets:
                 continue
-            topic_field_specific = f"property_{property_id}_{key}"
-            message_field_specific = messaging.Message(
-                data=changes_payload,
-                topic=topic_field_specific,
-            )
-            response = messaging.send(message_field_specific)
-            print(
-                f"Successfully sent notification to topic {topic_field_specific}: {response}"
-            )
-    except Exception as e:
-        raise e
+            messages.append((target, message))
+            property_by_target[target] = property_id
+    with metrics.stage("fcmSend"):
+        results = sendMessagesInBatches(messages, metrics)
+    results_by_property: Dict[str, Dict[str, Dict[str, Any]]] = {
+        property_id: {} for property_id in payloads
+    }
+    for target, result in results.items():
+        results_by_property[property_by_target[target]][target] = result
+    return results_by_property
+
+
+def buildMessages(
+    changes_payload: Dict[str, Change],
+    property_id: str,
+    mode: Optional[DeliveryMode] = None,
+) -> List[Tuple[str, messaging.Message]]:
+    """Build the (target, message) pairs for one property in the given delivery mode."""
+    data = payloadToString(changes_payload)
+    if (mode or DEFAULT_DELIVERY_MODE) == DeliveryMode.CONDITION:
+        return buildConditionMessages(data, property_id)
+    return buildTopicMessages(data, property_id)
+
+
+def buildTopicMessages(
+    changes_payload: Dict[str, str], property_id: str
+) -> List[Tuple[str, messaging.Message]]:
+    """Build one message per field-specific topic plus one for the `_all` topic."""
+    data = dict(changes_payload)
+    data["propertyId"] = property_id
+    topics = topicsForChanges(changes_payload.keys(), property_id)
+    return [(topic, messaging.Message(data=data, topic=topic)) for topic in topics]
+
 
+def buildConditionMessages(
+    changes_payload: Dict[str, str], property_id: str
+) -> List[Tuple[str, messaging.Message]]:
+    """Build one message per group of up to FCM_CONDITION_TOPIC_LIMIT topics.
 
-def sendToAllFieldTopic(changes_payload: Dict[str, str], property_id: str):
-    try:
-        topic_all_fields = f"property_{property_id}_all"
-        message = messaging.Message(
-            data=changes_payload,
-            topic=topic_all_fields,
+    The `_all` topic goes into the first condition, so its subscribers, the
+    largest audience, get exactly one copy.
+
+    Example:
+    "'property_X_all' in topics || 'property_X_book' in topics || 'property_X_page' in topics"
+    """
+    data = dict(changes_payload)
+    data["propertyId"] = property_id
+    topics = topicsForChanges(changes_payload.keys(), property_id)
+    topics.insert(0, topics.pop())
+    messages = []
+    for start in range(0, len(topics), FCM_CONDITION_TOPIC_LIMIT):
+        condition = " || ".join(
+            f"'{topic}' in topics"
+            for topic in topics[start:start + FCM_CONDITION_TOPIC_LIMIT]
         )
-        response = messaging.send(message)
-        print(f"Successfully sent notification to topic {topic_all_fields}: {response}")
-    except Exception as e:
-        raise e
+        messages.append((condition, messaging.Message(data=data, condition=condition)))
+    return messages
+
+
+def topicsForChanges(fields, property_id: str) -> List[str]:
+    """Field-specific topics followed by the `_all` topic."""
+    topics = [f"property_{property_id}_{key}" for key in fields]
+    topics.append(f"property_{property_id}_all")
+    return topics
+
+
+def sendMessagesInBatches(
+    messages: List[Tuple[str, messaging.Message]],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> Dict[str, Dict[str, Any]]:
+    """Send messages with ``messaging.send_each`` in chunks of FCM_BATCH_LIMIT.
+
+    A failure on one message, or on a whole chunk, does not stop the others.
+
+    Returns:
+        Dict[str, Dict[str, Any]]
+
+    Example:
+    {"property_1_book": {"success": True, "messageId": "projects/.../messages/1"},
+    "property_1_all": {"success": False, "error": "Topic quota exceeded"}}
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    for start in range(0, len(messages), FCM_BATCH_LIMIT):
+        chunk = messages[start:start + FCM_BATCH_LIMIT]
+        metrics.count("fcmRpcs")
+        try:
+            batch_response = messaging.send_each([message for _, message in chunk])
+        except (exceptions.FirebaseError, ValueError) as e:
+            for target, _ in chunk:
+                results[target] = {"success": False, "error": str(e)}
+            continue
+        for (target, _), response in zip(chunk, batch_response.responses):
+            if response.success:
+                results[target] = {"success": True, "messageId": response.message_id}
+            else:
+                results[target] = {"success": False, "error": str(response.exception)}
+    failures = {target: result for target, result in results.items() if not result["success"]}
+    metrics.count("pushMessages", len(results))
+    metrics.count("pushFailures", len(failures))
+    for target, result in failures.items():
+        metrics.detail("pushFailure", target=target, error=result["error"])
+    return results
 
 
 def payloadToString(payload: Dict[str, Change]) -> Dict[str, str]:
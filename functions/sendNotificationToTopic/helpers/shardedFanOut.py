@@ -0,0 +1,173 @@
+import hashlib
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Mapping, Optional
+from firebase_admin import exceptions, firestore, functions
+from models.property_notification import Change
+from instrumentation import InvocationMetrics, NOOP_METRICS
+
+# Fan-outs to more matching subscribers than this are split into task-queue shards.
+SHARDED_FAN_OUT_THRESHOLD = 5000
+# Subscriptions read and written by one shard task.
+FAN_OUT_SHARD_SIZE = 2000
+FAN_OUT_JOBS_COLLECTION = "fan_out_jobs"
+FAN_OUT_TASK_FUNCTION = "fanOutNotificationShard"
+# Job documents carry expireAt, a Firestore TTL policy deletes them after this long.
+FAN_OUT_JOB_TTL = timedelta(days=2)
+
+
+def scheduleShardedFanOut(
+    db,
+    change_payload: Mapping[str, Change],
+    property_id: str,
+    created_at: int,
+    notification_key: Optional[str] = None,
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> int:
+    """Split a property's subscriptions into shards and enqueue one task per shard.
+
+    The job document holds the changes, the creation time and the shard
+    boundaries, so a task only carries the job ID and its shard index. With a
+    notification_key the job ID and task IDs are deterministic: a retried
+    event reuses the stored boundaries and the task queue drops the
+    duplicate tasks.
+
+    Returns:
+        int: Number of shards.
+    """
+    job_id = notification_key or uuid.uuid4().hex
+    job_ref = db.collection(FAN_OUT_JOBS_COLLECTION).document(job_id)
+    snapshot = job_ref.get()
+    metrics.count("firestoreRpcs")
+    if snapshot.exists:
+        shard_bounds = snapshot.to_dict().get("shardBounds") or []
+    else:
+        shard_bounds = planShardBounds(db, property_id, FAN_OUT_SHARD_SIZE, metrics)
+        now = datetime.now(timezone.utc)
+        job_ref.set({
+            "propertyId": property_id,
+            "createdAt": created_at,
+            "notificationKey": notification_key,
+            "changes": {key: change.to_firestore() for key, change in change_payload.items()},
+            "shardBounds": shard_bounds,
+            "shardCount": len(shard_bounds) + 1,
+            "completedShards": 0,
+            "writtenCount": 0,
+            "expireAt": now + FAN_OUT_JOB_TTL,
+        })
+        metrics.count("firestoreRpcs")
+
+    shard_count = len(shard_bounds) + 1
+    queue = functions.task_queue(FAN_OUT_TASK_FUNCTION)
+    for shard_index in range(shard_count):
+        options = None
+        if notification_key is not None:
+            options = functions.TaskOptions(task_id=shardTaskId(job_id, shard_index))
+        try:
+            queue.enqueue({"jobId": job_id, "shardIndex": shard_index}, options)
+        except exceptions.AlreadyExistsError:
+            continue
+        metrics.count("tasksEnqueued")
+    metrics.count("fanOutShards", shard_count)
+    metrics.label(fanOutJobId=job_id)
+    return shard_count
+
+
+def planShardBounds(
+    db, property_id: str, shard_size: int, metrics: InvocationMetrics = NOOP_METRICS
+) -> List[str]:
+    """Walk the property's active subscriptions by document ID and return shard boundaries.
+
+    Only document names are fetched. Each boundary is the last subscription
+    ID of a full shard, the final shard has no upper bound.
+
+    Example:
+    ["sub_1999", "sub_3999"] -> shards (, sub_1999], (sub_1999, sub_3999], (sub_3999, )
+    """
+    bounds: List[str] = []
+    cursor: Optional[str] = None
+    while True:
+        query = (
+            activeSubscriptionsQuery(db, property_id)
+            .select(["__name__"])
+            .limit(shard_size)
+        )
+        if cursor is not None:
+            query = query.start_after({"__name__": cursor})
+        metrics.count("firestoreRpcs")
+        page = [snapshot.id for snapshot in query.stream()]
+        if len(page) < shard_size:
+            return bounds
+        cursor = page[-1]
+        bounds.append(cursor)
+
+
+def activeSubscriptionsQuery(db, property_id: str):
+    """Active subscriptions of a property in document ID order."""
+    return (
+        db.collection("subscriptions")
+        .where("propertyId", "==", property_id)
+        .where("isSubscribed", "==", True)
+        .order_by("__name__")
+    )
+
+
+def shardQuery(db, job: Dict[str, Any], shard_index: int):
+    """Query for the subscriptions of one shard, only userId and alertPreferences."""
+    bounds = job.get("shardBounds") or []
+    if not 0 <= shard_index <= len(bounds):
+        raise ValueError(f"shardIndex {shard_index} out of range for {len(bounds) + 1} shards")
+    query = activeSubscriptionsQuery(db, job["propertyId"]).select(["userId", "alertPreferences"])
+    if shard_index > 0:
+        query = query.start_after({"__name__": bounds[shard_index - 1]})
+    if shard_index < len(bounds):
+        query = query.end_at({"__name__": bounds[shard_index]})
+    return query
+
+
+def readJob(db, job_id: str) -> Optional[Dict[str, Any]]:
+    snapshot = db.collection(FAN_OUT_JOBS_COLLECTION).document(job_id).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+def recordShardComplete(db, job_id: str, shard_index: int, written: int) -> bool:
+    """Mark a shard as done on its job document.
+
+    A shard reported twice, after a task retry, is only counted once.
+
+    Returns:
+        bool: True once every shard of the job has completed.
+    """
+    job_ref = db.collection(FAN_OUT_JOBS_COLLECTION).document(job_id)
+    return _recordShardComplete(db.transaction(), job_ref, str(shard_index), written)
+
+
+@firestore.transactional
+def _recordShardComplete(transaction, job_ref, shard_key: str, written: int) -> bool:
+    snapshot = job_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    job = snapshot.to_dict()
+    shards = job.get("shards") or {}
+    completed = job.get("completedShards", 0)
+    if shard_key in shards:
+        return completed >= job.get("shardCount", 1)
+    completed += 1
+    update = {
+        f"shards.{shard_key}": written,
+        "completedShards": firestore.Increment(1),
+        "writtenCount": firestore.Increment(written),
+    }
+    if completed >= job.get("shardCount", 1):
+        update["completedAt"] = datetime.now(timezone.utc)
+    transaction.update(job_ref, update)
+    return completed >= job.get("shardCount", 1)
+
+
+def isShardComplete(job: Dict[str, Any], shard_index: int) -> bool:
+    return str(shard_index) in (job.get("shards") or {})
+
+
+def shardTaskId(job_id: str, shard_index: int) -> str:
+    """Task IDs only allow [A-Za-z0-9_-] and should not share a sequential prefix, so hash them."""
+    return hashlib.sha256(f"{job_id}/{shard_index}".encode()).hexdigest()
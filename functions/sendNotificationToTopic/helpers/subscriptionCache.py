@@ -0,0 +1,184 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional
+from firebase_admin import firestore
+from instrumentation import InvocationMetrics, NOOP_METRICS
+from sendNotificationToTopic.helpers import shardedFanOut
+
+# One document per property, {"version": n}. Bumped by invalidateSubscriptionCache
+# whenever a subscription of the property is written.
+SUBSCRIPTION_VERSIONS_COLLECTION = "subscription_versions"
+# Subscribers kept by a warm instance across all properties, least recently
+# used properties are evicted first. An entry counts at least 1.
+SUBSCRIPTION_CACHE_MAX_SUBSCRIBERS = 100000
+# Upper bound on staleness if a version bump is ever lost.
+SUBSCRIPTION_CACHE_TTL_SECONDS = 300
+# False sends every fan-out through querySubscriptionsForChanges.
+SUBSCRIPTION_CACHE_ENABLED = True
+# Subscription fields that decide who gets a notification. Writes touching
+# none of them leave the cache valid.
+CACHED_SUBSCRIPTION_FIELDS = ("propertyId", "userId", "isSubscribed", "alertPreferences")
+
+
+class _CacheEntry(NamedTuple):
+    version: int
+    fetched_at: float
+    # Same shape as groupSubscribersByPreferences, so equal preference sets share one frozenset.
+    # None marks a property above SHARDED_FAN_OUT_THRESHOLD, which is never cached.
+    subscribers_by_preferences: Optional[Dict[FrozenSet[str], List[str]]]
+    size: int
+
+
+_cache: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+_cache_lock = threading.Lock()
+# Sum of the sizes of the entries in _cache.
+_cached_subscribers = 0
+
+
+def cachedSubscribersByPreferences(
+    db, property_id: str, metrics: InvocationMetrics = NOOP_METRICS
+) -> Optional[Dict[FrozenSet[str], List[str]]]:
+    """Active subscribers of a property indexed by their alertPreferences.
+
+    The property's version document is always read. If a warm instance holds
+    an entry for the same version that is younger than the TTL it is served
+    from memory, otherwise the active subscriptions are queried and cached.
+    The version is read before the query, so a subscription written while the
+    query runs bumps it past the cached one and the next call refetches.
+    The returned index is shared with the cache and must not be modified.
+
+    Properties with more than SHARDED_FAN_OUT_THRESHOLD active subscriptions
+    are not cached: the query stops one past the threshold and None is
+    returned until the version changes or the TTL expires. Callers then fall
+    back to querySubscriptionsForChanges.
+
+    Example:
+    {frozenset({"book", "page"}): ["user1", "user7"], frozenset({"remark1"}): ["user2"]}
+    """
+    version = readSubscriptionVersion(db, property_id)
+    metrics.count("firestoreRpcs")
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(property_id)
+        if (
+            entry is not None
+            and entry.version == version
+            and now - entry.fetched_at < SUBSCRIPTION_CACHE_TTL_SECONDS
+        ):
+            _cache.move_to_end(property_id)
+            metrics.count("subscriptionCacheHits")
+            return entry.subscribers_by_preferences
+
+    metrics.count("subscriptionCacheMisses")
+    subscribers_by_preferences = queryActiveSubscribers(
+        db, property_id, metrics, shardedFanOut.SHARDED_FAN_OUT_THRESHOLD
+    )
+    if subscribers_by_preferences is None:
+        metrics.count("subscriptionCacheSkipped")
+        size = 1
+    else:
+        size = max(1, sum(len(users) for users in subscribers_by_preferences.values()))
+    _store(property_id, _CacheEntry(version, now, subscribers_by_preferences, size))
+    return subscribers_by_preferences
+
+
+def _store(property_id: str, entry: _CacheEntry) -> None:
+    global _cached_subscribers
+    with _cache_lock:
+        previous = _cache.pop(property_id, None)
+        if previous is not None:
+            _cached_subscribers -= previous.size
+        _cache[property_id] = entry
+        _cached_subscribers += entry.size
+        while _cached_subscribers > SUBSCRIPTION_CACHE_MAX_SUBSCRIBERS and _cache:
+            _, evicted = _cache.popitem(last=False)
+            _cached_subscribers -= evicted.size
+
+
+def readSubscriptionVersion(db, property_id: str) -> int:
+    """Current subscription version of a property, 0 if it was never bumped."""
+    snapshot = db.collection(SUBSCRIPTION_VERSIONS_COLLECTION).document(property_id).get()
+    if not snapshot.exists:
+        return 0
+    return (snapshot.to_dict() or {}).get("version", 0)
+
+
+def queryActiveSubscribers(
+    db,
+    property_id: str,
+    metrics: InvocationMetrics = NOOP_METRICS,
+    max_subscriptions: Optional[int] = None,
+) -> Optional[Dict[FrozenSet[str], List[str]]]:
+    """Read every active subscription of a property, only userId and alertPreferences.
+
+    Subscriptions without alertPreferences cannot match a change and are left out.
+    With max_subscriptions at most one more is read, and None is returned
+    if the property has more than that.
+    """
+    query = (
+        db.collection("subscriptions")
+        .where("propertyId", "==", property_id)
+        .where("isSubscribed", "==", True)
+        .select(["userId", "alertPreferences"])
+    )
+    if max_subscriptions is not None:
+        query = query.limit(max_subscriptions + 1)
+    metrics.count("firestoreRpcs")
+    subscribers_by_preferences: Dict[FrozenSet[str], List[str]] = {}
+    # Interned so subscribers with the same preferences share one frozenset.
+    preference_sets: Dict[FrozenSet[str], FrozenSet[str]] = {}
+    read = 0
+    for sub in query.stream():
+        read += 1
+        sub_data = sub.to_dict()
+        preferences = sub_data.get("alertPreferences")
+        if not preferences:
+            continue
+        key = frozenset(preferences)
+        key = preference_sets.setdefault(key, key)
+        subscribers_by_preferences.setdefault(key, []).append(sub_data.get("userId"))
+    metrics.count("subscriptionsRead", read)
+    if max_subscriptions is not None and read > max_subscriptions:
+        return None
+    return subscribers_by_preferences
+
+
+def bumpSubscriptionVersions(
+    db, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]
+) -> List[str]:
+    """Bump the version of every property a subscription write can affect.
+
+    A subscription moved to another property invalidates both properties.
+    A write that leaves CACHED_SUBSCRIPTION_FIELDS unchanged bumps nothing.
+
+    Returns:
+        List[str]: The property IDs whose version was bumped.
+    """
+    before = before or {}
+    after = after or {}
+    if all(before.get(field) == after.get(field) for field in CACHED_SUBSCRIPTION_FIELDS):
+        return []
+    property_ids = []
+    for property_id in (before.get("propertyId"), after.get("propertyId")):
+        if isinstance(property_id, str) and property_id and property_id not in property_ids:
+            property_ids.append(property_id)
+    for property_id in property_ids:
+        db.collection(SUBSCRIPTION_VERSIONS_COLLECTION).document(property_id).set(
+            {"version": firestore.Increment(1)}, merge=True
+        )
+        invalidate(property_id)
+    return property_ids
+
+
+def invalidate(property_id: Optional[str] = None) -> None:
+    """Drop one property from this instance's cache, or everything without an ID."""
+    global _cached_subscribers
+    with _cache_lock:
+        if property_id is None:
+            _cache.clear()
+            _cached_subscribers = 0
+        else:
+            entry = _cache.pop(property_id, None)
+            if entry is not None:
+                _cached_subscribers -= entry.size
@@ -0,0 +1,173 @@
+import hashlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from firebase_admin import exceptions, firestore, messaging
+from instrumentation import InvocationMetrics, NOOP_METRICS
+from sendNotificationToTopic.helpers.batchWrite import FIRESTORE_BATCH_LIMIT, commitInBatches
+from sendNotificationToTopic.helpers.sendPushNotification import FCM_BATCH_LIMIT
+
+# fcm_tokens/{sha256(token)}: {"token", "topics", "updatedAt"} plus
+# {"dead": True, "deadReason"} once FCM reported the token as unusable.
+FCM_TOKENS_COLLECTION = "fcm_tokens"
+# Topic management reasons for a token that will never work again. FCM reports
+# the raw backend codes, the Admin SDKs of other languages map them to the
+# kebab-case codes.
+DEAD_TOKEN_REASONS = frozenset({
+    "NOT_FOUND",
+    "INVALID_ARGUMENT",
+    "registration-token-not-registered",
+    "invalid-argument",
+    "invalid-registration-token",
+})
+
+
+def tokenDocumentId(token: str) -> str:
+    """Tokens are long and may contain characters Firestore IDs do not allow, so hash them."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def isDeadTokenReason(reason: Any) -> bool:
+    return isinstance(reason, str) and (
+        reason in DEAD_TOKEN_REASONS
+        or reason.rsplit("/", 1)[-1] in DEAD_TOKEN_REASONS
+    )
+
+
+def recordTopicResults(
+    db,
+    tokens_by_topic: Dict[str, List[str]],
+    results: Dict[str, Dict[str, Any]],
+    subscribe: bool,
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> int:
+    """Update the token registry from a topic management run.
+
+    Successful pairs add the topic to, or remove it from, the token's
+    document. Tokens FCM reported dead are flagged for pruneDeadTokens.
+    One merged write per token.
+
+    Returns:
+        int: Number of tokens flagged dead.
+    """
+    failures: Dict[Tuple[str, str], str] = {
+        (topic, error["token"]): error["reason"]
+        for topic, result in results.items()
+        for error in result["errors"]
+    }
+    topics_by_token: Dict[str, List[str]] = {}
+    dead_tokens: Dict[str, str] = {}
+    for topic, tokens in tokens_by_topic.items():
+        for token in tokens:
+            reason = failures.get((topic, token))
+            if reason is None:
+                topics_by_token.setdefault(token, []).append(topic)
+            elif isDeadTokenReason(reason):
+                dead_tokens[token] = reason
+
+    now = datetime.now(timezone.utc)
+    collection = db.collection(FCM_TOKENS_COLLECTION)
+    writes = []
+    for token in dict.fromkeys(list(topics_by_token) + list(dead_tokens)):
+        data: Dict[str, Any] = {"token": token, "updatedAt": now}
+        topics = topics_by_token.get(token)
+        if topics:
+            data["topics"] = (
+                firestore.ArrayUnion(topics) if subscribe else firestore.ArrayRemove(topics)
+            )
+        if token in dead_tokens:
+            data["dead"] = True
+            data["deadReason"] = dead_tokens[token]
+        elif topics and subscribe:
+            # FCM just accepted the token, so it is not dead (anymore).
+            data["dead"] = False
+        writes.append((collection.document(tokenDocumentId(token)), data))
+    commitInBatches(db, writes, metrics, merge=True)
+    metrics.count("deadTokensFlagged", len(dead_tokens))
+    return len(dead_tokens)
+
+
+def tokenPage(
+    db, cursor: Optional[str] = None, metrics: InvocationMetrics = NOOP_METRICS
+) -> List[Any]:
+    """One page of registry documents, dead or not, in document ID order."""
+    query = (
+        db.collection(FCM_TOKENS_COLLECTION)
+        .order_by("__name__")
+        .select(["token", "topics", "dead"])
+        .limit(FIRESTORE_BATCH_LIMIT)
+    )
+    if cursor is not None:
+        query = query.start_after({"__name__": cursor})
+    metrics.count("firestoreRpcs")
+    return list(query.stream())
+
+
+def findDeadTokens(tokens: List[str], metrics: InvocationMetrics = NOOP_METRICS) -> Dict[str, str]:
+    """Check tokens with dry-run sends, in send_each chunks of FCM_BATCH_LIMIT.
+
+    A dry run is validated by FCM like a real send but delivers nothing.
+    UnregisteredError and InvalidArgumentError mark a token dead, the message
+    carries nothing but the token. Other errors, on a message or on a whole
+    chunk, leave the token to the next check.
+
+    Returns:
+        Dict[str, str]: token -> reason, for the dead tokens only.
+
+    Example:
+    {"t2": "NOT_FOUND", "t7": "INVALID_ARGUMENT"}
+    """
+    dead: Dict[str, str] = {}
+    unchecked = 0
+    for start in range(0, len(tokens), FCM_BATCH_LIMIT):
+        chunk = tokens[start:start + FCM_BATCH_LIMIT]
+        metrics.count("fcmRpcs")
+        try:
+            batch_response = messaging.send_each(
+                [messaging.Message(token=token) for token in chunk], dry_run=True
+            )
+        except (exceptions.FirebaseError, ValueError) as e:
+            unchecked += len(chunk)
+            metrics.label(tokenCheckError=str(e))
+            continue
+        for token, response in zip(chunk, batch_response.responses):
+            if response.success:
+                continue
+            if isinstance(
+                response.exception, (messaging.UnregisteredError, exceptions.InvalidArgumentError)
+            ):
+                dead[token] = response.exception.code
+            else:
+                unchecked += 1
+    metrics.count("tokensChecked", len(tokens) - unchecked)
+    metrics.count("tokensUnchecked", unchecked)
+    return dead
+
+
+def flagDeadTokens(
+    db,
+    references_by_token: Dict[str, Any],
+    reasons: Dict[str, str],
+    metrics: InvocationMetrics = NOOP_METRICS,
+) -> int:
+    """Flag registry documents dead with one merged write per token."""
+    now = datetime.now(timezone.utc)
+    writes = [
+        (references_by_token[token], {"dead": True, "deadReason": reason, "updatedAt": now})
+        for token, reason in reasons.items()
+    ]
+    commitInBatches(db, writes, metrics, merge=True)
+    metrics.count("deadTokensFlagged", len(writes))
+    return len(writes)
+
+
+def deleteRegistryDocuments(
+    db, references: List[Any], metrics: InvocationMetrics = NOOP_METRICS
+) -> int:
+    """Delete registry documents with WriteBatch commits of up to FIRESTORE_BATCH_LIMIT."""
+    for start in range(0, len(references), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for reference in references[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.delete(reference)
+        metrics.count("firestoreRpcs")
+        batch.commit()
+    return len(references)
@@ -0,0 +1,64 @@
+import random
+from typing import Any, Dict, Iterable, List, Tuple
+from firebase_admin import firestore
+from instrumentation import InvocationMetrics, NOOP_METRICS
+
+# unread_counters/{userId}/shards/{0..UNREAD_COUNTER_SHARDS-1}, each {"count": n}.
+# The unread count is the sum over the shards.
+UNREAD_COUNTERS_COLLECTION = "unread_counters"
+UNREAD_COUNTER_SHARDS = 10
+
+
+def counterShardRef(db, user_id: str, shard: int):
+    return (
+        db.collection(UNREAD_COUNTERS_COLLECTION)
+        .document(user_id)
+        .collection("shards")
+        .document(str(shard))
+    )
+
+
+def unreadCounterWrites(
+    db, user_ids: Iterable[str], amount: int = 1
+) -> List[Tuple[Any, Dict[str, Any]]]:
+    """Increment writes for commitInBatches(merge=True), one per user on a random shard.
+
+    Spreading a user's increments over shards keeps concurrent fan-outs from
+    contending on one document.
+    """
+    return [
+        (
+            counterShardRef(db, user_id, random.randrange(UNREAD_COUNTER_SHARDS)),
+            {"count": firestore.Increment(amount)},
+        )
+        for user_id in user_ids
+    ]
+
+
+def readUnreadCount(db, user_id: str, metrics: InvocationMetrics = NOOP_METRICS) -> int:
+    """Sum a user's counter shards with one aggregation query."""
+    shards = db.collection(UNREAD_COUNTERS_COLLECTION).document(user_id).collection("shards")
+    metrics.count("firestoreRpcs")
+    total = shards.sum("count").get()[0][0].value
+    return max(0, int(total or 0))
+
+
+def recountUnread(db, user_id: str, metrics: InvocationMetrics = NOOP_METRICS) -> int:
+    """Count the user's unread notifications and reset the shards to that value.
+
+    Repairs drift, for example from counter writes that failed or were
+    applied twice after a timed out commit.
+    """
+    query = (
+        db.collection("property_notifications")
+        .where("userId", "==", user_id)
+        .where("isRead", "==", False)
+    )
+    metrics.count("firestoreRpcs")
+    count = int(query.count().get()[0][0].value)
+    batch = db.batch()
+    for shard in range(UNREAD_COUNTER_SHARDS):
+        batch.set(counterShardRef(db, user_id, shard), {"count": count if shard == 0 else 0})
+    metrics.count("firestoreRpcs")
+    batch.commit()
+    return count
@@ -1,30 +1,49 @@
-from firebase_admin import messaging
+from firebase_admin import firestore, messaging
 import logging
 from firebase_functions import https_fn
 from flask import jsonify, request, Response
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+from instrumentation import InvocationMetrics
+from sendNotificationToTopic.helpers import tokenRegistry
+
+# FCM accepts at most 1,000 registration tokens per topic management call.
+FCM_TOPIC_TOKEN_LIMIT = 1000
+MAX_PARALLEL_TOPIC_REQUESTS = 10
+# Upper bound on token x topic pairs in one bulk request, counted as sent.
+MAX_TOKEN_TOPIC_PAIRS = 10000
+
+CORS_RESPONSE_HEADERS = {
+    "Access-Control-Allow-Origin": "*",  # Allow all origins
+}
+
+
+def corsPreflightResponse(
+    methods: str = "POST, OPTIONS", headers: str = "Content-Type"
+) -> Response:
+    return Response(
+        status=204,
+        headers={
+            "Access-Control-Allow-Origin": "*",  # Allow all origins
+            "Access-Control-Allow-Methods": methods,
+            "Access-Control-Allow-Headers": headers,
+            "Access-Control-Max-Age": "3600",
+        },
+    )
 
 @https_fn.on_request()
 def subscribeToTopic(req: https_fn.Request) -> Response:
     # Handle CORS preflight request
     if req.method == "OPTIONS":
-        return Response(
-            status=204,
-            headers={
-                "Access-Control-Allow-Origin": "*",  # Allow all origins
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type",
-                "Access-Control-Max-Age": "3600",
-            },
-        )
+        return corsPreflightResponse()
 
     # Add CORS headers to the response
-    response_headers = {
-        "Access-Control-Allow-Origin": "*",  # Allow all origins
-    }
+    response_headers = dict(CORS_RESPONSE_HEADERS)
+    metrics = InvocationMetrics("subscribeToTopic")
 
     try:
         # Log the request headers for debugging
-        logging.info(f"Request headers: {req.headers}")
+        logging.debug("Request headers: %s", req.headers)
 
         # Parse the JSON body
         data = req.get_json(silent=True) or {}
@@ -40,45 +59,44 @@ def subscribeToTopic(req: https_fn.Request) -> Response:
         if not isinstance(topic, str) or not topic:
             raise ValueError("topic must be a non-empty string")
 
-        response = messaging.subscribe_to_topic(fcm_token, topic)
-        logging.info(f"Subscribed {fcm_token} to topic {topic}")
+        metrics.label(topic=topic)
+        tokens_by_topic = {topic: [fcm_token]}
+        with metrics.stage("fcmTopicManagement"):
+            results = manageTopicsInBulk(tokens_by_topic, True, metrics, raise_call_errors=True)
+        metrics.count("topicManagementFailures", results[topic]["failureCount"])
+        recordTokenRegistry(tokens_by_topic, results, True, metrics)
 
         return jsonify({
-            "success": True,
+            "success": results[topic]["failureCount"] == 0,
             "message": f"Subscribed {fcm_token} to {topic}",
-            "response": str(response)
+            "response": results[topic]
         }), 200, response_headers
 
     except ValueError as ve:
-        logging.error(f"Invalid request: {str(ve)}")
+        logging.error("Invalid request: %s", ve)
+        metrics.label(error=str(ve))
         return jsonify({"error": str(ve)}), 400, response_headers
     except Exception as e:
-        logging.error(f"Error subscribing to topic: {str(e)}")
+        logging.error("Error subscribing to topic: %s", e)
+        metrics.label(error=str(e))
         return jsonify({"error": "Failed to subscribe to topic"}), 500, response_headers
+    finally:
+        metrics.emit()
     
 
 @https_fn.on_request()
 def unsubscribeFromTopic(req: https_fn.Request) -> Response:
     # Handle CORS preflight request
     if req.method == "OPTIONS":
-        return Response(
-            status=204,
-            headers={
-                "Access-Control-Allow-Origin": "*",  # Allow all origins
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type",
-                "Access-Control-Max-Age": "3600",
-            },
-        )
+        return corsPreflightResponse()
 
     # Add CORS headers to the response
-    response_headers = {
-        "Access-Control-Allow-Origin": "*",  # Allow all origins
-    }
+    response_headers = dict(CORS_RESPONSE_HEADERS)
+    metrics = InvocationMetrics("unsubscribeFromTopic")
 
     try:
         # Log the request headers for debugging
-        logging.info(f"Request headers: {req.headers}")
+        logging.debug("Request headers: %s", req.headers)
 
         # Parse the JSON body
         data = req.get_json(silent=True) or {}
@@ -94,18 +112,193 @@ def unsubscribeFromTopic(req: https_fn.Request) -> Response:
         if not isinstance(topic, str) or not topic:
             raise ValueError("topic must be a non-empty string")
 
-        response = messaging.unsubscribe_from_topic(fcm_token, topic)
-        logging.info(f"Unsubscribed {fcm_token} to topic {topic}")
+        metrics.label(topic=topic)
+        tokens_by_topic = {topic: [fcm_token]}
+        with metrics.stage("fcmTopicManagement"):
+            results = manageTopicsInBulk(tokens_by_topic, False, metrics, raise_call_errors=True)
+        metrics.count("topicManagementFailures", results[topic]["failureCount"])
+        recordTokenRegistry(tokens_by_topic, results, False, metrics)
 
         return jsonify({
-            "success": True,
+            "success": results[topic]["failureCount"] == 0,
             "message": f"Unsubscribed {fcm_token} to {topic}",
-            "response": str(response)
+            "response": results[topic]
         }), 200, response_headers
 
     except ValueError as ve:
-        logging.error(f"Invalid request: {str(ve)}")
+        logging.error("Invalid request: %s", ve)
+        metrics.label(error=str(ve))
         return jsonify({"error": str(ve)}), 400, response_headers
     except Exception as e:
-        logging.error(f"Error unsubscribing to topic: {str(e)}")
-        return jsonify({"error": "Failed to unsubscribe to topic"}), 500, response_headers
\ No newline at end of file
+        logging.error("Error unsubscribing to topic: %s", e)
+        metrics.label(error=str(e))
+        return jsonify({"error": "Failed to unsubscribe to topic"}), 500, response_headers
+    finally:
+        metrics.emit()
+
+
+@https_fn.on_request()
+def bulkSubscribeToTopics(req: https_fn.Request) -> Response:
+    """Subscribe many tokens to many topics in one request.
+
+    Body: {"operations": [{"tokens": ["token1", "token2"], "topics": ["property_1_book", "property_1_all"]}]}
+    """
+    return handleBulkTopicRequest(req, subscribe=True)
+
+
+@https_fn.on_request()
+def bulkUnsubscribeFromTopics(req: https_fn.Request) -> Response:
+    """Unsubscribe many tokens from many topics in one request. Same body as bulkSubscribeToTopics."""
+    return handleBulkTopicRequest(req, subscribe=False)
+
+
+def handleBulkTopicRequest(req: https_fn.Request, subscribe: bool) -> Response:
+    # Handle CORS preflight request
+    if req.method == "OPTIONS":
+        return corsPreflightResponse()
+
+    response_headers = dict(CORS_RESPONSE_HEADERS)
+    action = "subscribe" if subscribe else "unsubscribe"
+    metrics = InvocationMetrics("bulkSubscribeToTopics" if subscribe else "bulkUnsubscribeFromTopics")
+
+    try:
+        logging.debug("Request headers: %s", req.headers)
+
+        data = req.get_json(silent=True) or {}
+        if not data:
+            raise ValueError("Request body must be JSON")
+
+        tokens_by_topic = groupTokensByTopic(data.get("operations"))
+        metrics.count("topics", len(tokens_by_topic))
+        metrics.count("tokenTopicPairs", sum(len(tokens) for tokens in tokens_by_topic.values()))
+
+        with metrics.stage("fcmTopicManagement"):
+            results = manageTopicsInBulk(tokens_by_topic, subscribe, metrics)
+        failure_count = sum(result["failureCount"] for result in results.values())
+        metrics.count("topicManagementFailures", failure_count)
+        recordTokenRegistry(tokens_by_topic, results, subscribe, metrics)
+
+        return jsonify({
+            "success": failure_count == 0,
+            "results": results,
+        }), 200, response_headers
+
+    except ValueError as ve:
+        logging.error("Invalid request: %s", ve)
+        metrics.label(error=str(ve))
+        return jsonify({"error": str(ve)}), 400, response_headers
+    except Exception as e:
+        logging.error("Error during bulk %s: %s", action, e)
+        metrics.label(error=str(e))
+        return jsonify({"error": f"Failed to {action} topics"}), 500, response_headers
+    finally:
+        metrics.emit()
+
+
+def recordTokenRegistry(
+    tokens_by_topic: Dict[str, List[str]],
+    results: Dict[str, Dict[str, Any]],
+    subscribe: bool,
+    metrics: InvocationMetrics,
+) -> None:
+    """Keep the token -> topics registry in step with FCM, without failing the request."""
+    try:
+        with metrics.stage("tokenRegistry"):
+            tokenRegistry.recordTopicResults(
+                firestore.client(), tokens_by_topic, results, subscribe, metrics
+            )
+    except Exception as e:
+        logging.error("Failed to update token registry: %s", e)
+        metrics.label(tokenRegistryError=str(e))
+
+
+def groupTokensByTopic(operations: Any) -> Dict[str, List[str]]:
+    """Validate bulk operations and merge them into topic -> unique tokens.
+
+    Every operation adds len(tokens) x len(topics) pairs, duplicates
+    included. More than MAX_TOKEN_TOPIC_PAIRS in one request raise ValueError.
+
+    Example:
+    [{"tokens": ["t1", "t2"], "topics": ["a", "b"]}, {"tokens": ["t2"], "topics": ["a"]}]
+    -> {"a": ["t1", "t2"], "b": ["t1", "t2"]}
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a non-empty list")
+    tokens_by_topic: Dict[str, Dict[str, None]] = {}
+    pairs = 0
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError("each operation must be an object with tokens and topics")
+        tokens = operation.get("tokens")
+        topics = operation.get("topics")
+        if not isinstance(tokens, list) or not tokens or not all(
+            isinstance(token, str) and token for token in tokens
+        ):
+            raise ValueError("tokens must be a non-empty list of non-empty strings")
+        if not isinstance(topics, list) or not topics or not all(
+            isinstance(topic, str) and topic for topic in topics
+        ):
+            raise ValueError("topics must be a non-empty list of non-empty strings")
+        pairs += len(tokens) * len(topics)
+        if pairs > MAX_TOKEN_TOPIC_PAIRS:
+            raise ValueError(f"At most {MAX_TOKEN_TOPIC_PAIRS} token/topic pairs per request")
+        for topic in topics:
+            # dict keeps first-seen order and drops duplicate tokens.
+            tokens_by_topic.setdefault(topic, {}).update(dict.fromkeys(tokens))
+    return {topic: list(tokens) for topic, tokens in tokens_by_topic.items()}
+
+
+def manageTopicsInBulk(
+    tokens_by_topic: Dict[str, List[str]],
+    subscribe: bool,
+    metrics: InvocationMetrics,
+    raise_call_errors: bool = False,
+) -> Dict[str, Dict[str, Any]]:
+    """Call subscribe_to_topic/unsubscribe_from_topic in concurrent chunks of 1,000 tokens.
+
+    A call that fails as a whole, an FCM outage or an auth error, is
+    reported as a failure of each of its tokens. With ``raise_call_errors``
+    it raises instead, so single-token endpoints answer 500 like before.
+
+    Returns:
+        Dict[str, Dict[str, Any]]
+
+    Example:
+    {"property_1_all": {"successCount": 1, "failureCount": 1,
+                        "errors": [{"token": "t2", "reason": "NOT_FOUND"}]}}
+    """
+    manage = messaging.subscribe_to_topic if subscribe else messaging.unsubscribe_from_topic
+    calls: List[Tuple[str, List[str]]] = [
+        (topic, tokens[start:start + FCM_TOPIC_TOKEN_LIMIT])
+        for topic, tokens in tokens_by_topic.items()
+        for start in range(0, len(tokens), FCM_TOPIC_TOKEN_LIMIT)
+    ]
+
+    def run(call: Tuple[str, List[str]]) -> List[Dict[str, str]]:
+        topic, tokens = call
+        metrics.count("fcmRpcs")
+        try:
+            response = manage(tokens, topic)
+        except Exception as e:
+            if raise_call_errors:
+                raise
+            return [{"token": token, "reason": str(e)} for token in tokens]
+        return [
+            {"token": tokens[error.index], "reason": error.reason}
+            for error in response.errors
+        ]
+
+    results: Dict[str, Dict[str, Any]] = {
+        topic: {"successCount": 0, "failureCount": 0, "errors": []}
+        for topic in tokens_by_topic
+    }
+    if not calls:
+        return results
+    workers = min(MAX_PARALLEL_TOPIC_REQUESTS, len(calls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (topic, tokens), errors in zip(calls, executor.map(run, calls)):
+            result = results[topic]
+            result["successCount"] += len(tokens) - len(errors)
+            result["failureCount"] += len(errors)
+            result["errors"].extend(errors)
+    return results
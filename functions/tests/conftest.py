@@ -0,0 +1,46 @@
+"""Shared fixtures: the in-memory fakes from benchmarks/fakes.py and clean module state.
+
+Run from the functions directory: python -m pytest -q tests
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeFirestore, FakeMessaging, FakeTaskQueues, patched_clients
+from sendNotificationToTopic.helpers import batchWrite, bulkIngest, idempotency, subscriptionCache
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    """No retry backoff, and no idempotency or subscription cache carried across tests."""
+    monkeypatch.setattr(batchWrite, "RETRY_BACKOFF_SECONDS", 0)
+    monkeypatch.setattr(bulkIngest, "RETRY_BACKOFF_SECONDS", 0)
+    idempotency._recent_events.clear()
+    subscriptionCache.invalidate()
+    yield
+    idempotency._recent_events.clear()
+    subscriptionCache.invalidate()
+
+
+@pytest.fixture
+def fakes():
+    """Fake Firestore, FCM and task queues, patched into firebase_admin for the test."""
+    clients = SimpleNamespace(db=FakeFirestore(), fcm=FakeMessaging(), tasks=FakeTaskQueues())
+    with patched_clients(clients.db, clients.fcm, clients.tasks):
+        yield clients
+
+
+def seed_subscribers(db, property_id, count, preferences=("book",)):
+    db.seed("subscriptions", {
+        f"{property_id}_s{index:05d}": {
+            "propertyId": property_id,
+            "userId": f"u{index}",
+            "isSubscribed": True,
+            "alertPreferences": list(preferences),
+        }
+        for index in range(count)
+    })
@@ -0,0 +1,119 @@
+import threading
+from unittest import mock
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from benchmarks.fakes import FakeFirestore, FakeWriteBatch
+from instrumentation import InvocationMetrics
+from sendNotificationToTopic.helpers.batchWrite import (
+    MAX_COMMIT_ATTEMPTS,
+    BatchWriteError,
+    commitInBatches,
+    createInBatches,
+)
+
+
+def writes_for(db, count):
+    collection = db.collection("docs")
+    return [(collection.document(f"d{index:04d}"), {"n": index}) for index in range(count)]
+
+
+def failing_commits(should_fail):
+    """Patch FakeWriteBatch.commit to raise for batches where should_fail(first_path, call) holds."""
+    commit = FakeWriteBatch.commit
+    calls = {}
+    lock = threading.Lock()
+
+    def flaky(batch):
+        first_path = batch._writes[0][1]
+        with lock:
+            calls[first_path] = calls.get(first_path, 0) + 1
+            call = calls[first_path]
+        if should_fail(first_path, call):
+            raise api_exceptions.ServiceUnavailable("Injected commit failure")
+        return commit(batch)
+
+    return mock.patch.object(FakeWriteBatch, "commit", flaky), calls
+
+
+def test_writes_are_committed_in_batches_of_500():
+    db = FakeFirestore()
+
+    written = commitInBatches(db, writes_for(db, 1200))
+
+    assert written == 1200
+    assert db.rpcs["commit"] == 3
+    assert len(db.dump("docs")) == 1200
+
+
+def test_failed_batch_is_retried_on_its_own():
+    db = FakeFirestore()
+    metrics = InvocationMetrics("test")
+    patch, calls = failing_commits(lambda path, call: path == "docs/d0500" and call == 1)
+
+    with patch:
+        written = commitInBatches(db, writes_for(db, 1200), metrics)
+
+    assert written == 1200
+    assert calls == {"docs/d0000": 1, "docs/d0500": 2, "docs/d1000": 1}
+    assert metrics.to_dict()["counters"]["commitRetries"] == 1
+    assert len(db.dump("docs")) == 1200
+
+
+def test_batch_failing_every_attempt_raises_with_the_writes_that_landed():
+    db = FakeFirestore()
+    writes = writes_for(db, 1200)
+    patch, calls = failing_commits(lambda path, call: path == "docs/d0500")
+
+    with patch, pytest.raises(BatchWriteError) as raised:
+        commitInBatches(db, writes)
+
+    assert calls["docs/d0500"] == MAX_COMMIT_ATTEMPTS
+    assert len(raised.value.written) == 700
+    assert "500/1200 writes failed" in str(raised.value)
+    assert len(db.dump("docs")) == 700
+
+
+def test_merge_only_touches_the_given_fields():
+    db = FakeFirestore()
+    db.seed("docs", {"d0000": {"n": 0, "keep": True}})
+
+    commitInBatches(db, [(db.collection("docs").document("d0000"), {"n": 1})], merge=True)
+
+    assert db.dump("docs")["d0000"] == {"n": 1, "keep": True}
+
+
+def test_create_keeps_existing_documents_and_reports_only_new_ones():
+    db = FakeFirestore()
+    db.seed("docs", {"d0001": {"n": 1, "isRead": True}, "d0600": {"n": 600, "isRead": True}})
+    metrics = InvocationMetrics("test")
+
+    created = createInBatches(db, writes_for(db, 1200), metrics)
+
+    assert len(created) == 1198
+    assert {ref.id for ref, _ in created}.isdisjoint({"d0001", "d0600"})
+    assert db.dump("docs")["d0001"] == {"n": 1, "isRead": True}
+    assert len(db.dump("docs")) == 1200
+    counters = metrics.to_dict()["counters"]
+    assert counters["existingDocuments"] == 2
+    assert "commitRetries" not in counters
+
+
+def test_create_retried_after_a_commit_that_landed_reports_nothing_created():
+    db = FakeFirestore()
+    writes = writes_for(db, 3)
+    commit = FakeWriteBatch.commit
+    calls = []
+
+    def lands_then_times_out(batch):
+        calls.append(batch)
+        commit(batch)
+        if len(calls) == 1:
+            raise api_exceptions.DeadlineExceeded("Injected timeout")
+
+    with mock.patch.object(FakeWriteBatch, "commit", lands_then_times_out):
+        created = createInBatches(db, writes)
+
+    assert created == []
+    assert len(db.dump("docs")) == 3
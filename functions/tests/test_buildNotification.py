@@ -0,0 +1,59 @@
+import pytest
+
+from models.property_notification import Change, ChangeType
+from sendNotificationToTopic.helpers.buildNotification import (
+    buildNotificationChangePayload,
+    diffDocuments,
+)
+
+
+def test_diff_reports_removed_with_added_and_updated_in_one_pass():
+    old = {"documentId": "p1", "book": "45", "page": "12", "remark1": "x", "remark2": None}
+    new = {"documentId": "p1", "book": "46", "remark1": "x", "remark2": "y", "deed": "d"}
+
+    assert diffDocuments(new, old) == {
+        "book": Change(ChangeType.UPDATED, "45", "46"),
+        "remark2": Change(ChangeType.ADDED, None, "y"),
+        "deed": Change(ChangeType.ADDED, None, "d"),
+        "page": Change(ChangeType.REMOVED, "12", None),
+    }
+
+
+def test_diff_field_set_to_none_is_an_update_and_new_none_field_is_no_change():
+    old = {"book": "45"}
+    new = {"book": None, "page": None}
+
+    assert diffDocuments(new, old) == {"book": Change(ChangeType.UPDATED, "45", None)}
+
+
+def test_diff_only_compares_watched_and_not_ignored_fields():
+    old = {"book": "1", "page": "1", "insertTimestamp": 1}
+    new = {"book": "2", "page": "2", "insertTimestamp": 2}
+
+    changes = diffDocuments(new, old, watch={"book", "insertTimestamp"}, ignore={"insertTimestamp"})
+
+    assert changes == {"book": Change(ChangeType.UPDATED, "1", "2")}
+
+
+def test_payload_skips_bookkeeping_fields():
+    old = {"documentId": "p1", "book": "1", "insertTimestamp": 1, "bulkIngestId": None}
+    new = {"documentId": "p1", "book": "1", "insertTimestamp": 2, "bulkIngestId": "ingest1"}
+
+    assert buildNotificationChangePayload(new, old, "p1") == {}
+
+
+def test_payload_rejects_mismatched_property_ids():
+    with pytest.raises(Exception, match="Property IDs don't match"):
+        buildNotificationChangePayload({"documentId": "p2"}, {"documentId": "p1"}, "p1")
+
+
+@pytest.mark.parametrize("watch, ignore", [
+    ({"owner.name"}, ()),
+    ({"notAField"}, ()),
+    (None, {"owner.name"}),
+])
+def test_payload_rejects_fields_a_notification_cannot_carry(watch, ignore):
+    document = {"documentId": "p1", "owner": {"name": "A"}}
+
+    with pytest.raises(ValueError):
+        buildNotificationChangePayload(document, document, "p1", watch=watch, ignore=ignore)
@@ -0,0 +1,147 @@
+import threading
+from collections import Counter
+from unittest import mock
+
+import pytest
+from firebase_admin import messaging
+from google.api_core import exceptions as api_exceptions
+
+from benchmarks.fakes import FakeFirestore, FakeMessaging, FakeWriteBatch
+from conftest import seed_subscribers
+from resumeBulkIngestFanOuts import function as resume_function
+from sendNotificationToTopic.helpers import bulkIngest
+
+PROPERTY_IDS = ["p0", "p1", "p2"]
+RECORDS = [{"documentId": property_id, "book": "9"} for property_id in PROPERTY_IDS]
+
+
+@pytest.fixture
+def properties(fakes):
+    fakes.db.seed("properties", {
+        property_id: {"documentId": property_id, "book": "1", "page": "2"}
+        for property_id in PROPERTY_IDS
+    })
+    for property_id in PROPERTY_IDS:
+        seed_subscribers(fakes.db, property_id, 700)
+    return fakes
+
+
+def ingest(db, ingest_id, records=RECORDS, resume=True):
+    applied = bulkIngest.applyIngestRecords(db, records, ingest_id, resume=resume)
+    notifications = {}
+    if applied["fanOuts"]:
+        notifications = bulkIngest.dispatchGroupedNotifications(db, applied["fanOuts"])
+    return applied, notifications
+
+
+def notifications_per_user_and_property(db):
+    return Counter(
+        (notification["userId"], notification["propertyId"])
+        for notification in db.dump("property_notifications").values()
+    )
+
+
+def test_failed_notification_chunk_is_retried_in_place_without_duplicates(properties):
+    commit = FakeWriteBatch.commit
+    calls = Counter()
+    lock = threading.Lock()
+
+    def fail_second_chunk(batch):
+        if any(path.startswith("property_notifications/") for _, path, _, _ in batch._writes):
+            with lock:
+                calls["commit"] += 1
+                attempt = calls["commit"]
+            # Every attempt of one chunk fails, so the whole group is retried.
+            if 2 <= attempt <= 4:
+                raise api_exceptions.ServiceUnavailable("Injected failure")
+        return commit(batch)
+
+    with mock.patch.object(FakeWriteBatch, "commit", fail_second_chunk):
+        _, notifications = ingest(properties.db, "ingest1")
+
+    counts = notifications_per_user_and_property(properties.db)
+    assert len(counts) == 2100
+    assert set(counts.values()) == {1}
+    assert notifications["pending"] == []
+    assert len(properties.fcm.sent) == len(PROPERTY_IDS)
+    assert properties.db.dump(bulkIngest.FAN_OUTS_COLLECTION) == {}
+
+
+def test_concurrent_write_between_read_and_commit_is_kept(properties):
+    get_all = FakeFirestore.get_all
+    raced = []
+
+    def racy_get_all(db, references, **kwargs):
+        snapshots = list(get_all(db, references, **kwargs))
+        if not raced:
+            raced.append(True)
+            db.document("properties", "p1").update({"page": "concurrent"})
+        return snapshots
+
+    with mock.patch.object(FakeFirestore, "get_all", racy_get_all):
+        applied, _ = ingest(properties.db, "ingest1")
+
+    assert applied["failed"] == {}
+    assert properties.db.dump("properties")["p1"] == {
+        "documentId": "p1", "book": "9", "page": "concurrent", "bulkIngestId": "ingest1",
+    }
+
+
+def test_crash_after_commit_is_resumed_by_retry_with_same_ingest_id(properties):
+    with mock.patch.object(
+        bulkIngest, "dispatchGroupedNotifications", side_effect=RuntimeError("crash")
+    ):
+        with pytest.raises(RuntimeError):
+            ingest(properties.db, "ingest1")
+    assert len(properties.db.dump(bulkIngest.FAN_OUTS_COLLECTION)) == len(PROPERTY_IDS)
+
+    applied, notifications = ingest(properties.db, "ingest1")
+    assert sorted(applied["resumed"]) == PROPERTY_IDS
+    assert notifications["pending"] == []
+
+    applied, _ = ingest(properties.db, "ingest1")
+    assert sorted(applied["unchanged"]) == PROPERTY_IDS
+    assert set(notifications_per_user_and_property(properties.db).values()) == {1}
+    assert len(properties.fcm.sent) == len(PROPERTY_IDS)
+
+
+def test_failed_push_is_resumed_for_failed_targets_only(properties):
+    with mock.patch.object(messaging, "send_each", FakeMessaging(error_rate=1.0).send_each):
+        _, notifications = ingest(properties.db, "ingest1")
+    assert notifications["pending"] == PROPERTY_IDS
+    assert len(notifications_per_user_and_property(properties.db)) == 2100
+
+    applied, notifications = ingest(properties.db, "ingest1")
+
+    assert sorted(applied["resumed"]) == PROPERTY_IDS
+    assert notifications["inAppNotifications"] == 0
+    assert notifications["pending"] == []
+    assert len(properties.fcm.sent) == len(PROPERTY_IDS)
+
+
+def test_scheduler_resumes_fan_outs_of_an_ingest_that_is_not_retried(properties, monkeypatch):
+    with mock.patch.object(
+        bulkIngest, "dispatchGroupedNotifications", side_effect=RuntimeError("crash")
+    ):
+        with pytest.raises(RuntimeError):
+            ingest(properties.db, "ingest1")
+    monkeypatch.setattr(resume_function, "STALE_FAN_OUT_GRACE_SECONDS", -60)
+
+    assert resume_function.resumeStaleFanOuts() == {"resumed": 3, "pending": 0}
+    assert len(notifications_per_user_and_property(properties.db)) == 2100
+    assert properties.db.dump(bulkIngest.FAN_OUTS_COLLECTION) == {}
+
+
+def test_new_change_merges_into_pending_fan_out_under_a_new_key(properties):
+    records = [{"documentId": "p0", "book": "9"}]
+    with mock.patch.object(
+        bulkIngest, "dispatchGroupedNotifications", side_effect=RuntimeError("crash")
+    ):
+        with pytest.raises(RuntimeError):
+            ingest(properties.db, "ingest1", records)
+
+    applied, _ = ingest(properties.db, "ingest1", [{"documentId": "p0", "book": "10"}])
+
+    fan_out = applied["fanOuts"]["p0"]
+    assert fan_out["notificationKey"] == "ingest1_p0_1"
+    assert fan_out["changes"]["book"] == {"type": "updated", "old_value": "1", "new_value": "10"}
@@ -0,0 +1,125 @@
+from unittest import mock
+
+import pytest
+
+from conftest import seed_subscribers
+from flushNotificationBuffer import function as flush_function
+from flushNotificationBuffer.function import flushBuffer
+from models.property_notification import Change, ChangeType
+from sendNotificationToTopic.helpers import coalesceNotifications, createInAppNotification
+from sendNotificationToTopic.helpers.coalesceNotifications import mergeChangePayloads
+
+
+def updated(old, new):
+    return Change(ChangeType.UPDATED, old, new)
+
+
+def test_merge_keeps_oldest_old_value_and_newest_new_value():
+    merged = mergeChangePayloads(
+        {"book": updated("45", "46")},
+        {"book": updated("46", "47"), "page": Change(ChangeType.ADDED, None, "12")},
+    )
+
+    assert merged == {"book": updated("45", "47"), "page": Change(ChangeType.ADDED, None, "12")}
+
+
+@pytest.mark.parametrize("older, newer, expected", [
+    # Back at the original value: nothing to notify.
+    (updated("45", "46"), updated("46", "45"), None),
+    # Added, then removed again.
+    (Change(ChangeType.ADDED, None, "1"), Change(ChangeType.REMOVED, "1", None), None),
+    (updated("45", "46"), Change(ChangeType.REMOVED, "46", None), Change(ChangeType.REMOVED, "45", None)),
+    (Change(ChangeType.REMOVED, "45", None), Change(ChangeType.ADDED, None, "47"), updated("45", "47")),
+    (Change(ChangeType.ADDED, None, "1"), updated("1", "2"), Change(ChangeType.ADDED, None, "2")),
+])
+def test_merge_derives_the_change_type_again(older, newer, expected):
+    merged = mergeChangePayloads({"book": older}, {"book": newer})
+
+    assert merged.get("book") == expected
+
+
+def test_merge_does_not_modify_its_inputs():
+    older = {"book": updated("1", "2")}
+
+    mergeChangePayloads(older, {"book": updated("2", "3")})
+
+    assert older == {"book": updated("1", "2")}
+
+
+def test_failed_flush_keeps_the_buffer_and_the_retry_sends_only_what_failed(fakes):
+    seed_subscribers(fakes.db, "p1", 3)
+    coalesceNotifications.bufferChanges(fakes.db, "p1", {"book": updated("1", "2")})
+
+    with mock.patch.object(
+        createInAppNotification, "createInBatches", side_effect=Exception("commit failed")
+    ):
+        with pytest.raises(Exception):
+            flushBuffer("p1")
+    assert "p1" in fakes.db.dump(coalesceNotifications.BUFFER_COLLECTION)
+    assert fakes.db.dump("property_notifications") == {}
+    pushed = len(fakes.fcm.sent)
+    assert pushed == 1
+
+    flushBuffer("p1")
+
+    assert len(fakes.db.dump("property_notifications")) == 3
+    assert len(fakes.fcm.sent) == pushed
+
+
+def test_window_leased_by_a_running_flush_is_not_flushed_again(fakes):
+    seed_subscribers(fakes.db, "p1", 3)
+    coalesceNotifications.bufferChanges(fakes.db, "p1", {"book": updated("1", "2")})
+    dispatch = flush_function.dispatchNotifications
+    overlapping = []
+
+    def dispatch_with_overlapping_flush(*args, **kwargs):
+        # A task retry or sweeper run arriving while this flush is sending.
+        overlapping.append(flushBuffer("p1"))
+        return dispatch(*args, **kwargs)
+
+    with mock.patch.object(flush_function, "dispatchNotifications", dispatch_with_overlapping_flush):
+        flushBuffer("p1")
+
+    assert overlapping == [None]
+    assert len(fakes.fcm.sent) == 1
+    assert len(fakes.db.dump("property_notifications")) == 3
+    assert fakes.db.dump(coalesceNotifications.BUFFER_COLLECTION) == {}
+
+
+def test_sweeper_skips_active_leases_and_reclaims_expired_ones(fakes, monkeypatch):
+    seed_subscribers(fakes.db, "p1", 1)
+    coalesceNotifications.bufferChanges(fakes.db, "p1", {"book": updated("1", "2")})
+    monkeypatch.setattr(flush_function, "STALE_BUFFER_GRACE_SECONDS", -60)
+    # A flush claimed the window and died without finishing or releasing it.
+    coalesceNotifications.claimBuffer(fakes.db, "p1")
+
+    flush_function.flushStaleNotificationBuffers.__wrapped__(None)
+    assert fakes.fcm.sent == []
+    with pytest.raises(coalesceNotifications.FlushLeaseHeld):
+        coalesceNotifications.claimBuffer(fakes.db, "p1")
+
+    fakes.db.collection(coalesceNotifications.BUFFER_COLLECTION).document("p1").update(
+        {"flushLeaseExpiresAt": 0}
+    )
+    flush_function.flushStaleNotificationBuffers.__wrapped__(None)
+
+    assert len(fakes.fcm.sent) == 1
+    assert len(fakes.db.dump("property_notifications")) == 1
+    assert fakes.db.dump(coalesceNotifications.BUFFER_COLLECTION) == {}
+
+
+def test_changes_during_a_flush_become_the_next_window(fakes):
+    seed_subscribers(fakes.db, "p1", 1)
+    coalesceNotifications.bufferChanges(fakes.db, "p1", {"book": updated("1", "2")})
+    coalesceNotifications.claimBuffer(fakes.db, "p1")
+
+    opened = coalesceNotifications.bufferChanges(fakes.db, "p1", {"book": updated("2", "3")})
+    buffer = fakes.db.dump(coalesceNotifications.BUFFER_COLLECTION)["p1"]
+
+    assert opened is False
+    assert buffer["changes"]["book"]["new_value"] == "2"
+    assert buffer["pendingChanges"]["book"] == {"type": "updated", "old_value": "2", "new_value": "3"}
+    assert coalesceNotifications.finishFlush(fakes.db, "p1", buffer["windowStart"]) is True
+    next_window = fakes.db.dump(coalesceNotifications.BUFFER_COLLECTION)["p1"]
+    assert next_window["changes"] == buffer["pendingChanges"]
+    assert "flushing" not in next_window
@@ -0,0 +1,215 @@
+from unittest import mock
+
+import pytest
+from conftest import seed_subscribers
+
+from benchmarks.fakes import FakeFirestore
+from instrumentation import InvocationMetrics
+from models.property_notification import Change, ChangeType, PropertyNotification
+from sendNotificationToTopic.helpers import (
+    createInAppNotification,
+    shardedFanOut,
+    subscriptionCache,
+)
+from sendNotificationToTopic.helpers.createInAppNotification import (
+    ARRAY_CONTAINS_ANY_LIMIT,
+    buildNotificationWrites,
+    createInAppNotifications,
+    createInAppNotificationsForProperties,
+    groupSubscribersByPreferences,
+    querySubscriptionsForChanges,
+)
+
+PAYLOAD = {
+    "book": Change(ChangeType.UPDATED, "1", "2"),
+    "page": Change(ChangeType.ADDED, None, "12"),
+}
+
+MANY_FIELDS = [f"field{index:02d}" for index in range(35)]
+
+
+def subscription(property_id, user_id, preferences, subscribed=True, **extra):
+    return {
+        "propertyId": property_id,
+        "userId": user_id,
+        "isSubscribed": subscribed,
+        "alertPreferences": preferences,
+        **extra,
+    }
+
+
+def test_query_returns_only_active_subscriptions_overlapping_the_changes():
+    db = FakeFirestore()
+    db.seed("subscriptions", {
+        "s1": subscription("p1", "u1", ["book"]),
+        "s2": subscription("p1", "u2", ["page"]),
+        "s3": subscription("p1", "u3", ["book"], subscribed=False),
+        "s4": subscription("p2", "u4", ["book"]),
+    })
+
+    subscriptions = querySubscriptionsForChanges(db, "p1", ["book", "deed"])
+
+    assert subscriptions == [{"userId": "u1", "alertPreferences": ["book"]}]
+
+
+def test_query_projects_only_user_and_preferences():
+    db = FakeFirestore()
+    db.seed("subscriptions", {"s1": subscription("p1", "u1", ["book"], email="a@b.c")})
+
+    assert querySubscriptionsForChanges(db, "p1", ["book"]) == [
+        {"userId": "u1", "alertPreferences": ["book"]}
+    ]
+
+
+def test_more_than_30_fields_are_split_into_chunks_and_deduplicated():
+    db = FakeFirestore()
+    db.seed("subscriptions", {
+        # Matches a field of each chunk, must come back once.
+        "s1": subscription("p1", "u1", [MANY_FIELDS[0], MANY_FIELDS[34]]),
+        "s2": subscription("p1", "u2", [MANY_FIELDS[33]]),
+        "s3": subscription("p1", "u3", ["unrelated"]),
+    })
+    metrics = InvocationMetrics("test")
+
+    subscriptions = querySubscriptionsForChanges(db, "p1", MANY_FIELDS, metrics)
+
+    assert sorted(sub["userId"] for sub in subscriptions) == ["u1", "u2"]
+    counters = metrics.to_dict()["counters"]
+    assert counters["firestoreRpcs"] == 2 == -(-len(MANY_FIELDS) // ARRAY_CONTAINS_ANY_LIMIT)
+    assert counters["subscriptionsRead"] == 2
+
+
+def test_limit_stops_reading_once_reached():
+    db = FakeFirestore()
+    db.seed("subscriptions", {
+        f"s{index}": subscription("p1", f"u{index}", [MANY_FIELDS[0]]) for index in range(10)
+    })
+    metrics = InvocationMetrics("test")
+
+    subscriptions = querySubscriptionsForChanges(db, "p1", MANY_FIELDS, metrics, limit=4)
+
+    assert len(subscriptions) == 4
+    # The first chunk reached the limit, the second is never queried.
+    assert metrics.to_dict()["counters"]["firestoreRpcs"] == 1
+
+
+def test_limit_counts_subscribers_matching_several_chunks_once():
+    db = FakeFirestore()
+    db.seed("subscriptions", {
+        f"s{index}": subscription("p1", f"u{index}", [MANY_FIELDS[0], MANY_FIELDS[34]])
+        for index in range(6)
+    })
+
+    # Counted once per chunk these would be 12 and reach the limit.
+    subscriptions = querySubscriptionsForChanges(db, "p1", MANY_FIELDS, limit=11)
+
+    assert len(subscriptions) == 6
+
+
+def test_more_matching_subscribers_than_the_threshold_are_sharded(fakes, monkeypatch):
+    seed_subscribers(fakes.db, "p1", 12)
+    monkeypatch.setattr(subscriptionCache, "SUBSCRIPTION_CACHE_ENABLED", False)
+    monkeypatch.setattr(shardedFanOut, "SHARDED_FAN_OUT_THRESHOLD", 10)
+    metrics = InvocationMetrics("test")
+
+    scheduled = createInAppNotifications(PAYLOAD, "p1", metrics, "ev1")
+
+    assert scheduled == 11
+    assert metrics.to_dict()["counters"]["subscriptionsRead"] == 11
+    assert list(fakes.db.dump(shardedFanOut.FAN_OUT_JOBS_COLLECTION)) == ["ev1"]
+    assert fakes.db.dump("property_notifications") == {}
+
+
+def test_large_property_is_sharded_before_the_grouped_query(fakes, monkeypatch):
+    db = fakes.db
+    seed_subscribers(db, "p1", 30)
+    seed_subscribers(db, "p2", 3)
+    monkeypatch.setattr(shardedFanOut, "SHARDED_FAN_OUT_THRESHOLD", 10)
+    metrics = InvocationMetrics("test")
+
+    written, failed = createInAppNotificationsForProperties(
+        db, {"p1": PAYLOAD, "p2": PAYLOAD}, {"p1": "k1", "p2": "k2"}, metrics
+    )
+
+    assert (written, failed) == (11 + 3, {})
+    # p1 stops one past the threshold, only p2 goes through the grouped query.
+    assert metrics.to_dict()["counters"]["subscriptionsRead"] == 11 + 3
+    assert list(db.dump(shardedFanOut.FAN_OUT_JOBS_COLLECTION)) == ["k1"]
+    notifications = db.dump("property_notifications")
+    assert sorted(data["propertyId"] for data in notifications.values()) == ["p2"] * 3
+
+
+def test_large_property_with_few_matching_subscribers_is_written(monkeypatch):
+    db = FakeFirestore()
+    seed_subscribers(db, "p1", 12, preferences=("remark1",))
+    seed_subscribers(db, "p1", 4)
+    monkeypatch.setattr(shardedFanOut, "SHARDED_FAN_OUT_THRESHOLD", 10)
+
+    written, failed = createInAppNotificationsForProperties(db, {"p1": PAYLOAD}, {"p1": "k1"})
+
+    assert (written, failed) == (4, {})
+    assert db.dump(shardedFanOut.FAN_OUT_JOBS_COLLECTION) == {}
+
+
+def test_failed_group_commit_counts_its_sharded_properties_as_failed_only(fakes, monkeypatch):
+    db = fakes.db
+    seed_subscribers(db, "p1", 12)
+    seed_subscribers(db, "p2", 3)
+    monkeypatch.setattr(shardedFanOut, "SHARDED_FAN_OUT_THRESHOLD", 10)
+
+    with mock.patch.object(
+        createInAppNotification, "commitNotificationWrites",
+        side_effect=RuntimeError("commit failed"),
+    ):
+        written, failed = createInAppNotificationsForProperties(
+            db, {"p1": PAYLOAD, "p2": PAYLOAD}, {"p1": "k1", "p2": "k2"}
+        )
+
+    assert written == 0
+    assert failed == {"p1": "commit failed", "p2": "commit failed"}
+
+
+def test_subscribers_are_grouped_by_preference_set_regardless_of_order():
+    grouped = groupSubscribersByPreferences([
+        {"userId": "u1", "alertPreferences": ["book", "page"]},
+        {"userId": "u2", "alertPreferences": ["page", "book"]},
+        {"userId": "u3", "alertPreferences": ["remark1"]},
+    ])
+
+    assert grouped == {
+        frozenset({"book", "page"}): ["u1", "u2"],
+        frozenset({"remark1"}): ["u3"],
+    }
+
+
+def test_subscription_without_preferences_is_rejected():
+    with pytest.raises(Exception):
+        groupSubscribersByPreferences([{"userId": "u1", "alertPreferences": None}])
+
+
+def test_writes_match_and_encode_once_per_preference_set():
+    db = FakeFirestore()
+    subscribers = {
+        frozenset({"book"}): ["u1", "u2"],
+        frozenset({"book", "page"}): ["u3"],
+        frozenset({"remark1"}): ["u4"],
+    }
+
+    with mock.patch.object(
+        PropertyNotification, "to_firestore", autospec=True,
+        side_effect=PropertyNotification.to_firestore,
+    ) as to_firestore:
+        writes = buildNotificationWrites(
+            db.collection("property_notifications"), PAYLOAD, "p1", 7, subscribers, "ev1"
+        )
+
+    assert to_firestore.call_count == 2
+    data_by_user = {data["userId"]: data for _, data in writes}
+    assert sorted(data_by_user) == ["u1", "u2", "u3"]
+    assert data_by_user["u1"]["changes"] == {"book": PAYLOAD["book"].to_firestore()}
+    assert data_by_user["u3"]["changes"] == {
+        key: change.to_firestore() for key, change in PAYLOAD.items()
+    }
+    assert all(data["createdAt"] == 7 and data["isRead"] is False for _, data in writes)
+    # Each write gets its own dict, only the encoded changes are shared.
+    assert data_by_user["u1"] is not data_by_user["u2"]
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from benchmarks.fakes import FakeFirestore, FakeTaskQueues
+
+
+def test_batch_commit_is_all_or_nothing():
+    db = FakeFirestore()
+    db.seed("docs", {"a": {"n": 1}})
+    batch = db.batch()
+    batch.set(db.document("docs", "b"), {"n": 2})
+    batch.create(db.document("docs", "a"), {"n": 3})
+
+    with pytest.raises(api_exceptions.AlreadyExists):
+        batch.commit()
+
+    assert db.dump("docs") == {"a": {"n": 1}}
+
+
+def test_batch_rejects_more_than_500_writes():
+    db = FakeFirestore()
+    batch = db.batch()
+    for index in range(501):
+        batch.set(db.document("docs", str(index)), {})
+
+    with pytest.raises(api_exceptions.InvalidArgument):
+        batch.commit()
+
+
+def test_update_time_precondition():
+    db = FakeFirestore()
+    db.seed("docs", {"a": {"n": 1}})
+    snapshot = db.document("docs", "a").get()
+    db.document("docs", "a").update({"n": 2})
+
+    with pytest.raises(api_exceptions.FailedPrecondition):
+        db.document("docs", "a").update(
+            {"n": 3}, option=db.write_option(last_update_time=snapshot.update_time)
+        )
+
+    assert db.dump("docs")["a"] == {"n": 2}
+
+
+def test_injected_errors_and_rpc_accounting():
+    db = FakeFirestore(error_rate=1.0, seed=1)
+
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        db.document("docs", "a").get()
+
+    assert db.rpcs["get"] == 1
+
+
+def test_task_ids_are_deduplicated_and_failed_tasks_retried():
+    queues = FakeTaskQueues()
+    queue = queues.task_queue("work")
+    queue.enqueue({"n": 1}, SimpleNamespace(task_id="t1"))
+    with pytest.raises(Exception):
+        queue.enqueue({"n": 1}, SimpleNamespace(task_id="t1"))
+    calls = []
+
+    def handler(request):
+        calls.append(request.data)
+        if len(calls) == 1:
+            raise RuntimeError("first attempt fails")
+
+    assert queues.drain({"work": handler}) == 1
+    assert calls == [{"n": 1}, {"n": 1}]
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import seed_subscribers
+from inbox_web import markRead, parseCursor
+from instrumentation import NOOP_METRICS
+from models.property_notification import Change, ChangeType
+from sendNotificationToTopic.helpers import createInAppNotification, unreadCounter
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("1700000000000:abc", (1700000000000, "abc")),
+    ("-5:abc", (-5, "abc")),
+    # Only the first colon separates, document IDs may contain more.
+    ("12:a:b", (12, "a:b")),
+])
+def test_parse_cursor(value, expected):
+    assert parseCursor(value) == expected
+
+
+@pytest.mark.parametrize("value", ["abc", "12", "12:", ":abc", "1.5:abc", "x1:abc"])
+def test_parse_cursor_rejects_malformed_values(value):
+    with pytest.raises(ValueError):
+        parseCursor(value)
+
+
+def mark_read_request(body):
+    return SimpleNamespace(get_json=lambda silent=True: body)
+
+
+def test_redelivered_fan_out_counts_once_and_marking_read_twice_decrements_once(fakes):
+    seed_subscribers(fakes.db, "p1", 1)
+    payload = {"book": Change(ChangeType.UPDATED, "1", "2")}
+    for _ in range(2):
+        createInAppNotification.createInAppNotifications(payload, "p1", notification_key="ev1")
+    assert unreadCounter.readUnreadCount(fakes.db, "u0") == 1
+
+    request = mark_read_request({"notificationIds": list(fakes.db.dump("property_notifications"))})
+    first = markRead(fakes.db, request, "u0", NOOP_METRICS)
+    second = markRead(fakes.db, request, "u0", NOOP_METRICS)
+
+    assert (first["updated"], second["updated"]) == (1, 0)
+    assert unreadCounter.readUnreadCount(fakes.db, "u0") == 0
+
+
+def test_mark_read_ignores_notifications_of_other_users(fakes):
+    seed_subscribers(fakes.db, "p1", 2)
+    createInAppNotification.createInAppNotifications(
+        {"book": Change(ChangeType.UPDATED, "1", "2")}, "p1", notification_key="ev1"
+    )
+
+    result = markRead(
+        fakes.db,
+        mark_read_request({"notificationIds": list(fakes.db.dump("property_notifications"))}),
+        "u0",
+        NOOP_METRICS,
+    )
+
+    assert result["updated"] == 1
+    assert unreadCounter.readUnreadCount(fakes.db, "u1") == 1
@@ -0,0 +1,92 @@
+import json
+import threading
+
+from benchmarks.bench_fanout import PROPERTY_ID, make_event
+from conftest import seed_subscribers
+from instrumentation import MAX_DETAILS, NOOP_METRICS, InvocationMetrics
+from sendNotificationToTopic.function import sendNotificationToTopic
+from sendNotificationToTopic.helpers import coalesceNotifications
+
+
+def emitted_lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_emit_writes_one_structured_json_line(capsys):
+    metrics = InvocationMetrics("fn", propertyId="p1")
+    with metrics.stage("diff"):
+        pass
+    with metrics.stage("diff"):
+        pass
+    metrics.count("fcmRpcs")
+    metrics.count("fcmRpcs", 2)
+    metrics.label(skipped="noWatchedChanges")
+
+    metrics.emit(severity="WARNING")
+
+    [entry] = emitted_lines(capsys)
+    assert entry["message"] == "fn invocation metrics"
+    assert entry["function"] == "fn"
+    assert entry["severity"] == "WARNING"
+    assert entry["propertyId"] == "p1"
+    assert entry["skipped"] == "noWatchedChanges"
+    assert entry["counters"] == {"fcmRpcs": 3}
+    assert list(entry["stagesMs"]) == ["diff"]
+    assert entry["totalMs"] >= entry["stagesMs"]["diff"] >= 0
+    assert "details" not in entry
+
+
+def test_details_are_kept_only_when_sampled_and_bounded():
+    sampled = InvocationMetrics("fn", detail_sample_rate=1.0)
+    unsampled = InvocationMetrics("fn", detail_sample_rate=0.0)
+    for index in range(MAX_DETAILS + 10):
+        sampled.detail("pushFailure", target=f"t{index}")
+        unsampled.detail("pushFailure", target=f"t{index}")
+
+    assert len(sampled.to_dict()["details"]) == MAX_DETAILS
+    assert sampled.to_dict()["details"][0] == {"kind": "pushFailure", "target": "t0"}
+    assert "details" not in unsampled.to_dict()
+
+
+def test_counters_are_thread_safe():
+    metrics = InvocationMetrics("fn")
+
+    def count():
+        for _ in range(1000):
+            metrics.count("writes")
+
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.to_dict()["counters"]["writes"] == 8000
+
+
+def test_noop_metrics_record_and_print_nothing(capsys):
+    NOOP_METRICS.count("writes")
+    NOOP_METRICS.label(a=1)
+    with NOOP_METRICS.stage("diff"):
+        pass
+    NOOP_METRICS.emit()
+
+    assert NOOP_METRICS.to_dict()["counters"] == {}
+    assert capsys.readouterr().out == ""
+
+
+def test_trigger_emits_exactly_one_metrics_line(fakes, capsys, monkeypatch):
+    monkeypatch.setattr(coalesceNotifications, "COALESCE_WINDOW_SECONDS", 0)
+    seed_subscribers(fakes.db, PROPERTY_ID, 3)
+    before = {"documentId": PROPERTY_ID, "book": "1"}
+
+    sendNotificationToTopic.__wrapped__(
+        make_event(fakes.db, before, {**before, "book": "2"}, "ev1")
+    )
+
+    [entry] = emitted_lines(capsys)
+    assert entry["function"] == "sendNotificationToTopic"
+    assert entry["propertyId"] == PROPERTY_ID
+    assert entry["counters"]["changedFields"] == 1
+    assert entry["counters"]["fanOutSize"] == 3
+    assert {"diff", "fcmSend", "firestoreWrites"} <= set(entry["stagesMs"])
@@ -0,0 +1,28 @@
+from models.property_notification import ChangeType, PropertyNotification
+
+
+def notification(old_value, new_value):
+    return {
+        "propertyId": "p1",
+        "createdAt": 1,
+        "userId": "u1",
+        "changes": {"book": {"type": "updated", "old_value": old_value, "new_value": new_value}},
+    }
+
+
+def test_decoding_many_keeps_equal_values_of_different_types_apart():
+    decoded = PropertyNotification.from_firestore_many(
+        [notification(1, 2), notification(1.0, 2.0), notification(True, 2), notification(1, 2)]
+    )
+
+    values = [
+        (type(n.changes["book"].old_value), type(n.changes["book"].new_value)) for n in decoded
+    ]
+    assert values == [(int, int), (float, float), (bool, int), (int, int)]
+    assert all(n.changes["book"].type == ChangeType.UPDATED for n in decoded)
+
+
+def test_decoding_many_handles_unhashable_values():
+    decoded = PropertyNotification.from_firestore_many([notification([1], {"a": 1})])
+
+    assert decoded[0].changes["book"].old_value == [1]
@@ -0,0 +1,109 @@
+from unittest import mock
+
+from firebase_admin import exceptions, messaging
+
+from pruneDeadTokens import function as prune_function
+from pruneDeadTokens.function import PRUNE_STATE_COLLECTION, pruneDeadTokenRegistry
+from sendNotificationToTopic.helpers.tokenRegistry import (
+    FCM_TOKENS_COLLECTION,
+    findDeadTokens,
+    tokenDocumentId,
+)
+
+
+def seed_registry(db, tokens, topics=("a", "b"), **extra):
+    db.seed(FCM_TOKENS_COLLECTION, {
+        tokenDocumentId(token): {"token": token, "topics": list(topics), **extra}
+        for token in tokens
+    })
+
+
+def test_dead_tokens_are_found_with_dry_run_sends_in_chunks_of_500(fakes):
+    tokens = [f"t{index}" for index in range(1200)]
+    fakes.fcm.dead_tokens.update({"t3", "t700"})
+
+    dead = findDeadTokens(tokens)
+
+    assert dead == {"t3": "NOT_FOUND", "t700": "NOT_FOUND"}
+    assert fakes.fcm.rpcs["fcm_send_each"] == 3
+    # Dry runs deliver nothing.
+    assert fakes.fcm.sent == []
+
+
+def test_invalid_tokens_are_dead_and_other_errors_are_not(fakes):
+    def send_each(messages, dry_run=False):
+        assert dry_run
+        return messaging.BatchResponse([
+            messaging.SendResponse(None, exceptions.InvalidArgumentError("bad token")),
+            messaging.SendResponse(None, exceptions.UnavailableError("busy")),
+            messaging.SendResponse({"name": "m1"}, None),
+        ])
+
+    with mock.patch.object(messaging, "send_each", send_each):
+        assert findDeadTokens(["t0", "t1", "t2"]) == {"t0": "INVALID_ARGUMENT"}
+
+
+def test_unflagged_dead_tokens_are_unsubscribed_and_deleted(fakes):
+    tokens = [f"t{index}" for index in range(5)]
+    seed_registry(fakes.db, tokens)
+    fakes.fcm.dead_tokens.update({"t1", "t3"})
+    unsubscribe = fakes.fcm.unsubscribe_from_topic
+    calls = []
+
+    def record(tokens, topic, app=None):
+        calls.append((topic, sorted(tokens)))
+        return unsubscribe(tokens, topic)
+
+    with mock.patch.object(messaging, "unsubscribe_from_topic", record):
+        result = pruneDeadTokenRegistry()
+
+    assert result == {"checked": 5, "pruned": 2, "retained": 0}
+    assert sorted(calls) == [("a", ["t1", "t3"]), ("b", ["t1", "t3"])]
+    registry = fakes.db.dump(FCM_TOKENS_COLLECTION)
+    assert sorted(data["token"] for data in registry.values()) == ["t0", "t2", "t4"]
+
+
+def test_tokens_flagged_by_topic_management_skip_the_dry_run(fakes):
+    seed_registry(fakes.db, ["t0"], dead=True, deadReason="NOT_FOUND")
+    seed_registry(fakes.db, ["t1"])
+
+    result = pruneDeadTokenRegistry()
+
+    assert result == {"checked": 1, "pruned": 1, "retained": 0}
+    assert fakes.fcm.rpcs["fcm_messages"] == 1
+    assert fakes.fcm.rpcs["fcm_topic_management"] == 2
+
+
+def test_dead_token_whose_unsubscribe_fails_is_flagged_and_kept(fakes):
+    seed_registry(fakes.db, ["t0", "t1"])
+    fakes.fcm.dead_tokens.add("t0")
+    unsubscribe = fakes.fcm.unsubscribe_from_topic
+
+    def fail_topic_b(tokens, topic, app=None):
+        if topic == "b":
+            raise exceptions.UnavailableError("FCM down")
+        return unsubscribe(tokens, topic)
+
+    with mock.patch.object(messaging, "unsubscribe_from_topic", fail_topic_b):
+        result = pruneDeadTokenRegistry()
+
+    assert result == {"checked": 2, "pruned": 0, "retained": 1}
+    kept = fakes.db.dump(FCM_TOKENS_COLLECTION)[tokenDocumentId("t0")]
+    assert (kept["dead"], kept["deadReason"]) == (True, "NOT_FOUND")
+
+
+def test_a_run_stops_after_max_pages_and_the_next_continues(fakes, monkeypatch):
+    monkeypatch.setattr(prune_function, "FIRESTORE_BATCH_LIMIT", 2)
+    monkeypatch.setattr(prune_function.tokenRegistry, "FIRESTORE_BATCH_LIMIT", 2)
+    tokens = [f"t{index}" for index in range(5)]
+    seed_registry(fakes.db, tokens)
+    fakes.fcm.dead_tokens.update(tokens)
+
+    first = pruneDeadTokenRegistry(max_pages=2)
+    assert first["pruned"] == 4
+    assert "cursor" in fakes.db.dump(PRUNE_STATE_COLLECTION)["state"]
+
+    second = pruneDeadTokenRegistry(max_pages=2)
+    assert second["pruned"] == 1
+    assert fakes.db.dump(FCM_TOKENS_COLLECTION) == {}
+    assert fakes.db.dump(PRUNE_STATE_COLLECTION) == {}
@@ -0,0 +1,79 @@
+from unittest import mock
+
+import pytest
+from firebase_admin import messaging
+
+from benchmarks.bench_fanout import PROPERTY_ID, make_event
+from benchmarks.fakes import FakeMessaging
+from conftest import seed_subscribers
+from sendNotificationToTopic.function import sendNotificationToTopic
+from sendNotificationToTopic.helpers import coalesceNotifications, idempotency
+
+BEFORE = {"documentId": PROPERTY_ID, "book": "1", "page": "1"}
+AFTER = {"documentId": PROPERTY_ID, "book": "2", "page": "2"}
+
+
+@pytest.fixture(autouse=True)
+def no_coalescing(monkeypatch):
+    monkeypatch.setattr(coalesceNotifications, "COALESCE_WINDOW_SECONDS", 0)
+
+
+def trigger(event):
+    sendNotificationToTopic.__wrapped__(event)
+
+
+def test_bookkeeping_only_write_makes_no_firestore_or_fcm_calls(fakes):
+    seed_subscribers(fakes.db, PROPERTY_ID, 1)
+
+    trigger(make_event(fakes.db, BEFORE, {**BEFORE, "insertTimestamp": 2, "attempts": 3}, "ev1"))
+
+    assert sum(fakes.db.rpcs.values()) == 0
+    assert sum(fakes.fcm.rpcs.values()) == 0
+
+
+def test_failed_push_raises_and_retry_skips_finished_stages(fakes):
+    seed_subscribers(fakes.db, PROPERTY_ID, 3)
+    event = make_event(fakes.db, BEFORE, AFTER, "ev1")
+
+    with mock.patch.object(messaging, "send_each", FakeMessaging(error_rate=1.0).send_each):
+        with pytest.raises(Exception):
+            trigger(event)
+    marker = fakes.db.dump(idempotency.PROCESSED_EVENTS_COLLECTION)["ev1"]
+    assert marker["stages"] == {"inApp": True}
+    assert len(fakes.db.dump("property_notifications")) == 3
+
+    idempotency._recent_events.clear()
+    trigger(event)
+
+    assert len(fakes.fcm.sent) == 1
+    assert len(fakes.db.dump("property_notifications")) == 3
+
+
+def test_redelivered_event_does_not_reset_read_state(fakes):
+    seed_subscribers(fakes.db, PROPERTY_ID, 2)
+    event = make_event(fakes.db, BEFORE, AFTER, "ev1")
+    trigger(event)
+    notifications = fakes.db.dump("property_notifications")
+    read_id = sorted(notifications)[0]
+    fakes.db.collection("property_notifications").document(read_id).update(
+        {"isRead": True, "readAt": 5}
+    )
+
+    # A redelivery after the marker expired runs every stage again.
+    fakes.db.clear(idempotency.PROCESSED_EVENTS_COLLECTION)
+    idempotency._recent_events.clear()
+    trigger(event)
+
+    notifications = fakes.db.dump("property_notifications")
+    assert len(notifications) == 2
+    assert notifications[read_id]["isRead"] is True
+    assert notifications[read_id]["readAt"] == 5
+
+
+def test_bulk_ingest_write_is_skipped(fakes):
+    seed_subscribers(fakes.db, PROPERTY_ID, 1)
+
+    trigger(make_event(fakes.db, BEFORE, {**AFTER, "bulkIngestId": "ingest1"}, "ev1"))
+
+    assert fakes.fcm.sent == []
+    assert fakes.db.dump("property_notifications") == {}
@@ -0,0 +1,112 @@
+from unittest import mock
+
+import pytest
+from firebase_admin import exceptions, messaging
+
+from benchmarks.fakes import FakeMessaging
+from models.property_notification import Change, ChangeType
+from sendNotificationToTopic.helpers.sendPushNotification import (
+    FCM_BATCH_LIMIT,
+    FCM_CONDITION_TOPIC_LIMIT,
+    DeliveryMode,
+    PushDeliveryError,
+    buildConditionMessages,
+    buildMessages,
+    sendMessagesInBatches,
+    sendPushNotifications,
+)
+
+FIELDS = [
+    "book", "page", "generation", "remark1", "remark2", "parcelId", "version", "role", "editFlag",
+]
+
+
+def topic_messages(count):
+    return [
+        (f"topic{index}", messaging.Message(data={"n": str(index)}, topic=f"topic{index}"))
+        for index in range(count)
+    ]
+
+
+@pytest.mark.parametrize("message_count, expected_calls", [(1, 1), (500, 1), (501, 2), (1200, 3)])
+def test_messages_are_sent_in_chunks_of_500(fakes, message_count, expected_calls):
+    results = sendMessagesInBatches(topic_messages(message_count))
+
+    assert fakes.fcm.rpcs["fcm_send_each"] == expected_calls
+    assert fakes.fcm.rpcs["fcm_messages"] == message_count
+    assert len(results) == message_count
+    assert all(result["success"] for result in results.values())
+    assert FCM_BATCH_LIMIT == 500
+
+
+def test_failed_chunk_does_not_stop_the_others(fakes):
+    send_each = fakes.fcm.send_each
+    calls = []
+
+    def fail_first_chunk(messages, *args, **kwargs):
+        calls.append(len(messages))
+        if len(calls) == 1:
+            raise exceptions.UnavailableError("FCM down")
+        return send_each(messages, *args, **kwargs)
+
+    with mock.patch.object(messaging, "send_each", fail_first_chunk):
+        results = sendMessagesInBatches(topic_messages(501))
+
+    assert calls == [500, 1]
+    assert sum(not result["success"] for result in results.values()) == 500
+    assert results["topic500"]["success"] is True
+    assert results["topic0"]["error"] == "FCM down"
+
+
+def topics_of(condition):
+    return [part.strip().split(" in ")[0].strip("'") for part in condition.split("||")]
+
+
+@pytest.mark.parametrize("field_count, expected_sizes", [
+    (1, [2]),
+    (4, [5]),
+    (5, [5, 1]),
+    (9, [5, 5]),
+])
+def test_conditions_pack_up_to_five_topics_with_all_first(field_count, expected_sizes):
+    data = {field: "x" for field in FIELDS[:field_count]}
+
+    messages = buildConditionMessages(data, "p1")
+
+    conditions = [target for target, _ in messages]
+    assert [len(topics_of(condition)) for condition in conditions] == expected_sizes
+    assert topics_of(conditions[0])[0] == "property_p1_all"
+    all_topics = [topic for condition in conditions for topic in topics_of(condition)]
+    assert sorted(all_topics) == sorted(
+        [f"property_p1_{field}" for field in data] + ["property_p1_all"]
+    )
+    assert max(expected_sizes) <= FCM_CONDITION_TOPIC_LIMIT
+    for condition, message in messages:
+        assert message.condition == condition
+        assert message.data == {**data, "propertyId": "p1"}
+
+
+def test_topic_mode_sends_one_message_per_topic():
+    payload = {field: Change(ChangeType.UPDATED, "1", "2") for field in FIELDS[:2]}
+
+    messages = buildMessages(payload, "p1", DeliveryMode.TOPIC)
+
+    assert [target for target, _ in messages] == [
+        "property_p1_book", "property_p1_page", "property_p1_all",
+    ]
+    assert all(message.topic == target for target, message in messages)
+
+
+def test_failed_target_raises_and_retry_sends_only_failed_targets(fakes):
+    payload = {field: Change(ChangeType.UPDATED, "1", "2") for field in FIELDS}
+
+    with mock.patch.object(messaging, "send_each", FakeMessaging(error_rate=1.0).send_each):
+        with pytest.raises(PushDeliveryError) as raised:
+            sendPushNotifications(payload, "p1")
+    assert all(not result["success"] for result in raised.value.results.values())
+
+    first, second = list(raised.value.results)
+    results = sendPushNotifications(payload, "p1", skip_targets={first})
+
+    assert list(results) == [second]
+    assert [message.condition for message in fakes.fcm.sent] == [second]
@@ -0,0 +1,57 @@
+import pytest
+
+from conftest import seed_subscribers
+from sendNotificationToTopic.helpers.shardedFanOut import planShardBounds, shardQuery
+
+
+@pytest.mark.parametrize("subscriber_count, expected_bounds", [
+    (0, []),
+    (3, []),
+    (4, ["p1_s00003"]),
+    (8, ["p1_s00003", "p1_s00007"]),
+    (9, ["p1_s00003", "p1_s00007"]),
+])
+def test_bounds_are_the_last_id_of_each_full_shard(fakes, subscriber_count, expected_bounds):
+    seed_subscribers(fakes.db, "p1", subscriber_count)
+
+    assert planShardBounds(fakes.db, "p1", 4) == expected_bounds
+
+
+def test_bounds_skip_inactive_and_other_property_subscriptions(fakes):
+    seed_subscribers(fakes.db, "p1", 5)
+    seed_subscribers(fakes.db, "p2", 5)
+    fakes.db.seed("subscriptions", {"p1_s00001": {
+        "propertyId": "p1", "userId": "u1", "isSubscribed": False, "alertPreferences": ["book"],
+    }})
+
+    assert planShardBounds(fakes.db, "p1", 2) == ["p1_s00002", "p1_s00004"]
+
+
+@pytest.mark.parametrize("subscriber_count", [7, 8, 9])
+def test_shards_cover_every_subscription_exactly_once(fakes, subscriber_count):
+    seed_subscribers(fakes.db, "p1", subscriber_count)
+    job = {"propertyId": "p1", "shardBounds": planShardBounds(fakes.db, "p1", 4)}
+
+    shards = [
+        [snapshot.id for snapshot in shardQuery(fakes.db, job, index).stream()]
+        for index in range(len(job["shardBounds"]) + 1)
+    ]
+
+    assert [subscription for shard in shards for subscription in shard] == [
+        f"p1_s{index:05d}" for index in range(subscriber_count)
+    ]
+    assert all(len(shard) == 4 for shard in shards[:-1])
+
+
+def test_shard_query_selects_only_the_fan_out_fields(fakes):
+    seed_subscribers(fakes.db, "p1", 1)
+
+    snapshot = next(shardQuery(fakes.db, {"propertyId": "p1", "shardBounds": []}, 0).stream())
+
+    assert snapshot.to_dict() == {"userId": "u0", "alertPreferences": ["book"]}
+
+
+@pytest.mark.parametrize("shard_index", [-1, 2])
+def test_shard_index_out_of_range(fakes, shard_index):
+    with pytest.raises(ValueError):
+        shardQuery(fakes.db, {"propertyId": "p1", "shardBounds": ["p1_s00003"]}, shard_index)
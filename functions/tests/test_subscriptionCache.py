@@ -0,0 +1,130 @@
+from unittest import mock
+
+from conftest import seed_subscribers
+
+from benchmarks.fakes import FakeFirestore
+from instrumentation import InvocationMetrics
+from models.property_notification import Change, ChangeType
+from sendNotificationToTopic.helpers import (
+    createInAppNotification,
+    shardedFanOut,
+    subscriptionCache,
+)
+from sendNotificationToTopic.helpers.subscriptionCache import (
+    SUBSCRIPTION_VERSIONS_COLLECTION,
+    bumpSubscriptionVersions,
+    cachedSubscribersByPreferences,
+)
+
+
+def counters_of(call, *args):
+    metrics = InvocationMetrics("test")
+    result = call(*args, metrics)
+    return result, metrics.to_dict()["counters"]
+
+
+def test_second_call_is_served_from_memory():
+    db = FakeFirestore()
+    seed_subscribers(db, "p1", 3)
+
+    first, misses = counters_of(cachedSubscribersByPreferences, db, "p1")
+    second, hits = counters_of(cachedSubscribersByPreferences, db, "p1")
+
+    assert first == second == {frozenset({"book"}): ["u0", "u1", "u2"]}
+    assert misses["subscriptionCacheMisses"] == 1
+    assert hits["subscriptionCacheHits"] == 1
+    assert "subscriptionsRead" not in hits
+
+
+def test_subscription_write_bumps_the_version_and_refetches():
+    db = FakeFirestore()
+    seed_subscribers(db, "p1", 2)
+    cachedSubscribersByPreferences(db, "p1")
+    added = {"propertyId": "p1", "userId": "u9", "isSubscribed": True, "alertPreferences": ["book"]}
+    db.seed("subscriptions", {"p1_s00009": added})
+
+    assert bumpSubscriptionVersions(db, None, added) == ["p1"]
+    subscribers, counters = counters_of(cachedSubscribersByPreferences, db, "p1")
+
+    assert counters["subscriptionCacheMisses"] == 1
+    assert subscribers[frozenset({"book"})] == ["u0", "u1", "u9"]
+    assert db.dump(SUBSCRIPTION_VERSIONS_COLLECTION)["p1"] == {"version": 1}
+
+
+def test_version_bumped_by_another_instance_misses():
+    db = FakeFirestore()
+    seed_subscribers(db, "p1", 2)
+    cachedSubscribersByPreferences(db, "p1")
+    # The trigger ran elsewhere, only the version document tells this instance.
+    db.seed(SUBSCRIPTION_VERSIONS_COLLECTION, {"p1": {"version": 4}})
+
+    _, counters = counters_of(cachedSubscribersByPreferences, db, "p1")
+
+    assert counters["subscriptionCacheMisses"] == 1
+
+
+def test_write_to_unrelated_fields_keeps_the_cache():
+    subscription = {"propertyId": "p1", "userId": "u1", "isSubscribed": True, "email": "a@b.c"}
+
+    assert bumpSubscriptionVersions(FakeFirestore(), subscription, {**subscription, "email": "x"}) == []
+
+
+def test_entry_older_than_the_ttl_is_refetched():
+    db = FakeFirestore()
+    seed_subscribers(db, "p1", 2)
+    now = 1000.0
+
+    with mock.patch.object(subscriptionCache.time, "monotonic", lambda: now):
+        cachedSubscribersByPreferences(db, "p1")
+        now += subscriptionCache.SUBSCRIPTION_CACHE_TTL_SECONDS - 1
+        _, fresh = counters_of(cachedSubscribersByPreferences, db, "p1")
+        now += 1
+        _, expired = counters_of(cachedSubscribersByPreferences, db, "p1")
+
+    assert fresh["subscriptionCacheHits"] == 1
+    assert expired["subscriptionCacheMisses"] == 1
+
+
+def test_least_recently_used_properties_are_evicted_by_subscriber_count(monkeypatch):
+    db = FakeFirestore()
+    for property_id in ("p1", "p2", "p3"):
+        seed_subscribers(db, property_id, 40)
+    monkeypatch.setattr(subscriptionCache, "SUBSCRIPTION_CACHE_MAX_SUBSCRIBERS", 100)
+
+    cachedSubscribersByPreferences(db, "p1")
+    cachedSubscribersByPreferences(db, "p2")
+    cachedSubscribersByPreferences(db, "p1")
+    cachedSubscribersByPreferences(db, "p3")
+
+    assert list(subscriptionCache._cache) == ["p1", "p3"]
+    assert subscriptionCache._cached_subscribers == 80
+
+
+def test_property_above_the_threshold_is_not_cached(monkeypatch):
+    db = FakeFirestore()
+    seed_subscribers(db, "p1", 30)
+    monkeypatch.setattr(shardedFanOut, "SHARDED_FAN_OUT_THRESHOLD", 20)
+
+    first, misses = counters_of(cachedSubscribersByPreferences, db, "p1")
+    second, hits = counters_of(cachedSubscribersByPreferences, db, "p1")
+
+    assert first is None and second is None
+    # Reading stops one past the threshold, and only once per version.
+    assert misses["subscriptionsRead"] == 21
+    assert misses["subscriptionCacheSkipped"] == 1
+    assert "subscriptionsRead" not in hits
+    assert subscriptionCache._cached_subscribers == 1
+
+
+def test_uncached_property_falls_back_to_the_filtered_query(fakes, monkeypatch):
+    seed_subscribers(fakes.db, "p1", 30)
+    # The first 10 of the 30 are overwritten with another preference.
+    seed_subscribers(fakes.db, "p1", 10, preferences=("page",))
+    monkeypatch.setattr(shardedFanOut, "SHARDED_FAN_OUT_THRESHOLD", 20)
+    payload = {"page": Change(ChangeType.UPDATED, "1", "2")}
+
+    written = createInAppNotification.createInAppNotifications(payload, "p1")
+
+    assert written == 10
+    assert len(fakes.db.dump("property_notifications")) == 10
+    assert fakes.db.dump(shardedFanOut.FAN_OUT_JOBS_COLLECTION) == {}
@@ -0,0 +1,166 @@
+from unittest import mock
+
+import pytest
+from firebase_admin import exceptions, messaging
+from flask import Flask, request
+
+import subscription_web
+from instrumentation import NOOP_METRICS
+from sendNotificationToTopic.helpers import tokenRegistry
+from subscription_web import (
+    FCM_TOPIC_TOKEN_LIMIT,
+    MAX_TOKEN_TOPIC_PAIRS,
+    groupTokensByTopic,
+    manageTopicsInBulk,
+)
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+def call(app, endpoint, body):
+    with app.test_request_context("/", method="POST", json=body):
+        response, status, _ = endpoint.__wrapped__(request)
+    return status, response.get_json()
+
+
+def test_operations_are_merged_per_topic_without_duplicate_tokens():
+    tokens_by_topic = groupTokensByTopic([
+        {"tokens": ["t1", "t2"], "topics": ["a", "b"]},
+        {"tokens": ["t2", "t3"], "topics": ["a"]},
+    ])
+
+    assert tokens_by_topic == {"a": ["t1", "t2", "t3"], "b": ["t1", "t2"]}
+
+
+@pytest.mark.parametrize("operations", [
+    None,
+    [],
+    ["not an object"],
+    [{"tokens": [], "topics": ["a"]}],
+    [{"tokens": ["t1"], "topics": [""]}],
+    [{"tokens": "t1", "topics": ["a"]}],
+])
+def test_invalid_operations_are_rejected(operations):
+    with pytest.raises(ValueError):
+        groupTokensByTopic(operations)
+
+
+def test_token_topic_pairs_are_capped():
+    tokens = [f"t{index}" for index in range(MAX_TOKEN_TOPIC_PAIRS // 2)]
+
+    assert len(groupTokensByTopic([{"tokens": tokens, "topics": ["a", "b"]}])["a"]) == len(tokens)
+    with pytest.raises(ValueError):
+        groupTokensByTopic([
+            {"tokens": tokens, "topics": ["a", "b"]},
+            {"tokens": ["t0"], "topics": ["c"]},
+        ])
+
+
+def test_tokens_are_sent_in_chunks_of_1000_per_topic(fakes):
+    tokens = [f"t{index}" for index in range(2500)]
+
+    results = manageTopicsInBulk({"a": tokens, "b": tokens[:10]}, True, NOOP_METRICS)
+
+    assert fakes.fcm.rpcs["fcm_topic_management"] == 4
+    assert results["a"] == {"successCount": 2500, "failureCount": 0, "errors": []}
+    assert results["b"]["successCount"] == 10
+    assert fakes.fcm.topics["a"] == set(tokens)
+    assert FCM_TOPIC_TOKEN_LIMIT == 1000
+
+
+def test_errors_are_mapped_back_to_their_tokens_across_chunks(fakes):
+    tokens = [f"t{index}" for index in range(1500)]
+    fakes.fcm.dead_tokens.update({"t3", "t1200"})
+
+    results = manageTopicsInBulk({"a": tokens}, True, NOOP_METRICS)
+
+    assert results["a"]["successCount"] == 1498
+    assert sorted(results["a"]["errors"], key=lambda error: error["token"]) == [
+        {"token": "t1200", "reason": "NOT_FOUND"},
+        {"token": "t3", "reason": "NOT_FOUND"},
+    ]
+
+
+def test_failed_call_is_reported_for_each_of_its_tokens(fakes):
+    manage = fakes.fcm.subscribe_to_topic
+
+    def fail_second_chunk(tokens, topic, app=None):
+        if tokens[0] == "t1000":
+            raise exceptions.UnavailableError("FCM down")
+        return manage(tokens, topic)
+
+    with mock.patch.object(messaging, "subscribe_to_topic", fail_second_chunk):
+        results = manageTopicsInBulk(
+            {"a": [f"t{index}" for index in range(1200)]}, True, NOOP_METRICS
+        )
+
+    assert results["a"]["successCount"] == 1000
+    assert results["a"]["failureCount"] == 200
+    assert results["a"]["errors"][0] == {"token": "t1000", "reason": "FCM down"}
+
+
+def test_bulk_endpoint_reports_per_topic_results(fakes, app):
+    fakes.fcm.dead_tokens.add("t2")
+
+    status, body = call(app, subscription_web.bulkSubscribeToTopics, {
+        "operations": [{"tokens": ["t1", "t2"], "topics": ["a", "b"]}],
+    })
+
+    assert status == 200
+    assert body["success"] is False
+    assert body["results"]["a"]["successCount"] == 1
+    assert body["results"]["b"]["errors"] == [{"token": "t2", "reason": "NOT_FOUND"}]
+
+
+def test_bulk_endpoint_answers_400_above_the_pair_cap(fakes, app):
+    tokens = [f"t{index}" for index in range(MAX_TOKEN_TOPIC_PAIRS + 1)]
+
+    status, body = call(app, subscription_web.bulkUnsubscribeFromTopics, {
+        "operations": [{"tokens": tokens, "topics": ["a"]}],
+    })
+
+    assert status == 400
+    assert str(MAX_TOKEN_TOPIC_PAIRS) in body["error"]
+    assert sum(fakes.fcm.rpcs.values()) == 0
+
+
+@pytest.mark.parametrize("endpoint, method", [
+    (subscription_web.subscribeToTopic, "subscribe_to_topic"),
+    (subscription_web.unsubscribeFromTopic, "unsubscribe_from_topic"),
+])
+def test_single_token_call_failing_outright_returns_500(fakes, app, endpoint, method):
+    with mock.patch.object(messaging, method, side_effect=exceptions.UnavailableError("down")):
+        status, body = call(app, endpoint, {"fcmToken": "token1", "topic": "property_p1_all"})
+
+    assert status == 500
+    assert "error" in body
+
+
+def test_single_token_rejected_by_fcm_returns_200_with_the_error(fakes, app):
+    fakes.fcm.dead_tokens.add("token1")
+
+    status, body = call(
+        app, subscription_web.subscribeToTopic, {"fcmToken": "token1", "topic": "property_p1_all"}
+    )
+
+    assert status == 200
+    assert body["success"] is False
+    assert body["response"]["failureCount"] == 1
+
+
+def test_registry_follows_topic_management_results(fakes, app):
+    fakes.fcm.dead_tokens.add("t2")
+
+    call(app, subscription_web.bulkSubscribeToTopics, {
+        "operations": [{"tokens": ["t1", "t2"], "topics": ["a", "b"]}],
+    })
+    call(app, subscription_web.unsubscribeFromTopic, {"fcmToken": "t1", "topic": "a"})
+
+    registry = fakes.db.dump(tokenRegistry.FCM_TOKENS_COLLECTION)
+    t1 = registry[tokenRegistry.tokenDocumentId("t1")]
+    t2 = registry[tokenRegistry.tokenDocumentId("t2")]
+    assert (t1["topics"], t1["dead"]) == (["b"], False)
+    assert (t2["dead"], t2["deadReason"]) == (True, "NOT_FOUND")